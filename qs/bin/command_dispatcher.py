@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""
+A module that runs the built-in QS/VMS command handlers on a pool of worker
+threads.
+
+The command monitor used to run every pending command inline, one after the
+other, on the thread that polls the Command_Log table.  A slow command (a
+CALL can wait up to 60 seconds for the radio, a SYNC_* command for the
+ground link) therefore held up every other pending command and the next
+poll.  Now the poll only claims the pending commands and submits them to the
+CommandDispatcher, which runs them on a pool of workers.
+
+Each command type is registered with its handler and:
+
+    - a group and a limit: at most limit commands of the same group run at
+      the same time (for example the radio commands share the one radio, so
+      only one of them runs at a time).  Commands whose group is busy wait
+      without holding up commands of other groups.
+    - a priority: pending commands are started in the order of the
+      Command_Log priority column, then the priority of their type, then the
+      order they were submitted in.
+    - a timeout: a command that is still running after this many seconds is
+      completed as failed.  Python threads can't be stopped, so the handler
+      keeps running and the command's "cancel" event is set so a handler
+      that checks it (see cancelled()) can give up early.  The command keeps
+      its group slot until the handler returns, because it may still be
+      using what the group protects (such as the radio), but its worker is
+      replaced so the pool doesn't shrink.  At most max_abandoned workers
+      are replaced at a time, after that the pool shrinks until an
+      abandoned handler returns.  vms_db.complete_commands ignores the
+      result of a command whose cancel event is set, so a late result
+      doesn't overwrite the failure.
+
+Commands of a type that isn't registered are run by the default handler.
+"""
+
+import bisect
+import itertools
+import sys
+import syslog
+import threading
+import time
+import traceback
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,too-many-instance-attributes,too-many-arguments
+
+DEFAULT_WORKERS = 4
+DEFAULT_TIMEOUT = 300.0
+
+# The number of abandoned commands whose workers are replaced
+DEFAULT_MAX_ABANDONED = 4
+
+# How often the watchdog checks the running commands when none of them have
+# a deadline
+WATCHDOG_INTERVAL = 60.0
+
+
+def cancelled(cmd):
+    """
+    Returns True if a command has timed out or been cancelled, handlers can
+    check this to stop early.
+    """
+    event = cmd.get('cancel')
+    return bool(event and event.is_set())
+
+
+class CommandType(object):
+    """
+    How one type of command is run.
+    """
+    def __init__(self, name, handler, group=None, limit=1, priority=0, timeout=DEFAULT_TIMEOUT):
+        self.name = name
+        self.handler = handler
+        self.group = group or name
+        self.limit = limit
+        self.priority = priority
+        self.timeout = timeout
+
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.cancels = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def stats(self):
+        return {
+            'group': self.group,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'cancels': self.cancels,
+            'avg_wait': self.total_wait / self.completed if self.completed else 0.0,
+            'max_wait': self.max_wait,
+            'avg_time': self.total_time / self.completed if self.completed else 0.0,
+            'max_time': self.max_time,
+        }
+
+
+class Task(object):
+    """
+    A submitted command.
+    """
+    def __init__(self, cmd, ctype, seq):
+        self.cmd = cmd
+        self.ctype = ctype
+        priority = cmd.get('priority')
+        if priority is None:
+            priority = ctype.priority
+        self.key = (priority, ctype.priority, seq)
+        self.submitted = time.time()
+        self.started = None
+        self.deadline = None
+        self.thread = None
+        # Set once the command has been completed by the dispatcher because
+        # it timed out or was cancelled, and whether its worker was replaced
+        self.abandoned = False
+        self.replaced = False
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+
+class CommandDispatcher(object):
+    """
+    Runs commands on a pool of worker threads.  complete is called with
+    (cmd, success, message) to complete a command that failed without being
+    completed by its handler, timed out or was cancelled.  default is the
+    handler of the commands whose type hasn't been registered.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, complete=None, default=None, default_timeout=DEFAULT_TIMEOUT, max_abandoned=DEFAULT_MAX_ABANDONED):
+        self.num_workers = workers
+        self.max_abandoned = max_abandoned
+        self.complete = complete
+        self.cond = threading.Condition()
+        self.types = {}
+        # The limit and the number of running commands of each group
+        self.group_limits = {}
+        self.group_running = {}
+        self.default = None
+        if default:
+            self.default = CommandType('default', default, timeout=default_timeout)
+            self.group_limits['default'] = 1
+            self.group_running['default'] = 0
+        self.counter = itertools.count()
+        # Sorted by priority
+        self.pending = []
+        self.running = []
+        # The number of workers, not counting the ones that are still running
+        # a command that timed out, and the number of those that have been
+        # replaced
+        self.workers = 0
+        self.replaced = 0
+        self.active = False
+        self.threads = []
+
+    def register(self, name, handler, group=None, limit=1, priority=0, timeout=DEFAULT_TIMEOUT):
+        """
+        Registers the handler of a command type.  Commands in the same group
+        share the group's limit, which is the limit given when the first type
+        of the group was registered.
+        """
+        ctype = CommandType(name, handler, group, limit, priority, timeout)
+        with self.cond:
+            self.types[name] = ctype
+            self.group_limits.setdefault(ctype.group, limit)
+            self.group_running.setdefault(ctype.group, 0)
+        return ctype
+
+    def start(self):
+        with self.cond:
+            if self.active:
+                return
+            self.active = True
+            for _ in range(self.num_workers):
+                self._add_worker()
+        t = threading.Thread(target=self._watchdog, name='command-watchdog')
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def stop(self, wait=True, timeout=None):
+        """
+        Stops the workers once the commands that are running have finished.
+        The commands that haven't started have already been claimed, so they
+        are completed as failed.
+        """
+        with self.cond:
+            self.active = False
+            self.cond.notify_all()
+            threads = list(self.threads)
+            pending = self.pending
+            self.pending = []
+        for task in pending:
+            self._finish(task.cmd, False, 'Command not run, the VMS is stopping')
+        if wait:
+            for t in threads:
+                if t is not threading.current_thread():
+                    t.join(timeout)
+        self.threads = []
+
+    def _add_worker(self):
+        # Must be called with the lock held
+        self.workers += 1
+        t = threading.Thread(target=self._work, name='command-worker')
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def submit(self, cmd):
+        """
+        Queues a claimed command to be run.
+        """
+        ctype = self.types.get(cmd['command'], self.default)
+        if ctype is None:
+            self._finish(cmd, False, 'Unknown command {}'.format(cmd['command']))
+            return None
+        cmd['cancel'] = threading.Event()
+        task = Task(cmd, ctype, next(self.counter))
+        with self.cond:
+            ctype.submitted += 1
+            bisect.insort(self.pending, task)
+            self.cond.notify_all()
+        return task
+
+    def cancel(self, event_key):
+        """
+        Cancels a pending or running command.  Returns True if the command was
+        found.
+        """
+        with self.cond:
+            for task in self.pending:
+                if task.cmd.get('event_key') == event_key:
+                    self.pending.remove(task)
+                    task.ctype.cancels += 1
+                    task.cmd['cancel'].set()
+                    break
+            else:
+                for task in self.running:
+                    if task.cmd.get('event_key') == event_key and not task.abandoned:
+                        task.ctype.cancels += 1
+                        self._abandon(task)
+                        break
+                else:
+                    return False
+        self._finish(task.cmd, False, 'Command cancelled')
+        return True
+
+    def _next(self):
+        # Must be called with the lock held.  Returns the highest priority
+        # pending command whose group isn't busy.
+        for task in self.pending:
+            group = task.ctype.group
+            if self.group_running[group] < self.group_limits[group]:
+                self.pending.remove(task)
+                return task
+        return None
+
+    def _work(self):
+        while True:
+            with self.cond:
+                task = None
+                while self.active:
+                    task = self._next()
+                    if task:
+                        break
+                    self.cond.wait()
+                if not task:
+                    self.workers -= 1
+                    return
+                task.started = time.time()
+                if task.ctype.timeout:
+                    task.deadline = task.started + task.ctype.timeout
+                task.thread = threading.current_thread()
+                self.group_running[task.ctype.group] += 1
+                self.running.append(task)
+                self.cond.notify_all()
+
+            self._run(task)
+
+            with self.cond:
+                self.running.remove(task)
+                ctype = task.ctype
+                end = time.time()
+                ctype.completed += 1
+                ctype.total_wait += task.started - task.submitted
+                ctype.max_wait = max(ctype.max_wait, task.started - task.submitted)
+                ctype.total_time += end - task.started
+                ctype.max_time = max(ctype.max_time, end - task.started)
+                self.group_running[ctype.group] -= 1
+                self.cond.notify_all()
+                if task.abandoned:
+                    syslog.syslog(syslog.LOG_WARNING, 'Command {} finished {:.1f}s after it was abandoned'.format(ctype.name, end - task.deadline if task.deadline else 0.0))
+                    if task.replaced:
+                        # Another worker has taken this one's place
+                        self.replaced -= 1
+                        return
+                    self.workers += 1
+
+    def _run(self, task):
+        # pylint: disable=bare-except
+        try:
+            task.ctype.handler(task.cmd)
+        except:
+            task.ctype.errors += 1
+            msg = traceback.format_exception(*sys.exc_info())
+            syslog.syslog(syslog.LOG_ERR, 'Error in command {}: {}'.format(task.ctype.name, msg))
+            if not cancelled(task.cmd):
+                self._finish(task.cmd, False, msg)
+
+    def _abandon(self, task):
+        # Must be called with the lock held.  Replaces the worker of a running
+        # command, unless too many workers have been replaced already.  The
+        # group slot is only freed when the handler returns.
+        task.abandoned = True
+        task.cmd['cancel'].set()
+        self.workers -= 1
+        if self.active and self.replaced < self.max_abandoned:
+            task.replaced = True
+            self.replaced += 1
+            self._add_worker()
+        self.cond.notify_all()
+
+    def _watchdog(self):
+        while True:
+            expired = []
+            with self.cond:
+                if not self.active:
+                    return
+                now = time.time()
+                deadlines = []
+                for task in self.running:
+                    if task.abandoned or task.deadline is None:
+                        continue
+                    if task.deadline <= now:
+                        task.ctype.timeouts += 1
+                        self._abandon(task)
+                        expired.append(task)
+                    else:
+                        deadlines.append(task.deadline)
+                if not expired:
+                    self.cond.wait(min(deadlines) - now if deadlines else WATCHDOG_INTERVAL)
+            for task in expired:
+                syslog.syslog(syslog.LOG_ERR, 'Command {} timed out after {}s'.format(task.ctype.name, task.ctype.timeout))
+                self._finish(task.cmd, False, 'Command timed out after {} seconds'.format(task.ctype.timeout))
+
+    def _finish(self, cmd, success, message):
+        # The cancel event is removed from the copy that is completed so that
+        # the result isn't ignored
+        if self.complete:
+            self.complete(dict((k, v) for (k, v) in cmd.items() if k != 'cancel'), success, message)
+
+    def stats(self):
+        with self.cond:
+            types = dict((name, ctype.stats()) for (name, ctype) in self.types.items())
+            if self.default:
+                types['default'] = self.default.stats()
+            return {
+                'workers': self.workers,
+                'pending': len(self.pending),
+                'running': len(self.running),
+                'abandoned': len([t for t in self.running if t.abandoned]),
+                'types': types,
+            }
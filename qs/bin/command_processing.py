@@ -26,6 +26,7 @@ if __name__ == '__main__':
     parser.add_argument('--no-vms-username', action='store_true', help='specify that a username is not required for the QS/VMS database (overrides --vms-username)')
     parser.add_argument('--vms-password', default='Quicksat!1', help='password for the QS/VMS database')
     parser.add_argument('--no-vms-password', action='store_true', help='specify that a password is not required for the QS/VMS database (overrides --vms-password)')
+    parser.add_argument('--vms-pool-size', type=int, default=4, help='number of connections in the QS/VMS database connection pool')
     parser.add_argument('--flight-stream-flag', default='DISABLED', help='When True it tells VMS to stream data from stepSATdb_FlightAV between the vehicle and ground station')
 
     # Parse the command line arguments
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+A module that runs the custom "MODULE.CMD" commands (mcp.*, vms_file.*,
+generic.*, ...) in a supervised pool of long-lived worker processes.
+
+Previously every custom command was run in a new multiprocessing.Process
+that opened its own database connections and imported the handler module,
+which takes seconds on the gateway, and the module level objects of the
+handlers (such as mcp.MCP and vms_file.VMS_GROUND) were lost after every
+command.  The CommandWorkers start a few worker processes that import the
+handler modules and open a database connection pool once, then run the
+commands they receive over a queue.
+
+The pool is supervised from a thread of the parent process:
+
+    - workers that have run max_commands commands exit and are replaced, so
+      a handler that leaks memory or file descriptors can't grow forever.
+    - a worker that crashes, or that is killed because its command ran for
+      longer than the timeout, is replaced and its command is completed as
+      failed.
+
+The commands are still run in separate processes so that a handler can't
+block or crash the VMS itself.
+"""
+
+import importlib
+import itertools
+import multiprocessing
+import Queue
+import sys
+import syslog
+import threading
+import time
+import traceback
+
+import db_pool
+import query_stats
+import scheduler
+import vms_db
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,too-many-instance-attributes,too-many-arguments
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_COMMANDS = 100
+
+# How often the supervisor checks the workers when there are no results
+SUPERVISE_INTERVAL = 1.0
+
+# How long to wait for the workers to exit when the pool is stopped
+STOP_TIMEOUT = 5.0
+
+
+def run_command(db, cmd, thread_run_event):
+    """
+    Runs a "MODULE.CMD" command with the process() function of the module,
+    and returns the status (0 is success).
+    """
+    status = 5
+
+    # If the command is "STRING.STRING", split the string and attempt
+    # to import a module to handle the command.
+    subcmd = cmd['command'].lower().split('.', 2)
+    if len(subcmd) == 2:
+        # pylint: disable=bare-except
+        try:
+            m = importlib.import_module(subcmd[0])
+            cmd_process_func = getattr(m, 'process')
+        except KeyboardInterrupt as e:
+            raise e
+        except:
+            status = 3
+            # The previous statements could fail if a custom command
+            # package is not defined, or if it does not have a process
+            # function defined.
+            db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
+            cmd_process_func = None
+
+        if cmd_process_func:
+            try:
+                result = cmd_process_func(db, subcmd[1], cmd['data'], thread_run_event)
+                status = int(not result)
+                db.complete_commands(cmd, result)
+            except KeyboardInterrupt as e:
+                raise e
+            except:
+                # Ensure that the threads are not stuck paused
+                thread_run_event.set()
+
+                status = 4
+                db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
+    else:
+        status = 2
+        # This is not a custom command, just log it as an unknown error
+        msg = 'Unknown command {}:{}'.format(cmd['command'], cmd)
+        db.complete_commands(cmd, False, msg)
+
+    return status
+
+
+def _worker(wid, db_args, modules, tasks, results, current, thread_run_event, max_commands):
+    """
+    The main function of a worker process.  The event_key and the start time
+    of the command that is running are kept in current, which is shared
+    memory, so the supervisor can tell which command was lost even if the
+    worker dies without sending anything.
+
+    Workers are forked while the other threads of the VMS are running, so
+    the module level locks that those threads take (the query statistics
+    and the connection pools) may have been held at the time of the fork.
+    They are re-created before the database is opened.
+    """
+    query_stats.STATS.reset_after_fork()
+    db_pool.reset_after_fork()
+    scheduler.reset_after_fork()
+    db = vms_db.vms_db(**db_args)
+    for name in modules:
+        # pylint: disable=bare-except
+        try:
+            importlib.import_module(name)
+        except:
+            syslog.syslog(syslog.LOG_ERR, 'Command worker {} unable to import {}: {}'.format(wid, name, traceback.format_exception(*sys.exc_info())))
+
+    handled = 0
+    while not max_commands or handled < max_commands:
+        cmd = tasks.get()
+        if cmd is None:
+            break
+        start = time.time()
+        current[0] = cmd['event_key']
+        current[1] = start
+        status = run_command(db, cmd, thread_run_event)
+        current[0] = 0
+        results.put((wid, cmd['event_key'], status, time.time() - start))
+        handled += 1
+
+
+class CommandWorkers(object):
+    """
+    A pool of worker processes that run custom commands.  complete is called
+    with (cmd, success, message) for the commands that a worker could not
+    complete because it crashed or timed out.
+    """
+    def __init__(self, db_args, thread_run_event, complete, workers=DEFAULT_WORKERS, modules=(), max_commands=DEFAULT_MAX_COMMANDS, timeout=None):
+        self.db_args = db_args
+        self.thread_run_event = thread_run_event
+        self.complete = complete
+        self.num_workers = workers
+        self.modules = tuple(modules)
+        self.max_commands = max_commands
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.ids = itertools.count(1)
+        # The (process, current command) of the workers by id
+        self.workers = {}
+        # The commands that have been submitted and not finished by event_key
+        self.commands = {}
+        self.active = False
+        self.thread = None
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.crashes = 0
+        self.timeouts = 0
+        self.recycled = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.active:
+                return
+            self.active = True
+            for _ in range(self.num_workers):
+                self._start_worker()
+        self.thread = threading.Thread(target=self._supervise, name='command-workers')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the workers, the commands that haven't been started are completed
+        as failed and the workers that don't exit are killed.
+        """
+        with self.lock:
+            if not self.active:
+                return
+            self.active = False
+            workers = [proc for (proc, _) in self.workers.values()]
+        for _ in workers:
+            self.tasks.put(None)
+        deadline = time.time() + STOP_TIMEOUT
+        for proc in workers:
+            proc.join(max(deadline - time.time(), 0))
+            if proc.is_alive():
+                proc.terminate()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self._drain_results()
+        with self.lock:
+            commands = self.commands.values()
+            self.commands = {}
+            self.workers = {}
+        for cmd in commands:
+            self.complete(cmd, False, 'Command not completed, the VMS is stopping')
+
+    def _start_worker(self):
+        # Must be called with the lock held
+        wid = next(self.ids)
+        # The event_key (0 when idle) and start time of the running command
+        current = multiprocessing.Array('d', 2, lock=False)
+        proc = multiprocessing.Process(
+            target=_worker,
+            name='command-worker-{}'.format(wid),
+            args=(wid, self.db_args, self.modules, self.tasks, self.results, current, self.thread_run_event, self.max_commands))
+        proc.daemon = True
+        proc.start()
+        self.workers[wid] = (proc, current)
+        syslog.syslog(syslog.LOG_INFO, 'command worker {} started (pid:{})'.format(wid, proc.pid))
+
+    def submit(self, cmd):
+        """
+        Queues a custom command to be run by the next free worker.
+        """
+        # Only the Command_Log columns are sent to the worker
+        cmd = dict((k, v) for (k, v) in cmd.items() if k != 'cancel')
+        with self.lock:
+            self.commands[cmd['event_key']] = cmd
+            self.submitted += 1
+        self.tasks.put(cmd)
+
+    def _supervise(self):
+        while True:
+            with self.lock:
+                if not self.active:
+                    return
+            # pylint: disable=bare-except
+            try:
+                self._handle(self.results.get(True, SUPERVISE_INTERVAL))
+            except Queue.Empty:
+                pass
+            try:
+                self._check_workers()
+            except:
+                syslog.syslog(syslog.LOG_ERR, 'Error supervising the command workers: {}'.format(traceback.format_exception(*sys.exc_info())))
+
+    def _drain_results(self):
+        while True:
+            try:
+                self._handle(self.results.get_nowait())
+            except Queue.Empty:
+                return
+
+    def _handle(self, msg):
+        (_, event_key, status, elapsed) = msg
+        with self.lock:
+            self.commands.pop(event_key, None)
+            self.completed += 1
+            if status:
+                self.failed += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def _check_workers(self):
+        now = time.time()
+        with self.lock:
+            if self.timeout:
+                for (wid, (proc, current)) in self.workers.items():
+                    if current[0] and proc.is_alive() and now - current[1] > self.timeout:
+                        syslog.syslog(syslog.LOG_ERR, 'command worker {} (pid:{}) killed, command {} timed out after {}s'.format(wid, proc.pid, int(current[0]), self.timeout))
+                        self.timeouts += 1
+                        proc.terminate()
+                        proc.join()
+            dead = [(wid, proc, current) for (wid, (proc, current)) in self.workers.items() if not proc.is_alive()]
+
+        if not dead:
+            return
+        # The results of the dead workers are read before their commands are
+        # treated as lost
+        self._drain_results()
+        lost = []
+        with self.lock:
+            for (wid, proc, current) in dead:
+                del self.workers[wid]
+                event_key = int(current[0])
+                if event_key:
+                    cmd = self.commands.pop(event_key, None)
+                    if cmd:
+                        self.failed += 1
+                        lost.append((cmd, proc))
+                    if proc.exitcode != -15:
+                        self.crashes += 1
+                    syslog.syslog(syslog.LOG_ERR, 'command worker {} (pid:{}) exited with {} while running command {}'.format(wid, proc.pid, proc.exitcode, event_key))
+                else:
+                    self.recycled += 1
+                    syslog.syslog(syslog.LOG_INFO, 'command worker {} (pid:{}) exited with {}'.format(wid, proc.pid, proc.exitcode))
+                if self.active:
+                    self._start_worker()
+        for (cmd, proc) in lost:
+            self.complete(cmd, False, 'Command worker exited with {} before the command completed'.format(proc.exitcode))
+
+    def stats(self):
+        with self.lock:
+            running = len([c for (_, c) in self.workers.values() if c[0]])
+            return {
+                'workers': len(self.workers),
+                'queued': len(self.commands) - running,
+                'running': running,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'crashes': self.crashes,
+                'timeouts': self.timeouts,
+                'recycled': self.recycled,
+                'avg_time': self.total_time / self.completed if self.completed else 0.0,
+                'max_time': self.max_time,
+            }
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+A module that exports the rows of a QS/VMS database table to a file without
+holding the whole table in memory.
+
+Rows are read from an unbuffered cursor a chunk at a time and written as
+JSON-lines (one JSON object per line), optionally gzip compressed.  The
+session and time range filters are applied in the SELECT statement so only
+the requested rows are read from the database.
+"""
+
+import datetime
+import gzip
+import json
+import os
+import os.path
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,too-many-arguments,protected-access
+
+OUTPUT_DIR = '/opt/qs/outputs'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+DEFAULT_CHUNK_SIZE = 500
+
+
+def parse_filter(data):
+    """
+    Parses the data of a RETRIEVE_* command into the export filter options.
+    The data is a comma separated list that may contain:
+        - an integer recording session ID
+        - one or two timestamps (YYYY-MM-DD HH:MM:SS), the first is the start
+          of the time range and the second is the end
+        - "gzip" to compress the output file
+    An empty string selects all rows.  Raises a ValueError if the data can't
+    be parsed.
+    """
+    options = {'session': None, 'start': None, 'end': None, 'compress': False}
+    for token in [t.strip() for t in (data or '').split(',') if t.strip()]:
+        if token.lower() == 'gzip':
+            options['compress'] = True
+            continue
+        try:
+            options['session'] = int(token)
+            continue
+        except ValueError:
+            pass
+        timestamp = datetime.datetime.strptime(token, TIMESTAMP_FORMAT)
+        if options['start'] is None:
+            options['start'] = timestamp
+        elif options['end'] is None:
+            options['end'] = timestamp
+        else:
+            raise ValueError('too many timestamps in "{}"'.format(data))
+    return options
+
+
+def build_query(table, column, session=None, start=None, end=None):
+    """
+    Returns the (statement, parameters) that select the requested rows of a
+    table, newest first.
+    """
+    where = []
+    params = {}
+    if session is not None:
+        where.append('`{}`.`Recording_Sessions_recording_session_id`=%(session)s'.format(table))
+        params['session'] = session
+    if start is not None:
+        where.append('`{}`.`{}`>%(start)s'.format(table, column))
+        params['start'] = start
+    if end is not None:
+        where.append('`{}`.`{}`<=%(end)s'.format(table, column))
+        params['end'] = end
+
+    stmt = '''
+        SELECT * FROM `stepSATdb_Flight`.`{table}`
+            {where}
+            ORDER BY `{table}`.`{column}` DESC
+    '''.format(table=table, column=column, where='WHERE ' + ' AND '.join(where) if where else '')
+    return (stmt, params)
+
+
+def export_table(db, table, column, filename, session=None, start=None, end=None, compress=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes the selected rows of a table to filename as JSON-lines.  If
+    compress is set the file is gzip compressed and ".gz" is appended to the
+    filename.
+
+    The file is written under a temporary name and renamed when it is complete
+    so that a partial file is never picked up.  Returns a tuple of the output
+    filename, the number of rows written and the newest value of the sort
+    column (or None if no rows were selected).
+    """
+    (stmt, params) = build_query(table, column, session, start, end)
+    if compress:
+        filename += '.gz'
+    tmp_filename = filename + '.tmp'
+
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    if compress:
+        f = gzip.open(tmp_filename, 'wb')
+    else:
+        f = open(tmp_filename, 'w')
+
+    count = 0
+    newest = None
+    complete = False
+    try:
+        # An unbuffered cursor streams the rows from the server as they are
+        # fetched instead of reading the entire result set into memory.
+        with db._cursor(buffered=False) as cursor:
+            cursor.execute(stmt, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                if newest is None:
+                    newest = rows[0][column]
+                f.write(''.join(json.dumps(row, default=str) + '\n' for row in rows))
+                count += len(rows)
+        complete = True
+    finally:
+        f.close()
+        if not complete:
+            os.remove(tmp_filename)
+
+    os.rename(tmp_filename, filename)
+    return (filename, count, newest)
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""
+A module that provides a thread-safe pool of MySQL connections that is shared
+by the QS/VMS database interface classes (vms_db, vms_db_ground, linkstar and
+ls_comm_flight_stream).
+
+Rather than holding a single connection and cursor behind a lock, each database
+call checks out a connection for the duration of the call, so independent
+periodic jobs can run their queries concurrently.
+"""
+
+import contextlib
+import os
+import Queue
+import syslog
+import threading
+import time
+
+# To connect to the QS/VMS database, install with
+#   $ pip install MySQL-python
+# but that requires other libraries, so it is recommended to install with this
+# command, and then install the mysql connector package:
+#   $ sudo apt-get install python-mysqldb
+#   $ pip install mysql-connector-python
+# install pip as described here:
+#   https://pypi.python.org/pypi/setuptools
+import mysql.connector
+import mysql.connector.errors
+
+import query_stats
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name
+
+# The default number of connections in each pool, and how long (in seconds) a
+# connection may sit idle before it is pinged when it is checked out.
+DEFAULT_POOL_SIZE = 4
+DEFAULT_HEALTH_CHECK_INTERVAL = 30.0
+
+# The errors that indicate that a connection is no longer usable
+CONNECTION_ERRORS = (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError)
+
+# The pools that have been created in this process, indexed by the connection
+# configuration.
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(config, size=None, **kwargs):
+    """
+    Returns the pool for the specified connection configuration, creating it if
+    necessary.  All objects that connect to the same database with the same
+    credentials share a single pool.
+
+    Pools are tracked per-process because connections must not be shared
+    between a parent process and the command processes that it spawns.
+    """
+    key = (os.getpid(),) + tuple(sorted((k, str(v)) for k, v in config.items()))
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if not pool:
+            pool = ConnectionPool(config, size or DEFAULT_POOL_SIZE, **kwargs)
+            _POOLS[key] = pool
+    return pool
+
+
+def reset_after_fork():
+    """
+    Forgets the pools of the parent process in a child process that was
+    forked from a process with other threads.  The lock may have been held
+    by one of those threads when the process was forked, and it would never
+    be released in the child.
+    """
+    global _POOLS_LOCK
+    _POOLS_LOCK = threading.Lock()
+    _POOLS.clear()
+
+
+class ConnectionPool(object):
+    """
+    A fixed-size pool of MySQL connections.
+
+    Connections are created lazily, up to the pool size.  If all connections
+    are in use, a checkout waits (up to checkout_timeout seconds, or forever if
+    the timeout is None) for one to be returned.  A thread that already has a
+    connection checked out re-uses that connection for nested checkouts so that
+    a thread can never deadlock waiting on itself.
+    """
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, config, size=DEFAULT_POOL_SIZE, checkout_timeout=None, health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL, stats=query_stats.STATS):
+        self.config = dict(config)
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+
+        self.lock = threading.Lock()
+        self.idle = Queue.LifoQueue()
+        self.local = threading.local()
+        self.created = 0
+
+        # Gauges used to size the pool
+        self.in_use = 0
+        self.max_in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.reconnects = 0
+
+        # Per-query statistics, set to None to disable.  Not named "stats", that
+        # is the method that returns the gauges above.
+        self.query_stats = stats
+
+    def _connect(self):
+        return mysql.connector.connect(**self.config)
+
+    def _checkout(self):
+        start = time.time()
+        item = None
+        create = False
+        with self.lock:
+            try:
+                item = self.idle.get_nowait()
+            except Queue.Empty:
+                if self.created < self.size:
+                    self.created += 1
+                    create = True
+
+        if not item and not create:
+            try:
+                item = self.idle.get(True, self.checkout_timeout)
+            except Queue.Empty:
+                raise mysql.connector.errors.PoolError('no connection available to {} after {} sec'.format(self.config.get('host'), self.checkout_timeout))
+
+        (conn, last_used) = item or (None, None)
+        if not conn and not create:
+            # A connection was discarded, which freed up a slot in the pool
+            with self.lock:
+                self.created += 1
+            create = True
+
+        if create:
+            # pylint: disable=bare-except
+            try:
+                conn = self._connect()
+            except:
+                self._release_slot()
+                raise
+
+        # Health check connections that have been idle for a while, since the
+        # server may have dropped them.
+        if last_used is not None and (time.time() - last_used) >= self.health_check_interval:
+            conn = self._check_health(conn)
+
+        waited = time.time() - start
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            if waited > 0.01:
+                self.waits += 1
+        # Remembered so the wait can be added to the first query made with
+        # the connection.
+        self.local.wait = waited
+        return conn
+
+    def _check_health(self, conn):
+        try:
+            if conn.is_connected():
+                return conn
+        except CONNECTION_ERRORS:
+            pass
+        return self._reconnect(conn)
+
+    def _reconnect(self, conn):
+        with self.lock:
+            self.reconnects += 1
+        try:
+            conn.reconnect(attempts=1, delay=0)
+            return conn
+        except mysql.connector.Error as err:
+            syslog.syslog(syslog.LOG_ERR, 'Error reconnecting to {}: {}'.format(self.config.get('host'), err))
+            # pylint: disable=bare-except
+            try:
+                conn.close()
+            except:
+                pass
+
+        # Replace the bad connection with a new one, if this fails the slot is
+        # given up and the exception is passed on to the caller.
+        try:
+            return self._connect()
+        except:
+            self._release_slot()
+            raise
+
+    def _release_slot(self):
+        # Let any thread waiting for a connection know that it can create a
+        # new one.
+        with self.lock:
+            self.created -= 1
+        self.idle.put((None, None))
+
+    def _checkin(self, conn, broken=False):
+        with self.lock:
+            self.in_use -= 1
+
+        if broken:
+            # The connection raised an error that indicates it is no longer
+            # usable, try to reconnect it now so the next user gets a working
+            # connection.
+            try:
+                conn = self._reconnect(conn)
+            except mysql.connector.Error:
+                return
+        self.idle.put((conn, time.time()))
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of the "with" block.
+        """
+        local = self.local
+        if getattr(local, 'conn', None) is not None:
+            local.depth += 1
+            try:
+                yield local.conn
+            finally:
+                local.depth -= 1
+            return
+
+        conn = self._checkout()
+        local.conn = conn
+        local.depth = 1
+        broken = False
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            local.conn = None
+            local.depth = 0
+            self._checkin(conn, broken)
+
+    def _instrument(self, cursor):
+        if self.query_stats is None or not self.query_stats.enabled:
+            return cursor
+        wait = getattr(self.local, 'wait', 0.0)
+        self.local.wait = 0.0
+        return query_stats.InstrumentedCursor(cursor, self.query_stats, wait)
+
+    @contextlib.contextmanager
+    def cursor(self, dictionary=True, buffered=True):
+        """
+        Checks out a connection and creates a cursor for the duration of the
+        "with" block.  If the connection is not in autocommit mode, the work
+        done with the cursor is committed when the block exits without an
+        exception.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor(dictionary=dictionary, buffered=buffered)
+            try:
+                yield self._instrument(cursor)
+                # Work done inside of transaction() is committed when the
+                # transaction completes.
+                if not self.config.get('autocommit') and not getattr(self.local, 'transaction', False):
+                    conn.commit()
+            finally:
+                # pylint: disable=bare-except
+                try:
+                    cursor.close()
+                    # An unbuffered cursor that was not read to the end leaves
+                    # the rest of the results on the connection, which must be
+                    # discarded before the connection can be used again.
+                    if not buffered and conn.unread_result:
+                        conn.consume_results()
+                except:
+                    pass
+
+    @contextlib.contextmanager
+    def transaction(self, dictionary=True, buffered=True):
+        """
+        Checks out a connection and creates a cursor for the duration of the
+        "with" block, and runs all of the work done in the block in a single
+        transaction.  The transaction is committed when the block exits, or
+        rolled back if an exception is raised.  A transaction started while
+        the thread is already in a transaction becomes part of the outer
+        transaction.
+        """
+        with self.connection() as conn:
+            if getattr(self.local, 'transaction', False):
+                with self.cursor(dictionary=dictionary, buffered=buffered) as cursor:
+                    yield cursor
+                return
+
+            # A connection that is not in autocommit mode may have an implicit
+            # transaction open already, start from a clean state.
+            if conn.in_transaction:
+                conn.commit()
+            conn.start_transaction()
+            self.local.transaction = True
+            cursor = conn.cursor(dictionary=dictionary, buffered=buffered)
+            # pylint: disable=bare-except
+            try:
+                yield self._instrument(cursor)
+                conn.commit()
+            except:
+                try:
+                    conn.rollback()
+                except:
+                    pass
+                raise
+            finally:
+                self.local.transaction = False
+                try:
+                    cursor.close()
+                except:
+                    pass
+
+    def stats(self):
+        """
+        Returns a snapshot of the pool gauges.
+        """
+        with self.lock:
+            if self.checkouts:
+                avg_wait = self.wait_time / self.checkouts
+            else:
+                avg_wait = 0.0
+            return {
+                'host': self.config.get('host'),
+                'size': self.size,
+                'created': self.created,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'avg_wait': avg_wait,
+                'max_wait': self.max_wait_time,
+                'reconnects': self.reconnects,
+            }
+
+    def close(self):
+        """
+        Closes all idle connections in the pool.
+        """
+        while True:
+            try:
+                (conn, _) = self.idle.get_nowait()
+            except Queue.Empty:
+                break
+            if conn:
+                # pylint: disable=bare-except
+                try:
+                    conn.close()
+                except:
+                    pass
+                with self.lock:
+                    self.created -= 1
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+A module that provides a background writer that batches samples destined for
+the Flight_Data table.
+
+Rather than running one INSERT per sample, samples are appended to a bounded
+in-memory queue and written with multi-row INSERT statements when either the
+batch size or the flush interval is reached.
+"""
+
+import collections
+import datetime
+import syslog
+import threading
+import time
+
+import mysql.connector
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,too-many-instance-attributes,too-many-arguments,protected-access
+
+# What to do with a new sample when the queue is full:
+#   drop-oldest - discard the oldest queued sample to make room (default)
+#   drop-newest - discard the new sample
+#   block       - wait up to block_timeout seconds for the writer to make room,
+#                 then discard the new sample
+OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest', 'block')
+
+# The errors that mean a row was rejected because of its data, rather than
+# because the database could not be reached.  Only rows rejected with one of
+# these are ever dropped.
+DATA_ERRORS = (mysql.connector.IntegrityError, mysql.connector.DataError)
+
+
+class FlightDataWriter(object):
+    """
+    Batches Flight_Data samples and writes them from a background thread.
+
+    The time stamp and recording session of each sample are captured when the
+    sample is queued so that batching does not change the recorded values.
+    This means the time_stamp comes from the clock of the VMS process
+    (datetime.datetime.now(), local time) rather than from NOW() on the
+    database server as the single-row INSERT does; the two only differ if
+    the database runs on another host with a different clock or time zone.
+
+    A batch that fails to be written is retried on the next flush, on its
+    own so that new samples don't keep being added to it.  If the INSERT
+    was rejected because of the data (IntegrityError or DataError, for
+    example a parameter_id that doesn't exist), or it has failed max_retries
+    times, the batch is written one row at a time so that a bad row can't
+    hold up the others forever.  Only the rows that are rejected because of
+    their data are dropped; any other error (the database is unreachable,
+    no connection is available, ...) stops the flush and the rows are kept
+    until the database is back.
+    """
+    def __init__(self, db, batch_size=100, flush_interval=5.0, max_queue=10000, overflow='drop-oldest', block_timeout=1.0, max_retries=3):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('invalid overflow policy "{}", must be one of {}'.format(overflow, OVERFLOW_POLICIES))
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        # Serializes flushes from the writer thread and from flush() calls so
+        # that rows are always written in the order they were queued.
+        self.flush_lock = threading.Lock()
+        # Rows from a failed flush that will be retried with the next flush,
+        # and the number of times they have failed
+        self.retry = []
+        self.retry_attempts = 0
+        self.max_retries = max_retries
+
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.reported_drops = 0
+        self.flushes = 0
+        self.errors = 0
+        self.failed = 0
+
+    def start(self):
+        if not self.thread:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._thread)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, flush=True, timeout=None):
+        """
+        Stops the writer thread.  If flush is set any queued samples are
+        written before this function returns.
+        """
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+        if flush:
+            self.flush()
+
+    def write(self, parameter_id, parameter_value, time_stamp=None, session=None):
+        """
+        Queues a sample.  Returns False if the sample was dropped because the
+        queue is full.
+        """
+        if time_stamp is None:
+            time_stamp = datetime.datetime.now()
+        if session is None:
+            session = self.db.current_session()
+        row = (time_stamp, parameter_id, session, parameter_value)
+
+        with self.cond:
+            if len(self.queue) >= self.max_queue:
+                if self.overflow == 'drop-oldest':
+                    self.queue.popleft()
+                    self.dropped += 1
+                elif self.overflow == 'block':
+                    # Wake the writer and wait for it to make room
+                    self.cond.notify_all()
+                    deadline = time.time() + self.block_timeout
+                    while len(self.queue) >= self.max_queue:
+                        remaining = deadline - time.time()
+                        if remaining <= 0 or self.stop_event.isSet():
+                            break
+                        self.cond.wait(remaining)
+
+                if len(self.queue) >= self.max_queue:
+                    self.dropped += 1
+                    return False
+
+            self.queue.append(row)
+            self.queued += 1
+            if len(self.queue) >= self.batch_size:
+                self.cond.notify_all()
+        return True
+
+    def _thread(self):
+        last_flush = time.time()
+        while not self.stop_event.isSet():
+            with self.cond:
+                while len(self.queue) < self.batch_size and not self.stop_event.isSet():
+                    remaining = self.flush_interval - (time.time() - last_flush)
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            if self.stop_event.isSet():
+                return
+            self.flush()
+            last_flush = time.time()
+
+    def flush(self):
+        """
+        Synchronously writes all queued samples to the database.  Returns the
+        number of rows written.
+        """
+        total = 0
+        with self.flush_lock:
+            while True:
+                with self.cond:
+                    rows = self.retry
+                    self.retry = []
+                    if not rows:
+                        while self.queue and len(rows) < self.batch_size:
+                            rows.append(self.queue.popleft())
+                        # Let any writers that are blocked on a full queue
+                        # know that there is now room.
+                        self.cond.notify_all()
+                if not rows:
+                    break
+                err = self._write_rows(rows)
+                if err is None:
+                    self.retry_attempts = 0
+                    total += len(rows)
+                    continue
+
+                self.retry_attempts += 1
+                if not isinstance(err, DATA_ERRORS) and self.retry_attempts < self.max_retries:
+                    # Keep the failed rows so they are retried with the next
+                    # flush.
+                    with self.cond:
+                        self.retry = rows
+                    break
+
+                # Find the bad rows by writing the batch one row at a time
+                (written, remaining) = self._isolate(rows)
+                total += written
+                if remaining:
+                    # The database is unavailable, keep the rows that have
+                    # not been written and wait for the next flush.
+                    with self.cond:
+                        self.retry = remaining
+                    break
+                self.retry_attempts = 0
+
+        if self.dropped != self.reported_drops:
+            syslog.syslog(syslog.LOG_WARNING, 'Flight_Data writer queue full, {} samples dropped'.format(self.dropped - self.reported_drops))
+            self.reported_drops = self.dropped
+        return total
+
+    def _isolate(self, rows):
+        """
+        Writes rows one at a time and drops the ones that are rejected
+        because of their data.  Stops at the first other error.  Returns the
+        number of rows written and the rows that have not been written yet.
+        """
+        written = 0
+        failed = 0
+        for (i, row) in enumerate(rows):
+            err = self._write_rows([row])
+            if err is None:
+                written += 1
+            elif isinstance(err, DATA_ERRORS):
+                failed += 1
+            else:
+                rows = rows[i:]
+                break
+        else:
+            rows = []
+        if failed:
+            self.failed += failed
+            syslog.syslog(syslog.LOG_ERR, 'Flight_Data writer dropped {} samples that were rejected by the database'.format(failed))
+        return (written, rows)
+
+    def _write_rows(self, rows):
+        # Returns None if the rows were written, otherwise the error
+        stmt = '''
+            INSERT INTO `Flight_Data`( `time_stamp`, `parameter_id`, `Recording_Sessions_recording_session_id`, `parameter_value`) VALUES {}
+        '''.format(','.join(['(%s,%s,%s,%s)'] * len(rows)))
+        params = [value for row in rows for value in row]
+        try:
+            with self.db._cursor() as cursor:
+                cursor.execute(stmt, params)
+        except mysql.connector.Error as err:
+            self.errors += 1
+            print("MySQL Error: {}".format(err))
+            syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+            return err
+        self.flushes += 1
+        self.written += len(rows)
+        return None
+
+    def stats(self):
+        with self.cond:
+            pending = len(self.queue) + len(self.retry)
+        return {
+            'queued': self.queued,
+            'written': self.written,
+            'pending': pending,
+            'dropped': self.dropped,
+            'flushes': self.flushes,
+            'errors': self.errors,
+            'failed': self.failed,
+        }
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Benchmark of the GPS_Satellite_View update that is done every GPS tick.
+
+Compares the original update (delete the whole table, then one INSERT IGNORE
+per satellite) with vms_db.gps_satellite_data() (one transaction with a
+multi-row upsert of the changed satellites and a delete of the satellites that
+are no longer in view).  The number of statements is measured with the
+server's "Questions" counter, so this should be run against a test database
+that nothing else is using; the contents of GPS_Satellite_View are replaced.
+"""
+
+import argparse
+import random
+import time
+
+import vms_db
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,protected-access
+
+
+def legacy_gps_satellite_data(db, SatellitesInTracked, SatellitesInView):
+    # The GPS_Satellite_View update as it was originally implemented
+    count = int(len(SatellitesInView)/4)
+    with db._cursor() as cursor:
+        cursor.execute('''
+            DELETE FROM `GPS_Satellite_View`
+        ''')
+    for x in range(0, count):
+        tracked = int(SatellitesInView[4*x] in SatellitesInTracked[:count])
+        with db._cursor() as cursor:
+            cursor.execute('''
+                INSERT IGNORE INTO `GPS_Satellite_View`(`PRN_number`, `elevation`, `azimuth`, `snr`, `being_tracked`) VALUES ('{}','{}','{}','{}','{}')
+            '''.format(SatellitesInView[4*x], SatellitesInView[(4*x)+1], SatellitesInView[(4*x)+2], SatellitesInView[(4*x)+3], tracked))
+
+
+class SkySimulator(object):
+    """
+    Generates a slowly changing set of satellites, similar to what a GPS
+    receiver reports from one fix to the next.
+    """
+    def __init__(self, seed, num_satellites, snr_change):
+        self.random = random.Random(seed)
+        self.snr_change = snr_change
+        self.sats = {}
+        for prn in self.random.sample(range(1, 33), num_satellites):
+            self.sats[prn] = [self.random.randint(5, 90), self.random.randint(0, 359), self.random.randint(20, 50)]
+
+    def tick(self):
+        for (prn, sat) in self.sats.items():
+            # Elevation and azimuth change slowly, SNR fluctuates
+            if self.random.random() < 0.05:
+                sat[0] = max(0, min(90, sat[0] + self.random.choice((-1, 1))))
+                sat[1] = (sat[1] + 1) % 360
+            if self.random.random() < self.snr_change:
+                sat[2] = max(0, min(60, sat[2] + self.random.choice((-1, 1))))
+            # Occasionally a satellite sets and another rises
+            if self.random.random() < 0.01:
+                del self.sats[prn]
+                new_prn = self.random.choice([p for p in range(1, 33) if p not in self.sats])
+                self.sats[new_prn] = [5, self.random.randint(0, 359), 20]
+
+        view = []
+        for prn in sorted(self.sats.keys()):
+            view.extend(['{:02d}'.format(prn)] + ['{:02d}'.format(v) for v in self.sats[prn]])
+        tracked = [p for p in view[0::4] if self.random.random() < 0.75]
+        return (tracked, view)
+
+
+def questions(db):
+    with db._cursor() as cursor:
+        cursor.execute("SHOW GLOBAL STATUS LIKE 'Questions'")
+        return int(cursor.fetchone()['Value'])
+
+
+def run(db, name, func, ticks, args):
+    sky = SkySimulator(args.seed, args.satellites, args.snr_change)
+    start_questions = questions(db)
+    start = time.time()
+    for _ in range(ticks):
+        (tracked, view) = sky.tick()
+        func(tracked, view)
+    elapsed = time.time() - start
+    # Don't count the SHOW STATUS statements
+    statements = questions(db) - start_questions - 1
+    print '{:<8} {:>8.2f} statements/tick {:>8.2f} ms/tick'.format(name, float(statements) / ticks, elapsed * 1000.0 / ticks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the GPS_Satellite_View update (replaces the contents of GPS_Satellite_View)')
+    parser.add_argument('--vms-address', default='127.0.0.1', help='address (IP or URL) of QS/VMS database')
+    parser.add_argument('--vms-port', type=int, default=3306, help='UDP port used by the QS/VMS database')
+    parser.add_argument('--vms-cert', help='location of SSL certificate to use to connect to QS/VMS database')
+    parser.add_argument('--vms-dbname', default='stepSATdb_Flight', help='name of the QS/VMS database')
+    parser.add_argument('--vms-username', default='root', help='username for the QS/VMS database')
+    parser.add_argument('--vms-password', default='Quicksat!1', help='password for the QS/VMS database')
+    parser.add_argument('--ticks', type=int, default=200, help='number of GPS ticks to simulate')
+    parser.add_argument('--satellites', type=int, default=12, help='number of satellites in view')
+    parser.add_argument('--snr-change', type=float, default=0.3, help='probability that the SNR of a satellite changes each tick')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+
+    db = vms_db.vms_db(address=args.vms_address, port=args.vms_port, cert=args.vms_cert, username=args.vms_username, password=args.vms_password, dbname=args.vms_dbname)
+
+    run(db, 'before', lambda tracked, view: legacy_gps_satellite_data(db, tracked, view), args.ticks, args)
+    db.satellite_view = None
+    run(db, 'after', lambda tracked, view: db.gps_satellite_data(len(view) / 4, len(tracked), tracked, view), args.ticks, args)
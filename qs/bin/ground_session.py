@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""
+A module that manages the connection to the QS/VMS ground database.
+
+Previously the ground server arguments were read from QS_Servers on every
+sync, and the vms_db_ground object was deleted whenever the link check failed,
+so every hiccup of the satellite link cost a full TLS MySQL handshake when the
+link came back.  The GroundSession keeps one vms_db_ground object for as long
+as the server arguments stay the same:
+
+    - The server arguments are cached and only re-read from the flight
+      database every ARGS_REFRESH_INTERVAL seconds, the ground connection is
+      only re-created if they have changed.
+    - A connection that has been idle for PING_INTERVAL seconds is pinged
+      before it is used, and keepalive() pings it so that the ground server
+      and any NAT on the way don't drop it while the link is idle.
+    - When the link is lost the connection is kept, and only pinged again
+      when the link comes back.
+    - Failed connection attempts are retried with an exponential backoff with
+      jitter, so a ground server that can't be reached isn't hammered by
+      every sync job (and by every spacecraft at the same time).
+
+The session also carries the command channel from the ground: the ground's
+Command_Log event_keys are used as a command sequence, and each poll asks for
+the commands after the newest one received, which is a single primary key
+range query.  The first poll after a (re)connection falls back to the old
+timestamp query to find where to start.
+"""
+
+import random
+import sys
+import syslog
+import threading
+import time
+import traceback
+
+import vms_db_ground
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,too-many-instance-attributes,too-many-arguments
+
+# How often (in seconds) the ground server arguments are re-read from the
+# flight database
+ARGS_REFRESH_INTERVAL = 60.0
+
+# A connection that has not been used for this many seconds is pinged before
+# it is used, and by keepalive()
+PING_INTERVAL = 60.0
+
+# The delay (in seconds) before the first retry of a failed connection, it is
+# doubled after each failure up to MAX_BACKOFF.  Each delay is randomly
+# shortened by up to BACKOFF_JITTER of its length.
+MIN_BACKOFF = 5.0
+MAX_BACKOFF = 600.0
+BACKOFF_JITTER = 0.5
+
+
+class GroundSession(object):
+    """
+    Owns the connection to the ground database.  db is the flight database
+    (a vms_db object) that the ground server arguments are read from, port,
+    cert and dbname are the settings of the ground database that aren't stored
+    in QS_Servers.
+    """
+    def __init__(self, db, port, cert, dbname, ping_interval=PING_INTERVAL, args_refresh_interval=ARGS_REFRESH_INTERVAL, min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF):
+        self.db = db
+        self.port = port
+        self.cert = cert
+        self.dbname = dbname
+        self.ping_interval = ping_interval
+        self.args_refresh_interval = args_refresh_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.RLock()
+        self.db_ground = None
+        # The arguments the current vms_db_ground object was created with
+        self.db_ground_args = None
+        self.args = None
+        self.args_read = 0.0
+        # The last time the connection was known to work
+        self.last_used = 0.0
+        # The time the current connection came up, None if it is down
+        self.up_since = None
+        self.total_uptime = 0.0
+        # Consecutive failures and when the next attempt may be made
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.connects = 0
+        self.reconnects = 0
+        self.failed_attempts = 0
+        self.pings = 0
+        self.args_changes = 0
+
+        # The sequence number (ground Command_Log event_key) of the newest
+        # command received, None until the first poll
+        self.command_lock = threading.Lock()
+        self.command_seq = None
+        self.commands_received = 0
+
+    def server_args(self, refresh=False):
+        """
+        Returns the arguments used to create the vms_db_ground object, re-read
+        from QS_Servers if they are older than the refresh interval.
+        """
+        with self.lock:
+            now = time.time()
+            if refresh or self.args is None or (now - self.args_read) >= self.args_refresh_interval:
+                gs_args = self.db.get_db_ground_args()
+                self.args = {
+                    'address': gs_args['server'],
+                    'port': self.port,
+                    'username': gs_args['username'],
+                    'password': gs_args['password'],
+                    'cert': self.cert,
+                    'dbname': self.dbname,
+                }
+                self.args_read = now
+            return self.args
+
+    def _mark_up(self, now):
+        self.last_used = now
+        self.failures = 0
+        self.next_attempt = 0.0
+        if self.up_since is None:
+            self.up_since = now
+
+    def _mark_down(self, now):
+        if self.up_since is not None:
+            self.total_uptime += now - self.up_since
+            self.up_since = None
+
+    def _failed(self, now):
+        self._mark_down(now)
+        self.failures += 1
+        self.failed_attempts += 1
+        backoff = min(self.min_backoff * (2 ** (self.failures - 1)), self.max_backoff)
+        backoff *= 1.0 - random.uniform(0.0, BACKOFF_JITTER)
+        self.next_attempt = now + backoff
+        syslog.syslog(syslog.LOG_ERR, 'Ground connection failed {} times, retrying in {:.0f}s'.format(self.failures, backoff))
+
+    def _close(self):
+        self.db_ground_args = None
+        # The sequence numbers of another ground server mean nothing
+        self.command_seq = None
+        if self.db_ground:
+            # pylint: disable=bare-except
+            try:
+                self.db_ground.close()
+            except:
+                pass
+        self.db_ground = None
+
+    def connect(self):
+        """
+        Returns the vms_db_ground object if the ground database can be
+        reached, or None if it can't (or a retry is not due yet).
+        """
+        with self.lock:
+            now = time.time()
+            if now < self.next_attempt:
+                return None
+
+            # pylint: disable=bare-except
+            try:
+                args = self.server_args()
+                if self.db_ground and args != self.db_ground_args:
+                    syslog.syslog(syslog.LOG_NOTICE, 'Ground server changed to {}'.format(args['address']))
+                    self.args_changes += 1
+                    self._mark_down(now)
+                    self._close()
+
+                if not self.db_ground:
+                    self.db_ground = vms_db_ground.vms_db_ground(**args)
+                    self.db_ground_args = args
+                    self.connects += 1
+                elif self.up_since is None or (now - self.last_used) >= self.ping_interval:
+                    self.db_ground.ping()
+                    self.pings += 1
+                    if self.up_since is None:
+                        self.reconnects += 1
+            except KeyboardInterrupt as e:
+                raise e
+            except:
+                syslog.syslog(syslog.LOG_ERR, 'Error opening ground connection: {}'.format(traceback.format_exception(*sys.exc_info())))
+                self._failed(now)
+                return None
+
+            self._mark_up(now)
+            return self.db_ground
+
+    def receive_commands(self, ingest):
+        """
+        Reads the commands that the ground has queued since the last poll and
+        passes them to ingest.  The sequence number is only advanced if ingest
+        returns True, so commands that could not be saved are read again.
+        Returns the commands, ground errors are passed on to the caller.
+        """
+        with self.command_lock:
+            db_ground = self.db_ground
+            if not db_ground:
+                return []
+            if self.command_seq is None:
+                # Read the newest sequence number before the commands so that
+                # a command created in between is not received twice.
+                seq = db_ground.command_sequence()
+                commands = db_ground.read_command_log(self.db.get_last_command_date('Pending-Ground'))
+                if commands is False:
+                    return []
+                commands = list(commands or [])
+            else:
+                seq = self.command_seq
+                commands = db_ground.read_commands_after(seq)
+
+            if commands and not ingest(commands):
+                return []
+            with self.lock:
+                if db_ground is self.db_ground:
+                    self.command_seq = max([seq] + [int(c['event_key']) for c in commands])
+                self.commands_received += len(commands)
+            return commands
+
+    def link_down(self):
+        """
+        Called when the link to the ground is known to be down.  The
+        connection is kept so it can be re-used when the link comes back.
+        """
+        with self.lock:
+            self._mark_down(time.time())
+
+    def keepalive(self):
+        """
+        Pings the ground connection if it is up and has been idle for the ping
+        interval, returns the number of seconds until the next keepalive so it
+        can be used as a PeriodicTimer action.
+        """
+        with self.lock:
+            if not self.db_ground or self.up_since is None:
+                # The link is down, the connection is checked when it is
+                # needed again
+                return self.ping_interval
+            idle = time.time() - self.last_used
+            if idle < self.ping_interval:
+                return self.ping_interval - idle
+        # connect() pings the connection, or starts the backoff if it fails
+        self.connect()
+        return self.ping_interval
+
+    def close(self):
+        with self.lock:
+            self._mark_down(time.time())
+            self._close()
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            uptime = 0.0
+            if self.up_since is not None:
+                uptime = now - self.up_since
+            return {
+                'connected': self.up_since is not None,
+                'uptime': uptime,
+                'total_uptime': self.total_uptime + uptime,
+                'connects': self.connects,
+                'reconnects': self.reconnects,
+                'failed_attempts': self.failed_attempts,
+                'failures': self.failures,
+                'retry_in': max(self.next_attempt - now, 0.0),
+                'pings': self.pings,
+                'args_changes': self.args_changes,
+                'command_seq': self.command_seq,
+                'commands_received': self.commands_received,
+            }
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""
+A TCP proxy that emulates the link between the spacecraft and the ground.
+
+The sync code can only be measured end-to-end over a link that behaves like
+the Globalstar LinkStar duplex link: a few kbit/s, several hundred ms of
+latency, and periods where the link drops entirely.  The LinkEmulator sits
+between a client and a server (for example the flight side sync code and a
+local ground MySQL instance) and shapes the traffic in both directions:
+
+    - bandwidth: each direction is a single link of a fixed number of bytes
+      per second that is shared by all of the connections, so data is
+      delivered no faster than it could be sent over the radio.
+    - latency: every chunk of data is delayed by a fixed one-way latency.
+    - blackouts: windows (relative to when the schedule is started) during
+      which the link is down.  In "drop" mode all connections are closed and
+      new connections are refused, like a dropped call.  In "stall" mode the
+      connections are kept and the data is held until the link comes back,
+      like a fade.
+
+It can be used from other scripts (see sync_benchmark.py) or run on its own:
+
+    $ python link_emulator.py --target 127.0.0.1:3307 --listen-port 13306 --bandwidth 1200 --latency 0.35 --blackout 60:30
+"""
+
+import argparse
+import Queue
+import socket
+import sys
+import threading
+import time
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,too-many-instance-attributes,too-many-arguments
+
+BLACKOUT_MODES = ('drop', 'stall')
+
+# The most data read from a socket at once
+CHUNK_SIZE = 4096
+
+
+class Link(object):
+    """
+    One direction of the emulated link.  Chunks are sent one after the other
+    at the link bandwidth, and arrive latency seconds after they have been
+    sent.
+    """
+    def __init__(self, bandwidth=None, latency=0.0):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.free_at = 0.0
+        self.bytes = 0
+        self.chunks = 0
+
+    def schedule(self, num_bytes):
+        """
+        Returns the time a chunk that is ready to be sent now arrives.
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.free_at)
+            if self.bandwidth:
+                self.free_at = start + float(num_bytes) / self.bandwidth
+            else:
+                self.free_at = start
+            self.bytes += num_bytes
+            self.chunks += 1
+            return self.free_at + self.latency
+
+
+class Pipe(object):
+    """
+    Forwards the data from one socket to another over a link.  One thread reads
+    the data and schedules it on the link, another delivers it when it
+    arrives.
+    """
+    def __init__(self, emulator, src, dst, link):
+        self.emulator = emulator
+        self.src = src
+        self.dst = dst
+        self.link = link
+        self.queue = Queue.Queue()
+        self.reader = threading.Thread(target=self._read)
+        self.writer = threading.Thread(target=self._write)
+        self.reader.daemon = True
+        self.writer.daemon = True
+
+    def start(self):
+        self.reader.start()
+        self.writer.start()
+
+    def _read(self):
+        try:
+            while True:
+                data = self.src.recv(CHUNK_SIZE)
+                if not data:
+                    break
+                self.queue.put((self.link.schedule(len(data)), data))
+        except socket.error:
+            pass
+        self.queue.put((None, None))
+
+    def _write(self):
+        try:
+            while True:
+                (arrival, data) = self.queue.get()
+                if data is None:
+                    break
+                delay = arrival - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                # In stall mode the data is held until the link comes back
+                self.emulator.wait_for_link()
+                self.dst.sendall(data)
+        except socket.error:
+            pass
+        self.emulator.close_connection(self.src, self.dst)
+
+
+class LinkEmulator(object):
+    """
+    Proxies connections made to listen_host:listen_port to
+    target_host:target_port over an emulated link.  bandwidth is in bytes/sec
+    (None for unlimited), latency is the one-way latency in seconds and
+    blackouts is a list of (start, duration) windows in seconds.
+    """
+    def __init__(self, target_host, target_port, listen_host='127.0.0.1', listen_port=0, bandwidth=None, latency=0.0, blackouts=(), mode='drop'):
+        if mode not in BLACKOUT_MODES:
+            raise ValueError('invalid blackout mode "{}", must be one of {}'.format(mode, BLACKOUT_MODES))
+        self.target = (target_host, target_port)
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.blackouts = sorted(blackouts)
+        self.mode = mode
+        self.up_link = Link(bandwidth, latency)
+        self.down_link = Link(bandwidth, latency)
+
+        self.lock = threading.Lock()
+        self.connections = []
+        self.link_up = threading.Event()
+        self.link_up.set()
+        self.stop_event = threading.Event()
+        self.schedule_stop = None
+        self.server = None
+        self.threads = []
+        # Functions called with True or False when the link comes up or goes
+        # down
+        self.listeners = []
+
+        self.accepted = 0
+        self.refused = 0
+        self.dropped = 0
+
+    @property
+    def port(self):
+        return self.server.getsockname()[1]
+
+    def start(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.listen_host, self.listen_port))
+        self.server.listen(16)
+        self.server.settimeout(0.5)
+        t = threading.Thread(target=self._accept)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+        return self.port
+
+    def start_schedule(self):
+        """
+        Starts the blackout schedule, the windows are relative to now.
+        """
+        self.stop_schedule()
+        self.schedule_stop = threading.Event()
+        t = threading.Thread(target=self._schedule, args=(time.time(), self.schedule_stop))
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+
+    def stop_schedule(self):
+        """
+        Stops the blackout schedule and brings the link back up.
+        """
+        if self.schedule_stop:
+            self.schedule_stop.set()
+            self.schedule_stop = None
+        self.set_link(True)
+
+    def stop(self):
+        self.stop_event.set()
+        self.stop_schedule()
+        if self.server:
+            self.server.close()
+        with self.lock:
+            connections = list(self.connections)
+        for (client, server) in connections:
+            self.close_connection(client, server)
+
+    def _schedule(self, start, stop_event):
+        for (offset, duration) in self.blackouts:
+            if stop_event.wait(max(start + offset - time.time(), 0)) or stop_event.is_set():
+                return
+            self.set_link(False)
+            if stop_event.wait(max(start + offset + duration - time.time(), 0)) or stop_event.is_set():
+                return
+            self.set_link(True)
+
+    def set_link(self, up):
+        """
+        Brings the link up or down.
+        """
+        if up == self.link_up.is_set():
+            return
+        if up:
+            self.link_up.set()
+        else:
+            self.link_up.clear()
+            if self.mode == 'drop':
+                with self.lock:
+                    connections = list(self.connections)
+                for (client, server) in connections:
+                    self.dropped += 1
+                    self.close_connection(client, server)
+        for listener in self.listeners:
+            listener(up)
+
+    def wait_for_link(self):
+        if self.mode == 'drop' and not self.link_up.is_set():
+            raise socket.error('link down')
+        while not self.link_up.wait(0.5):
+            if self.stop_event.is_set():
+                raise socket.error('link emulator stopped')
+
+    def _accept(self):
+        while not self.stop_event.is_set():
+            try:
+                (client, _) = self.server.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                return
+            if not self.link_up.is_set() and self.mode == 'drop':
+                self.refused += 1
+                client.close()
+                continue
+            try:
+                server = socket.create_connection(self.target)
+            except socket.error as err:
+                sys.stderr.write('Error connecting to {}:{}: {}\n'.format(self.target[0], self.target[1], err))
+                client.close()
+                continue
+            for s in (client, server):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connections.append((client, server))
+                self.accepted += 1
+            Pipe(self, client, server, self.up_link).start()
+            Pipe(self, server, client, self.down_link).start()
+
+    def close_connection(self, client, server):
+        with self.lock:
+            if (client, server) in self.connections:
+                self.connections.remove((client, server))
+            elif (server, client) in self.connections:
+                self.connections.remove((server, client))
+        for s in (client, server):
+            # pylint: disable=bare-except
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+            try:
+                s.close()
+            except:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                'link_up': self.link_up.is_set(),
+                'connections': len(self.connections),
+                'accepted': self.accepted,
+                'refused': self.refused,
+                'dropped': self.dropped,
+                'bytes_up': self.up_link.bytes,
+                'bytes_down': self.down_link.bytes,
+            }
+
+
+def parse_blackout(value):
+    """
+    Parses a "start:duration" blackout window (in seconds).
+    """
+    try:
+        (start, duration) = value.split(':')
+        return (float(start), float(duration))
+    except ValueError:
+        raise argparse.ArgumentTypeError('blackout windows must be "start:duration", not "{}"'.format(value))
+
+
+def add_link_arguments(parser):
+    parser.add_argument('--bandwidth', type=float, default=1200.0, help='link bandwidth in bytes/sec in each direction, 0 for unlimited (default is about the LinkStar duplex rate)')
+    parser.add_argument('--latency', type=float, default=0.35, help='one-way link latency in seconds')
+    parser.add_argument('--blackout', type=parse_blackout, action='append', default=[], help='a "start:duration" window (in seconds) in which the link is down, may be repeated')
+    parser.add_argument('--blackout-mode', choices=BLACKOUT_MODES, default='drop', help='drop the connections during a blackout, or stall them until the link comes back')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Emulate the spacecraft to ground link between a client and a TCP server')
+    parser.add_argument('--target', required=True, help='host:port of the server')
+    parser.add_argument('--listen-address', default='127.0.0.1', help='address to accept connections on')
+    parser.add_argument('--listen-port', type=int, default=13306, help='port to accept connections on')
+    add_link_arguments(parser)
+    args = parser.parse_args()
+
+    (host, port) = args.target.rsplit(':', 1)
+    emulator = LinkEmulator(host, int(port), args.listen_address, args.listen_port, args.bandwidth or None, args.latency, args.blackout, args.blackout_mode)
+    emulator.listeners.append(lambda up: sys.stdout.write('{} link {}\n'.format(time.strftime('%H:%M:%S'), 'up' if up else 'down')))
+    emulator.start()
+    emulator.start_schedule()
+    print 'Forwarding {}:{} to {}'.format(args.listen_address, emulator.port, args.target)
+    try:
+        while True:
+            time.sleep(10)
+            print emulator.stats()
+    except KeyboardInterrupt:
+        emulator.stop()
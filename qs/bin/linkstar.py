@@ -5,7 +5,6 @@ import itertools
 import sys
 import radio_status
 import subprocess
-import threading
 import string
 import time
 import os
@@ -23,6 +22,8 @@ import grp
 #   https://pypi.python.org/pypi/setuptools
 import mysql.connector
 
+import db_pool
+
 # utility function to test connection to server
 def ping(address, method):
     if method == 'Ethernet':
@@ -33,10 +34,9 @@ def ping(address, method):
     return (0 == subprocess.call(args, stdout=f))
 
 class linkstar(object):
-    def __init__(self, address, port, cert, username, password, dbname, **kwargs):
-        self.lock = threading.RLock()
-        self.db = None
-        self.cursor = None
+    def __init__(self, address, port, cert, username, password, dbname, pool_size=None, **kwargs):
+        self.pool = None
+        self.pool_size = pool_size
         self.config = {
             'user': username,
             'password': password,
@@ -51,6 +51,10 @@ class linkstar(object):
         self.open()
         self.radio = radio_status.gsp1720()
         self.ppp = None
+        # Optional function that is called after the connection state in
+        # Recording_Session_State has been updated, so that any cached copy
+        # of that row can be refreshed.
+        self.state_changed = None
         
 
     def __del__(self):
@@ -61,15 +65,14 @@ class linkstar(object):
         simple function to allow executing unusual statements
         """
     
-        with self.lock:
+        with self.pool.cursor() as cursor:
             if isinstance(args, list):
-                self.cursor.executemany(stmt, args)
+                cursor.executemany(stmt, args)
             else:
-                self.cursor.execute(stmt, args)
-            if self.cursor.with_rows:
-                return self.cursor.fetchall()
+                cursor.execute(stmt, args)
+            if cursor.with_rows:
+                return cursor.fetchall()
             else:
-                self.db.commit()
                 return None
 
     def _log_msg(self, msg):
@@ -88,29 +91,21 @@ class linkstar(object):
         # Handle exceptions for this cleanly, errors should get logged to the
         # syslog
         
-        with self.lock:
-            try:
-                self.cursor.execute(stmt, (msg,))
-                self.db.commit()
-            except:
-                syslog.syslog(syslog.LOG_ERR, 'Error logging message "{}": {}'.format(msg, sys.exc_info()[1]))
+        try:
+            with self.pool.cursor() as cursor:
+                cursor.execute(stmt, (msg,))
+        except:
+            syslog.syslog(syslog.LOG_ERR, 'Error logging message "{}": {}'.format(msg, sys.exc_info()[1]))
 
     def open(self):
-        with self.lock:
-            if not self.db:
-                self.db = mysql.connector.connect(**self.config)
-              
-            if self.db and not self.cursor:
-                self.cursor = self.db.cursor(dictionary=True)
+        if not self.pool:
+            self.pool = db_pool.get_pool(self.config, self.pool_size)
+        with self.pool.connection():
+            pass
 
     def close(self):
-        with self.lock:
-            
-            if self.cursor:
-                self.cursor.close()
-
-            if self.db:
-                self.db.close()
+        if self.pool:
+            self.pool.close()
 
 #    Radio monitoring functions
 #
@@ -123,9 +118,9 @@ class linkstar(object):
                         FROM `stepSATdb_Flight`.`Recording_Sessions`
                 ) LIMIT 1
         '''
-        with self.lock:
-            self.cursor.execute(stmt)
-            results = self.cursor.fetchone()
+        with self.pool.cursor() as cursor:
+            cursor.execute(stmt)
+            results = cursor.fetchone()
         sync_to_ground = results['sync_to_ground']
     
         status = {
@@ -158,20 +153,20 @@ class linkstar(object):
                 ORDER BY `Recording_Sessions`.`recording_session_id` DESC LIMIT 1
         '''
     
-        with self.lock:
-            self.cursor.execute(stmt)
-            row_recording_session = self.cursor.fetchone()        
+        with self.pool.cursor() as cursor:
+            cursor.execute(stmt)
+            row_recording_session = cursor.fetchone()        
             status.update(row_recording_session)         
     
             stmt = '''
                 SELECT `esn` 
                     FROM `stepSATdb_Flight`.`LinkStar_Duplex_Information` LIMIT 1
              '''
-            self.cursor.execute(stmt)
-            row_esn = self.cursor.fetchone()
+            cursor.execute(stmt)
+            row_esn = cursor.fetchone()
             status.update(row_esn)  
         
-            self.cursor.execute('''
+            cursor.execute('''
                INSERT INTO `stepSATdb_Flight`.`LinkStar_Duplex_State` (`esn`, `call_type`, 
                     `call_duration`, `call_number`, `provider`, `service_available`, 
                     `service_mode`, `call_state`, `registration`, `rssi`, 
@@ -182,7 +177,6 @@ class linkstar(object):
                     %(ROAMING)s, %(GATEWAY)s, %(recording_session_id)s, %(TIME)s, 
                     %(N)s, %(W)s, %(ERR)s, NOW() )
                             ''', status)   
-            self.db.commit()            
             if sync_to_ground == 1:      
                 self.connect_to_ground(status)
             else:
@@ -196,8 +190,12 @@ class linkstar(object):
                                 FROM `stepSATdb_Flight`.`Recording_Sessions`
                         )
                 '''
-                self.cursor.execute(stmt)
-                self.db.commit()
+                cursor.execute(stmt)
+            self._state_changed()
+
+    def _state_changed(self):
+        if self.state_changed:
+            self.state_changed()
 
     def connect_to_ground(self, status):
         print "connect_to_ground entered --> Looking from LinkStar.py"
@@ -216,9 +214,9 @@ class linkstar(object):
             LIMIT 1
         '''
 
-        with self.lock:
-            self.cursor.execute(stmt)
-            results = self.cursor.fetchone()
+        with self.pool.cursor() as cursor:
+            cursor.execute(stmt)
+            results = cursor.fetchone()
             connected = results['test_connection']
             method = results['connection_type']
             selected_server = results['selected_server']
@@ -246,8 +244,8 @@ class linkstar(object):
                        FROM `stepSATdb_Flight`.`QS_Servers`
                    LIMIT 1
                '''
-            self.cursor.execute(stmt)
-            results = self.cursor.fetchone()
+            cursor.execute(stmt)
+            results = cursor.fetchone()
 
             if selected_server == 'PRIMARY':
                server_address = results['primary_server']
@@ -310,9 +308,9 @@ class linkstar(object):
                             FROM `stepSATdb_Flight`.`Recording_Sessions`
                     )
             '''
-            with self.lock:
-                self.cursor.execute(stmt, (server_state,))
-                self.db.commit()
+            with self.pool.cursor() as cursor:
+                cursor.execute(stmt, (server_state,))
+            self._state_changed()
          
     def call(self, number):
         print "in linkstar.call()"
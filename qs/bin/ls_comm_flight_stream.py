@@ -5,7 +5,6 @@ import syslog
 import itertools
 import sys
 import subprocess
-import threading
 import vms_db
 import os
 import os.path
@@ -22,12 +21,12 @@ import grp
 #   https://pypi.python.org/pypi/setuptools
 import mysql.connector
 
+import db_pool
 
 class ls_comm_flight_stream(object):
-    def __init__(self, address, port, cert, username, password, dbname, **kwargs):
-        self.lock = threading.RLock()
-        self.db = None
-        self.cursor = None
+    def __init__(self, address, port, cert, username, password, dbname, pool_size=None, **kwargs):
+        self.pool = None
+        self.pool_size = pool_size
         self.config = {
             'user': username,
             'password': password,
@@ -38,8 +37,7 @@ class ls_comm_flight_stream(object):
         }
         if not self.config['ssl_ca']:
             del self.config['ssl_ca']    
-        with self.lock:     
-            self.open()
+        self.open()
 
     def __del__(self):
         self.close()
@@ -49,15 +47,14 @@ class ls_comm_flight_stream(object):
         simple function to allow executing unusual statements
         """
     
-        with self.lock:
+        with self.pool.cursor() as cursor:
             if isinstance(args, list):
-                self.cursor.executemany(stmt, args)
+                cursor.executemany(stmt, args)
             else:
-                self.cursor.execute(stmt, args)
-            if self.cursor.with_rows:
-                return self.cursor.fetchall()
+                cursor.execute(stmt, args)
+            if cursor.with_rows:
+                return cursor.fetchall()
             else:
-                self.db.commit()
                 return None
 
     def _log_msg(self, msg):
@@ -76,37 +73,24 @@ class ls_comm_flight_stream(object):
         # Handle exceptions for this cleanly, errors should get logged to the
         # syslog
         
-        with self.lock:
-            try:
-                self.cursor.execute(stmt, (msg,))
-                self.db.commit()
-            except:
-                syslog.syslog(syslog.LOG_ERR, 'Error logging message "{}": {}'.format(msg, sys.exc_info()[1]))
+        try:
+            with self.pool.cursor() as cursor:
+                cursor.execute(stmt, (msg,))
+        except:
+            syslog.syslog(syslog.LOG_ERR, 'Error logging message "{}": {}'.format(msg, sys.exc_info()[1]))
         
 
     def open(self):
-        with self.lock:
-            try:
-                if not self.db:
-                    self.db = mysql.connector.connect(**self.config)
-              
-                if self.db and not self.cursor:
-                    self.cursor = self.db.cursor(dictionary=True)
-            except: 
-                raise
-                #pass
+        # The connections are not in autocommit mode, the pool commits the
+        # work done with each cursor when it is returned.
+        if not self.pool:
+            self.pool = db_pool.get_pool(self.config, self.pool_size)
+        with self.pool.connection():
+            pass
 
     def close(self):
-        with self.lock:
-            
-            if self.cursor:
-                self.cursor.close()
-                #print 'cursor.close'
-
-            if self.db:
-                self.db.close()
-                #print 'db.close'
-            
+        if self.pool:
+            self.pool.close()
       
     def sync_selected_db_table(self, selected_table_name):
         selected_table_name_quotes = '`{}`'.format(selected_table_name)
@@ -122,10 +106,9 @@ class ls_comm_flight_stream(object):
                         SELECT MAX(`Recording_Sessions`.`recording_session_id`)
                             FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
         '''
-        with self.lock:
-            self.cursor.execute(stmt)
-            self.cursor.execute(stmt_update_last_sync_time)
-            self.db.commit()
+        with self.pool.cursor() as cursor:
+            cursor.execute(stmt)
+            cursor.execute(stmt_update_last_sync_time)
 
     def sync_recording_sessions(self):
         stmt = '''
@@ -133,9 +116,8 @@ class ls_comm_flight_stream(object):
                 INTO TABLE `stepSATdb_Flight`.`Recording_Sessions` FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
                 ESCAPED BY '\\\\' LINES TERMINATED BY '\n'
         '''
-        with self.lock:
-            self.cursor.execute(stmt)
-            self.db.commit()
+        with self.pool.cursor() as cursor:
+            cursor.execute(stmt)
         
     
     def read_command_log(self):
@@ -150,9 +132,9 @@ class ls_comm_flight_stream(object):
                             FROM `stepSATdb_Flight`.`Recording_Sessions`
                     )
         '''
-        with self.lock:
-            self.cursor.execute(stmt)
-            commands = self.cursor.fetchall()
+        with self.pool.cursor() as cursor:
+            cursor.execute(stmt)
+            commands = cursor.fetchall()
         return commands
         
 
@@ -166,9 +148,8 @@ class ls_comm_flight_stream(object):
                             WHERE `Command_Log`.`Recording_Sessions_recording_session_id` = %(Recording_Sessions_recording_session_id)s
                             AND `Command_log`.`time_of_command` = %(time_of_command)s
                 '''
-                with self.lock:
-                    self.cursor.execute(stmt,row)
-                    self.db.commit()
+                with self.pool.cursor() as cursor:
+                    cursor.execute(stmt,row)
 
     def add_ground_command_log(self, ground_commands):
     # adds new row(s) to ground db
@@ -180,6 +161,5 @@ class ls_comm_flight_stream(object):
                         ON DUPLICATE KEY UPDATE `Command_Log`.`pushed_to_ground` = 1 , `Command_Log`.`command_state` = %(command_state)s
                 '''
                 #print stmt
-                with self.lock:
-                    self.cursor.execute(stmt,row)
-                    self.db.commit()
+                with self.pool.cursor() as cursor:
+                    cursor.execute(stmt,row)
@@ -1,66 +1,97 @@
 #!/usr/bin/env python
 
-import threading
-import time
+import scheduler
 
-class PeriodicTimer(threading.Thread):
+class PeriodicTimer(object):
     """
-    Periodic timer class that spawns a thread that will execute an action
-    periodically.
+    Periodic timer class that executes an action periodically.
+
+    The timers used to each run in their own thread, they are now jobs of a
+    scheduler.Scheduler (the process wide default scheduler if one isn't
+    specified) that share a small pool of worker threads.  This class keeps
+    the original interface.
     """
-    def __init__(self, action, delay, args=()):
+    def __init__(self, action, delay, args=(), scheduler=None, pausable=False, name=None, fixed_rate=False, overrun=scheduler.OVERRUN_SKIP):
         """
         Initialization function for the periodic timer class.  When the start()
-        function is called it will start the thread that will cause the
-        specified action to be called after the delay seconds have elapsed until
-        the stop() function is called.
+        function is called it will schedule the specified action to be called
+        right away and then each time the delay seconds have elapsed after the
+        previous call returned, until the stop() function is called.
 
         The action function can optionally return a new delay value if the
-        periodic timer needs to be able to adjust itself.
+        periodic timer needs to be able to adjust itself, or a negative value
+        to stop the timer.  Pausable timers don't run while the scheduler's
+        run event is cleared.
+
+        If fixed_rate is set the action is instead called every delay seconds
+        regardless of how long it takes, the overrun parameter specifies what
+        happens to the calls that were missed when a call took longer than
+        the delay (see the scheduler module).
         """
+        # pylint: disable=redefined-outer-name
         self.action = action
-        self.delay = delay
-        super(PeriodicTimer, self).__init__(target=self._thread, args=args)
-        self.stop_event = threading.Event()
+        self._delay = delay
+        self.args = args
+        self.scheduler = scheduler
+        self.pausable = pausable
+        self.name = name
+        self.fixed_rate = fixed_rate
+        self.overrun = overrun
+        self.job = None
+
+    @property
+    def delay(self):
+        if self.job:
+            return self.job.delay
+        return self._delay
 
-    def _thread(self, *args):
+    @delay.setter
+    def delay(self, value):
+        self._delay = value
+        if self.job:
+            self.job.delay = value
+
+    def start(self):
         """
-        The main execution thread.
-        This thread will loop forever (until stop() is called) and perform the
-        specified periodic action after the specified delay has elapsed.  When
-        stop is called this thread will exit immediately.
+        This function adds the action to the scheduler, it is called for the
+        first time right away.
         """
-        while True:
-            if self.stop_event.isSet():
-                return
-            # Optionally the action function can return a new value for the
-            # delay timer
-            ret = self.action(*args)
-            if ret:
-                if ret > 0:
-                    self.delay = float(ret)
-                else:
-                    # If a negative timeout is returned, exit.
-                    return
-            self.stop_event.wait(self.delay)
+        if not self.scheduler:
+            self.scheduler = scheduler.default_scheduler()
+        self.job = self.scheduler.add(self.action, self._delay, self.args, self.name, self.pausable, fixed_rate=self.fixed_rate, overrun=self.overrun)
+
+    def trigger(self):
+        """
+        This function causes the action to be performed now rather than when
+        the current delay has elapsed.  If the action is running it is
+        performed again as soon as it returns.
+        """
+        if self.job:
+            self.job.trigger()
 
     def stop(self, wait=True, timeout=None):
         """
-        This function will set the event that causes the periodic thread to
-        stop executing and exit.  If the "wait" parameter is set, this function
-        will wait until the periodic thread exits before returning.  Optionally
-        a timeout can be provided to specify how long this function should wait
-        before raising an exception if the thread has not yet exited.
+        This function will remove the action from the scheduler.  If the
+        "wait" parameter is set and the action is running, this function will
+        wait until it returns.  Optionally a timeout can be provided to specify
+        how long this function should wait before raising an exception if the
+        action has not yet returned.
+        """
+        if self.job:
+            stopped = self.job.cancel(wait, timeout)
+            if wait:
+                assert stopped
+
+    def join(self, timeout=None):
         """
-        self.stop_event.set()
-        if wait:
-            # A timeout parameter of 'None' would cause join() to immediately
-            # exit regardless of if the thread has been stopped or not, so only
-            # provide a timeout parameter to the join() function if it is not
-            # 'None'.
-            if timeout:
-                self.join(timeout)
-            else:
-                self.join()
-            assert self.isAlive() == False
+        This function waits (up to timeout seconds) for the action of a timer
+        that has been stopped to return.  Returns True if it is not running.
+        """
+        if self.job:
+            return self.job.idle.wait(timeout)
+        return True
+
+    def is_alive(self):
+        return bool(self.job and self.job.is_alive())
 
+    isAlive = is_alive
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+A module that records how much time is spent in each database query.
+
+The connection pool wraps every cursor it hands out in an InstrumentedCursor,
+which times each execute() call and records it under the name of the function
+that issued the statement (for example "vms_db.all_pending_commands").  For
+each query name the number of calls, errors, rows, total/maximum time, a
+latency histogram and the time spent waiting for a pooled connection (which
+replaced the per-object database lock) are kept.
+
+Recording a statement is a dictionary lookup and a few additions under a lock,
+so the instrumentation is cheap enough to leave enabled.
+"""
+
+import bisect
+import json
+import os
+import os.path
+import sys
+import threading
+import time
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,protected-access
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last bucket
+# holds everything slower than the last bound.
+HISTOGRAM_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Helper functions that only pass a statement through to a cursor, the query
+# is recorded under the name of the function that called the helper.
+PASSTHROUGH_FUNCTIONS = ('_execute',)
+
+
+class QueryRecord(object):
+    """
+    The statistics of one query name.
+    """
+    __slots__ = ('calls', 'errors', 'rows', 'total_time', 'max_time', 'wait_time', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.wait_time = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'rows': self.rows,
+            'total_time': self.total_time,
+            'avg_time': self.total_time / self.calls if self.calls else 0.0,
+            'max_time': self.max_time,
+            'wait_time': self.wait_time,
+            'histogram': list(self.histogram),
+        }
+
+
+class QueryStats(object):
+    """
+    Collects the statistics of all queries made by this process.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.records = {}
+        self.started = time.time()
+        # Query names indexed by the code object of the calling function, so
+        # the name is only built once per function.
+        self.names = {}
+
+    def query_name(self, frame):
+        while frame.f_code.co_name in PASSTHROUGH_FUNCTIONS and frame.f_back:
+            frame = frame.f_back
+        code = frame.f_code
+        name = self.names.get(code)
+        if name is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            name = '{}.{}'.format(module, code.co_name)
+            self.names[code] = name
+        return name
+
+    def record(self, name, elapsed, rows=0, wait=0.0, error=False):
+        with self.lock:
+            rec = self.records.get(name)
+            if rec is None:
+                rec = QueryRecord()
+                self.records[name] = rec
+            rec.calls += 1
+            if error:
+                rec.errors += 1
+            if rows > 0:
+                rec.rows += rows
+            rec.total_time += elapsed
+            if elapsed > rec.max_time:
+                rec.max_time = elapsed
+            rec.wait_time += wait
+            rec.histogram[bisect.bisect_left(HISTOGRAM_BOUNDS, elapsed)] += 1
+
+    def reset_after_fork(self):
+        """
+        Replaces the lock, which may have been held by another thread of the
+        parent when the process was forked, and discards the parent's
+        statistics.
+        """
+        self.lock = threading.Lock()
+        self.records = {}
+        self.started = time.time()
+
+    def reset(self):
+        with self.lock:
+            self.records = {}
+            self.started = time.time()
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the statistics of each query name.
+        """
+        with self.lock:
+            return dict((name, rec.as_dict()) for (name, rec) in self.records.items())
+
+    def summary(self, top=10):
+        """
+        Returns a list of lines that describe the queries that took the most
+        total time.
+        """
+        snapshot = self.snapshot()
+        total = sum(r['total_time'] for r in snapshot.values())
+        calls = sum(r['calls'] for r in snapshot.values())
+        lines = ['Query stats: {} queries, {:.3f}s total over {:.0f}s'.format(calls, total, time.time() - self.started)]
+        for (name, r) in sorted(snapshot.items(), key=lambda i: i[1]['total_time'], reverse=True)[:top]:
+            lines.append('{}: calls={calls}, errors={errors}, rows={rows}, total={total_time:.3f}s, avg={avg_time:.4f}s, max={max_time:.4f}s, wait={wait_time:.3f}s'.format(name, **r))
+        return lines
+
+    def dump(self, filename):
+        """
+        Writes the statistics to a JSON file.
+        """
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        data = {
+            'pid': os.getpid(),
+            'started': self.started,
+            'time': time.time(),
+            'histogram_bounds': list(HISTOGRAM_BOUNDS),
+            'queries': self.snapshot(),
+        }
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.rename(tmp_filename, filename)
+
+
+# The statistics shared by all of the connection pools in this process
+STATS = QueryStats()
+
+
+class InstrumentedCursor(object):
+    """
+    Wraps a MySQL cursor and records the time taken by each statement.  The
+    time spent waiting for the connection is added to the first statement
+    executed with the cursor.
+    """
+    def __init__(self, cursor, stats, wait=0.0):
+        self._cursor = cursor
+        self._stats = stats
+        self._wait = wait
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _run(self, func, operation, params, frame):
+        wait = self._wait
+        self._wait = 0.0
+        start = time.time()
+        error = True
+        try:
+            result = func(operation, params)
+            error = False
+            return result
+        finally:
+            rows = self._cursor.rowcount if not error else 0
+            self._stats.record(self._stats.query_name(frame), time.time() - start, rows, wait, error)
+
+    def execute(self, operation, params=None, multi=False):
+        if multi:
+            return self._cursor.execute(operation, params, multi)
+        return self._run(self._cursor.execute, operation, params, sys._getframe(1))
+
+    def executemany(self, operation, seq_params):
+        return self._run(self._cursor.executemany, operation, seq_params, sys._getframe(1))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+A module that limits the size of the tables that are continuously appended to
+(such as Location_Data and LinkStarSTX3_Message_History).
+
+Instead of looking up the newest row and deleting the old rows after every
+INSERT, the writers record the event_key of the rows they insert and the
+RetentionManager prunes old rows from a separate, low-priority periodic job.
+Rows are deleted in bounded chunks so that one pass never holds a long lock on
+the table.
+"""
+
+import syslog
+import threading
+import time
+
+import mysql.connector
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,too-many-arguments,protected-access
+
+
+class RetentionPolicy(object):
+    """
+    Describes how long rows are kept in a table.
+
+    max_rows limits the table to (approximately) the newest max_rows rows,
+    based on the auto-increment key.  It can be an integer or a function that
+    takes the vms_db object and returns an integer, for limits that are
+    configured in the database.  max_age (in seconds) removes rows whose
+    time_column is older than the specified age.  Either or both may be set.
+    """
+    def __init__(self, table, max_rows=None, max_age=None, key_column='event_key', time_column=None, chunk_size=1000, max_chunks=20):
+        if max_age and not time_column:
+            raise ValueError('a time_column is required to prune {} by age'.format(table))
+        self.table = table
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.key_column = key_column
+        self.time_column = time_column
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+
+    def row_limit(self, db):
+        if callable(self.max_rows):
+            return self.max_rows(db)
+        return self.max_rows
+
+
+def _max_packets_stored(db):
+    return db.retrieve_linkstar_simplex_info('max_packets_stored')
+
+
+# Only 60,000 location points are saved, and the number of STX3 messages
+# that are archived is configured in LinkStar_Simplex_Information.
+DEFAULT_POLICIES = [
+    RetentionPolicy('Location_Data', max_rows=60000, time_column='time_recorded'),
+    RetentionPolicy('LinkStarSTX3_Message_History', max_rows=_max_packets_stored, time_column='time_sent'),
+]
+
+
+class RetentionManager(object):
+    """
+    Tracks the newest key written to each managed table and prunes the rows
+    that fall outside of the table's retention policy.
+    """
+    def __init__(self, db, policies=None, chunk_delay=0.1):
+        self.db = db
+        self.chunk_delay = chunk_delay
+        self.lock = threading.Lock()
+        self.policies = {}
+        # The highest key that has been inserted into each table, and the key
+        # below which all rows have already been deleted.
+        self.high_water = {}
+        self.pruned_below = {}
+        self.deleted = {}
+        for p in (policies if policies is not None else DEFAULT_POLICIES):
+            self.add_policy(p)
+
+    def add_policy(self, policy):
+        with self.lock:
+            self.policies[policy.table] = policy
+            self.deleted.setdefault(policy.table, 0)
+
+    def note_insert(self, table, key):
+        """
+        Records the key of a row that was just inserted into a table.
+        """
+        if key is None:
+            return
+        with self.lock:
+            if key > self.high_water.get(table, 0):
+                self.high_water[table] = key
+
+    def _max_key(self, policy):
+        stmt = '''
+            SELECT MAX(`{0}`) AS 'max_key' FROM `stepSATdb_Flight`.`{1}`
+        '''.format(policy.key_column, policy.table)
+        with self.db._cursor() as cursor:
+            cursor.execute(stmt)
+            row = cursor.fetchone()
+        if row:
+            return row['max_key']
+        return None
+
+    def _delete_chunks(self, policy, where, params):
+        stmt = '''
+            DELETE FROM `stepSATdb_Flight`.`{0}` WHERE {1} ORDER BY `{2}` LIMIT {3}
+        '''.format(policy.table, where, policy.key_column, policy.chunk_size)
+        total = 0
+        for _ in range(policy.max_chunks):
+            with self.db._cursor() as cursor:
+                cursor.execute(stmt, params)
+                count = cursor.rowcount
+            total += count
+            if count < policy.chunk_size:
+                return (total, True)
+            # Give the other database users a chance to run
+            time.sleep(self.chunk_delay)
+        return (total, False)
+
+    def prune(self, table):
+        """
+        Deletes the rows of a table that are outside of its retention policy.
+        Returns the number of rows deleted.
+        """
+        policy = self.policies[table]
+        total = 0
+
+        limit = policy.row_limit(self.db)
+        if limit:
+            with self.lock:
+                high_water = self.high_water.get(table)
+            if high_water is None:
+                # Nothing has been written by this process yet, the rows may
+                # have been written by another process.
+                high_water = self._max_key(policy)
+
+            if high_water is not None:
+                delete_point = high_water - limit
+                if delete_point > self.pruned_below.get(table, 0):
+                    (count, done) = self._delete_chunks(policy, '`{}` < %s'.format(policy.key_column), (delete_point,))
+                    total += count
+                    if done:
+                        self.pruned_below[table] = delete_point
+
+        if policy.max_age:
+            (count, _) = self._delete_chunks(policy, '`{}` < (NOW() - INTERVAL %s SECOND)'.format(policy.time_column), (int(policy.max_age),))
+            total += count
+
+        if total:
+            syslog.syslog(syslog.LOG_DEBUG, 'Retention: deleted {} rows from {}'.format(total, table))
+        with self.lock:
+            self.deleted[table] += total
+        return total
+
+    def run(self):
+        """
+        Prunes all of the managed tables.  Intended to be called from a
+        periodic timer.
+        """
+        for table in sorted(self.policies.keys()):
+            try:
+                self.prune(table)
+            except mysql.connector.Error as err:
+                print("MySQL Error: {}".format(err))
+                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'high_water': dict(self.high_water),
+                'pruned_below': dict(self.pruned_below),
+                'deleted': dict(self.deleted),
+            }
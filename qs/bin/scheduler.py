@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+"""
+A module that runs periodic jobs from a single dispatcher thread and a small
+pool of worker threads.
+
+Previously every PeriodicTimer was its own thread that slept between runs, so
+the VMS had a thread (and a thread stack) per job, and the jobs woke up in an
+unpredictable order.  The Scheduler keeps the jobs in a min-heap ordered by
+the time they are due.  The dispatcher sleeps until the first job is due and
+hands the due jobs to a bounded pool of workers, so at most that many jobs run
+at the same time and the rest wait their turn.
+
+A job is rescheduled when its action returns, using the same contract as the
+PeriodicTimer: if the action returns a positive number it becomes the new
+delay, if it returns a negative number the job is stopped.
+
+Pausable jobs are not started while the run event (the multiprocessing.Event
+that command processes use to pause the periodic jobs) is cleared; they are
+started as soon as it is set again.  A job that is running when the event is
+cleared finishes its current run.
+
+Jobs are fixed-delay by default: the delay is counted from the end of one run
+to the start of the next, so a job that takes a while to run drifts by its run
+time every period.  Fixed-rate jobs are instead run on a grid of ticks that
+are delay seconds apart, anchored to the time the job was added, so the run
+time doesn't add to the period.  If a run of a fixed-rate job takes longer
+than the period (an overrun), the ticks it missed are not all run back to
+back.  With the 'skip' overrun policy the missed ticks are dropped and the job
+is run at the next tick, with 'coalesce' the missed ticks are combined into
+one run as soon as the overrunning run finishes.  The overruns, the missed
+ticks and the period jitter (how far the time between the starts of two runs
+was from the time between their due times) are kept for every job.
+
+The system time is set from the GPS with clock_settime(), so the due times
+are kept with CLOCK_MONOTONIC, and the dispatcher waits with select() on a
+pipe, so neither are affected when the system time is changed.
+"""
+
+import ctypes
+import ctypes.util
+import heapq
+import itertools
+import os
+import Queue
+import select
+import sys
+import syslog
+import threading
+import time
+import traceback
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,too-many-instance-attributes,too-many-arguments
+
+DEFAULT_WORKERS = 4
+
+# The longest time the dispatcher sleeps without checking the jobs, and how
+# often the run event is checked while there are paused jobs
+MAX_WAIT = 60.0
+PAUSE_CHECK_INTERVAL = 1.0
+
+CLOCK_MONOTONIC = 1
+
+# What fixed-rate jobs do with the ticks they missed because a run took
+# longer than the period
+OVERRUN_SKIP = 'skip'
+OVERRUN_COALESCE = 'coalesce'
+OVERRUN_POLICIES = (OVERRUN_SKIP, OVERRUN_COALESCE)
+
+
+def _monotonic_clock():
+    """
+    Returns a function that reads CLOCK_MONOTONIC, or time.time if the clock
+    can't be read.
+    """
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long),
+                    ("tv_nsec", ctypes.c_long)]
+
+    try:
+        lib = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = lib.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+    except (OSError, AttributeError) as err:
+        syslog.syslog(syslog.LOG_WARNING, 'CLOCK_MONOTONIC is not available, using the system time: {}'.format(err))
+        return time.time
+
+    def monotonic():
+        ts = timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _monotonic_clock()
+
+
+class Job(object):
+    """
+    A periodic job.  For a fixed-delay job the delay is the number of seconds
+    between the end of one run and the start of the next, for a fixed-rate job
+    it is the number of seconds between the starts of two runs.
+    """
+    def __init__(self, scheduler, name, action, delay, args=(), pausable=False, fixed_rate=False, overrun=OVERRUN_SKIP):
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError('invalid overrun policy "{}", must be one of {}'.format(overrun, OVERRUN_POLICIES))
+        self.scheduler = scheduler
+        self.name = name
+        self.action = action
+        self.delay = delay
+        self.args = args
+        self.pausable = pausable
+        self.fixed_rate = fixed_rate
+        self.overrun = overrun
+
+        # 'scheduled', 'running', 'stopping' or 'stopped'
+        self.state = 'stopped'
+        self.due = None
+        # The heap entry of the job, entries of jobs that have been
+        # rescheduled or stopped are left in the heap and ignored
+        self.entry = None
+        # The next tick of a fixed-rate job that hasn't been run
+        self.tick = None
+        self.triggered = False
+        self.thread = None
+        self.idle = threading.Event()
+        self.idle.set()
+
+        self.runs = 0
+        self.errors = 0
+        self.paused = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self.overruns = 0
+        self.missed = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+        self.jitter_samples = 0
+        # The due and start times of the previous run
+        self.last_due = None
+        self.last_start = None
+
+    def trigger(self):
+        self.scheduler.trigger(self)
+
+    def cancel(self, wait=True, timeout=None):
+        return self.scheduler.cancel(self, wait, timeout)
+
+    def is_alive(self):
+        return self.state != 'stopped'
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'delay': self.delay,
+            'mode': 'fixed-rate' if self.fixed_rate else 'fixed-delay',
+            'runs': self.runs,
+            'errors': self.errors,
+            'paused': self.paused,
+            'avg_time': self.total_time / self.runs if self.runs else 0.0,
+            'max_time': self.max_time,
+            'avg_lateness': self.total_lateness / self.runs if self.runs else 0.0,
+            'max_lateness': self.max_lateness,
+            'overruns': self.overruns,
+            'missed': self.missed,
+            'avg_jitter': self.total_jitter / self.jitter_samples if self.jitter_samples else 0.0,
+            'max_jitter': self.max_jitter,
+        }
+
+
+class Scheduler(object):
+    """
+    Runs periodic jobs with a pool of worker threads.  If run_event is set,
+    pausable jobs only run while it is set.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, run_event=None):
+        self.num_workers = workers
+        self.run_event = run_event
+        self.lock = threading.Lock()
+        self.heap = []
+        self.counter = itertools.count()
+        self.jobs = []
+        # Jobs that came due while the run event was cleared
+        self.paused_jobs = []
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.running = False
+        self.busy = 0
+        (self.wake_r, self.wake_w) = os.pipe()
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        t = threading.Thread(target=self._dispatch, name='scheduler')
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+        for num in range(self.num_workers):
+            t = threading.Thread(target=self._work, name='scheduler-worker-{}'.format(num))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self, wait=True, timeout=None):
+        """
+        Stops all jobs and the scheduler threads.  Jobs that are running are
+        allowed to finish.
+        """
+        with self.lock:
+            jobs = list(self.jobs)
+        for job in jobs:
+            self.cancel(job, False)
+        with self.lock:
+            self.running = False
+        for _ in range(self.num_workers):
+            self.queue.put(None)
+        self._wake()
+        if wait:
+            for t in self.threads:
+                if t is not threading.current_thread():
+                    t.join(timeout)
+        self.threads = []
+
+    def add(self, action, delay, args=(), name=None, pausable=False, first_delay=0.0, fixed_rate=False, overrun=OVERRUN_SKIP):
+        """
+        Adds a job, its first run is first_delay seconds from now.  The ticks
+        of a fixed-rate job are anchored to its first run.
+        """
+        job = Job(self, name or getattr(action, '__name__', str(action)), action, delay, args, pausable, fixed_rate, overrun)
+        with self.lock:
+            self.jobs.append(job)
+            due = monotonic() + first_delay
+            job.tick = due
+            self._schedule(job, due)
+        self._wake()
+        return job
+
+    def _schedule(self, job, due):
+        # Must be called with the lock held
+        job.state = 'scheduled'
+        job.due = due
+        job.entry = (due, next(self.counter), job)
+        heapq.heappush(self.heap, job.entry)
+
+    def _wake(self):
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError:
+            pass
+
+    def trigger(self, job):
+        """
+        Runs a job now rather than when its delay has elapsed.  If the job is
+        running it is run again as soon as it finishes.
+        """
+        with self.lock:
+            if job.state == 'scheduled':
+                self._schedule(job, monotonic())
+            elif job.state == 'running':
+                job.triggered = True
+        self._wake()
+
+    def cancel(self, job, wait=True, timeout=None):
+        """
+        Stops a job.  If wait is set and the job is running, waits (up to
+        timeout seconds) for the run to finish.  Returns True if the job is no
+        longer running.
+        """
+        with self.lock:
+            if job.state == 'running':
+                job.state = 'stopping'
+            elif job.state != 'stopping':
+                job.state = 'stopped'
+            job.entry = None
+            if job in self.paused_jobs:
+                self.paused_jobs.remove(job)
+            if job in self.jobs and job.state == 'stopped':
+                self.jobs.remove(job)
+        # A job may stop itself, don't wait for the run that is doing it
+        if wait and job.thread is not threading.current_thread():
+            return job.idle.wait(timeout)
+        return job.idle.is_set()
+
+    def paused(self):
+        return self.run_event is not None and not self.run_event.is_set()
+
+    def pause(self):
+        if self.run_event is not None:
+            self.run_event.clear()
+
+    def resume(self):
+        if self.run_event is not None:
+            self.run_event.set()
+        self._wake()
+
+    def _dispatch(self):
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+                now = monotonic()
+                paused = self.paused()
+                if self.paused_jobs and not paused:
+                    for job in self.paused_jobs:
+                        if job.state == 'scheduled':
+                            # The ticks of fixed-rate jobs start again from
+                            # now, the paused ticks aren't overruns
+                            job.tick = now
+                            self._schedule(job, now)
+                    self.paused_jobs = []
+
+                while self.heap and self.heap[0][0] <= now:
+                    entry = heapq.heappop(self.heap)
+                    job = entry[2]
+                    if entry is not job.entry:
+                        continue
+                    job.entry = None
+                    if job.pausable and paused:
+                        job.paused += 1
+                        self.paused_jobs.append(job)
+                        continue
+                    job.state = 'running'
+                    job.idle.clear()
+                    self.queue.put((job, entry[0]))
+
+                # Drop the stale entries so they don't cause early wake ups
+                while self.heap and self.heap[0] is not self.heap[0][2].entry:
+                    heapq.heappop(self.heap)
+                timeout = MAX_WAIT
+                if self.heap:
+                    timeout = min(max(self.heap[0][0] - now, 0.0), MAX_WAIT)
+                if self.paused_jobs:
+                    timeout = min(timeout, PAUSE_CHECK_INTERVAL)
+
+            (readable, _, _) = select.select([self.wake_r], [], [], timeout)
+            if readable:
+                os.read(self.wake_r, 4096)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (job, due) = item
+            self._run(job, due)
+
+    def _run(self, job, due):
+        with self.lock:
+            self.busy += 1
+        start = monotonic()
+        job.thread = threading.current_thread()
+        ret = None
+        # pylint: disable=bare-except
+        try:
+            ret = job.action(*job.args)
+        except:
+            job.errors += 1
+            syslog.syslog(syslog.LOG_ERR, 'Error in periodic job {}: {}'.format(job.name, traceback.format_exception(*sys.exc_info())))
+        job.thread = None
+        end = monotonic()
+
+        with self.lock:
+            self.busy -= 1
+            job.runs += 1
+            elapsed = end - start
+            job.total_time += elapsed
+            job.max_time = max(job.max_time, elapsed)
+            lateness = max(start - due, 0.0)
+            job.total_lateness += lateness
+            job.max_lateness = max(job.max_lateness, lateness)
+            if job.last_start is not None:
+                jitter = abs((start - job.last_start) - (due - job.last_due))
+                job.jitter_samples += 1
+                job.total_jitter += jitter
+                job.max_jitter = max(job.max_jitter, jitter)
+            job.last_due = due
+            job.last_start = start
+
+            if ret and ret < 0:
+                job.state = 'stopping'
+            elif ret:
+                job.delay = float(ret)
+
+            if job.state == 'stopping' or not self.running:
+                job.state = 'stopped'
+                if job in self.jobs:
+                    self.jobs.remove(job)
+            else:
+                if job.fixed_rate:
+                    next_due = self._next_tick(job, due, end)
+                else:
+                    next_due = end + job.delay
+                if job.triggered:
+                    job.triggered = False
+                    next_due = end
+                self._schedule(job, next_due)
+            job.idle.set()
+        self._wake()
+
+    def _next_tick(self, job, due, end):
+        # Must be called with the lock held.  Returns when a fixed-rate job
+        # that was due at due and finished at end is due next.  A run that
+        # was triggered before the next tick doesn't use the tick up.
+        if due >= job.tick:
+            job.tick += job.delay
+        if job.tick > end:
+            return job.tick
+
+        # The run overran the period, count the ticks that were missed
+        missed = int((end - job.tick) / job.delay) + 1
+        job.overruns += 1
+        if job.overrun == OVERRUN_COALESCE:
+            # The missed ticks are run once, right away
+            job.tick += (missed - 1) * job.delay
+            job.missed += missed - 1
+            return end
+        job.tick += missed * job.delay
+        job.missed += missed
+        return job.tick
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.num_workers,
+                'busy': self.busy,
+                'queued': self.queue.qsize(),
+                'paused': len(self.paused_jobs),
+                'jobs': self._job_stats(),
+            }
+
+    def _job_stats(self):
+        # Must be called with the lock held, jobs with the same name are
+        # numbered so they are all reported
+        stats = {}
+        for job in self.jobs:
+            name = job.name
+            num = 1
+            while name in stats:
+                num += 1
+                name = '{}#{}'.format(job.name, num)
+            stats[name] = job.stats()
+        return stats
+
+
+# The scheduler used by PeriodicTimers that aren't given one
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def reset_after_fork():
+    """
+    Forgets the default scheduler of the parent process in a forked child.
+    Only the forking thread exists in the child, so the scheduler's thread
+    is gone, and the lock may have been held by another thread.
+    """
+    global _default_scheduler, _default_scheduler_lock
+    _default_scheduler = None
+    _default_scheduler_lock = threading.Lock()
+
+
+def default_scheduler():
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = Scheduler()
+            _default_scheduler.start()
+        return _default_scheduler
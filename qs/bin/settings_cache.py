@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+A module that caches the small configuration tables of the QS/VMS database
+(LinkStar_Simplex_Information and Packets_Types).
+
+These tables are read by the STX3 and GPS jobs every few seconds but only
+change when an operator changes a setting, so they are loaded together in a
+single pass and re-loaded on an interval.  When a re-load finds that a value
+changed, the registered listeners are notified so that the periodic jobs can
+react without restarting the VMS.
+"""
+
+import syslog
+import sys
+import threading
+import time
+
+import mysql.connector
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,protected-access
+
+
+class SettingsCache(object):
+    """
+    A cached copy of the LinkStar_Simplex_Information row and the
+    Packets_Types rows (indexed by packet_id).
+
+    Listeners are called with the name of the table that changed and a
+    dictionary of {column: (old value, new value)} for the LinkStar_Simplex_
+    Information row, or {packet_id: (old row, new row)} for Packets_Types.
+    Listeners are not called for the initial load.
+    """
+    def __init__(self, db, refresh_interval=10.0):
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.lock = threading.RLock()
+        # Only one thread re-loads the tables at a time
+        self.refresh_lock = threading.Lock()
+        self.simplex_info = None
+        self.packet_types = None
+        self.loaded_at = 0.0
+        self.listeners = []
+
+    def add_listener(self, func):
+        with self.lock:
+            if func not in self.listeners:
+                self.listeners.append(func)
+
+    def remove_listener(self, func):
+        with self.lock:
+            if func in self.listeners:
+                self.listeners.remove(func)
+
+    def invalidate(self):
+        """
+        Forces the next read to re-load the tables, used after a setting has
+        been modified by this process.
+        """
+        with self.lock:
+            self.loaded_at = 0.0
+
+    def is_stale(self):
+        with self.lock:
+            if self.simplex_info is None:
+                return True
+            return (time.time() - self.loaded_at) >= self.refresh_interval
+
+    def refresh(self, force=False):
+        """
+        Re-loads the tables if the cached copy is stale (or if force is set)
+        and notifies the listeners of any changes.  If the tables can't be
+        read the previous values are kept.
+        """
+        if not force and not self.is_stale():
+            return False
+
+        # If another thread is already re-loading the tables just use the
+        # current values, unless nothing has been loaded yet.
+        if not self.refresh_lock.acquire(self.simplex_info is None or force):
+            return False
+        try:
+            return self._refresh()
+        finally:
+            self.refresh_lock.release()
+
+    def _refresh(self):
+        try:
+            with self.db._cursor() as cursor:
+                cursor.execute('''
+                    SELECT * FROM `stepSATdb_Flight`.`LinkStar_Simplex_Information` LIMIT 1
+                ''')
+                simplex_info = cursor.fetchone() or {}
+                cursor.execute('''
+                    SELECT * FROM `stepSATdb_Flight`.`Packets_Types`
+                ''')
+                packet_types = dict((str(row['packet_id']), row) for row in cursor.fetchall())
+        except mysql.connector.Error as err:
+            print("MySQL Error: {}".format(err))
+            syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+            return False
+
+        changes = []
+        with self.lock:
+            if self.simplex_info is not None:
+                changed = dict((k, (self.simplex_info.get(k), v)) for k, v in simplex_info.items() if self.simplex_info.get(k) != v)
+                if changed:
+                    changes.append(('LinkStar_Simplex_Information', changed))
+                keys = set(self.packet_types.keys()) | set(packet_types.keys())
+                changed = dict((k, (self.packet_types.get(k), packet_types.get(k))) for k in keys if self.packet_types.get(k) != packet_types.get(k))
+                if changed:
+                    changes.append(('Packets_Types', changed))
+            self.simplex_info = simplex_info
+            self.packet_types = packet_types
+            self.loaded_at = time.time()
+            listeners = list(self.listeners)
+
+        # Call the listeners without holding the lock so they can read the
+        # new settings.
+        for (table, changed) in changes:
+            syslog.syslog(syslog.LOG_INFO, '{} settings changed: {}'.format(table, sorted(changed.keys())))
+            for func in listeners:
+                # pylint: disable=bare-except
+                try:
+                    func(table, changed)
+                except KeyboardInterrupt as e:
+                    raise e
+                except:
+                    syslog.syslog(syslog.LOG_ERR, 'Error in settings listener {}: {}'.format(func, sys.exc_info()[1]))
+        return True
+
+    def simplex(self, column, default=None):
+        """
+        Returns a column of the LinkStar_Simplex_Information row.
+        """
+        self.refresh()
+        with self.lock:
+            if not self.simplex_info:
+                return default
+            return self.simplex_info.get(column, default)
+
+    def packet_type(self, packet_id):
+        """
+        Returns the Packets_Types row for a packet ID, or None.
+        """
+        self.refresh()
+        with self.lock:
+            if not self.packet_types:
+                return None
+            return self.packet_types.get(str(packet_id))
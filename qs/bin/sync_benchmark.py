@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Benchmark of the flight to ground table sync over an emulated link.
+
+The flight database is used directly and the ground database is reached
+through a LinkEmulator (see link_emulator.py) that limits the bandwidth, adds
+latency and takes the link down during blackout windows, so the sync can be
+measured on a plain Linux box with two local MySQL instances instead of the
+Globalstar hardware.
+
+For each table a backlog of rows is written to the flight database, then rows
+keep being written at a fixed rate while the table is synchronized with
+SyncEngine the same way the sync coordinator does it (the next sync is
+started when the previous one finishes, or after a short delay if there was
+nothing to send or the sync failed).  The rows that existed before the
+benchmark started are not sent.  The benchmark reports:
+
+    - rows/s and bytes/s (as measured by the sync engine and on the link)
+    - the catch-up time after each blackout: how long it took, after the link
+      came back, to send every row that had been written when it came back
+    - the database time spent on each query (flight and ground) per table
+
+The rows are generated with a fixed seed and the results can be written to a
+JSON file together with the current git commit, so runs with the same
+arguments can be compared across commits.  This writes rows to the flight and
+ground databases and moves the sync watermarks, so it should only be run
+against test databases.
+"""
+
+import argparse
+import json
+import os.path
+import random
+import subprocess
+import threading
+import time
+
+import link_emulator
+import query_stats
+import sync_engine
+import throughput
+import vms_db
+import vms_db_ground
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,protected-access,too-many-locals,too-many-instance-attributes
+
+# How long to wait before the next sync if there was nothing to send, or the
+# sync failed
+IDLE_DELAY = 0.5
+RETRY_DELAY = 2.0
+
+
+class RowGenerator(object):
+    """
+    Writes rows to a flight table: a backlog to start with, and then rate rows
+    per second from a background thread.
+    """
+    def __init__(self, db, table, seed, rate, parameter_id):
+        self.db = db
+        self.table = table
+        self.random = random.Random(seed)
+        self.rate = rate
+        self.parameter_id = parameter_id
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.written = 0
+        self.backlog = 0
+        if table == 'Flight_Data':
+            self.db.start_flight_data_writer(flush_interval=1.0)
+
+    def write(self, count):
+        for _ in range(count):
+            if self.table == 'Flight_Data':
+                self.db.write_flight_data(self.parameter_id, '{:.6f}'.format(self.random.uniform(-1000.0, 1000.0)))
+            else:
+                self.db._log_msg('sync benchmark message {} {}'.format(self.written, self.random.getrandbits(64)))
+            self.written += 1
+        self.db.flush_flight_data()
+
+    def _thread(self):
+        start = time.time()
+        while not self.stop_event.wait(0.1) and not self.stop_event.is_set():
+            due = int((time.time() - start) * self.rate) - (self.written - self.backlog)
+            if due > 0:
+                self.write(due)
+
+    def start(self, backlog):
+        self.write(backlog)
+        self.backlog = backlog
+        if self.rate > 0:
+            self.thread = threading.Thread(target=self._thread)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.db.flush_flight_data()
+
+
+def git_commit():
+    # pylint: disable=bare-except
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except:
+        return None
+
+
+def db_time(snapshot):
+    """
+    Returns the total time spent in the flight and the ground database
+    queries, and the time of each query.
+    """
+    flight = sum(r['total_time'] for (name, r) in snapshot.items() if name.startswith('vms_db.'))
+    ground = sum(r['total_time'] for (name, r) in snapshot.items() if name.startswith('vms_db_ground.'))
+    queries = dict((name, {'calls': r['calls'], 'total_time': r['total_time'], 'max_time': r['max_time']}) for (name, r) in snapshot.items())
+    return (flight, ground, queries)
+
+
+def run_table(db, db_ground, emulator, table, args):
+    engine = sync_engine.SyncEngine(db, estimator=throughput.ThroughputEstimator(None))
+    engine.yield_check = None
+    if args.no_budget:
+        policy = sync_engine.SyncEngine.policy(table)
+        sync_engine.POLICIES[table] = sync_engine.TablePolicy(policy.priority, limited=False)
+
+    # Only the rows written by the benchmark are sent
+    engine.watermarks[table] = db.sync_max_key(table)
+    generator = RowGenerator(db, table, args.seed, args.row_rate, args.parameter_id)
+    generator.start(args.rows)
+
+    # The catch-up target of each blackout is the newest row when the link
+    # comes back
+    catch_ups = []
+    def link_changed(up):
+        if up:
+            catch_ups.append({'link_up': time.time(), 'target': db.sync_max_key(table), 'time': None})
+    emulator.listeners.append(link_changed)
+
+    query_stats.STATS.reset()
+    link_start = emulator.stats()
+    syncs = 0
+    failures = 0
+    watermark = engine.watermark(table)
+    # The newest row once the generator has stopped
+    target = None
+    start = time.time()
+    emulator.start_schedule()
+    try:
+        while True:
+            elapsed = time.time() - start
+            if elapsed >= args.duration and target is None:
+                generator.stop()
+                target = db.sync_max_key(table)
+            if elapsed >= args.duration + args.timeout:
+                break
+
+            sent = engine.sync_table(table, db_ground)
+            syncs += 1
+            now = time.time()
+            watermark = engine.watermark(table)
+            for c in catch_ups:
+                if c['time'] is None and watermark >= c['target']:
+                    c['time'] = now - c['link_up']
+
+            if target is not None and watermark >= target:
+                break
+            if sent is None:
+                failures += 1
+                time.sleep(RETRY_DELAY)
+            elif not sent:
+                time.sleep(IDLE_DELAY)
+    finally:
+        emulator.listeners.remove(link_changed)
+        emulator.stop_schedule()
+        generator.stop()
+        engine.close()
+
+    elapsed = time.time() - start
+    stats = engine.stats()[table]
+    link_end = emulator.stats()
+    (flight_time, ground_time, queries) = db_time(query_stats.STATS.snapshot())
+    return {
+        'rows_written': generator.written,
+        'rows_sent': stats['rows'],
+        'caught_up': target is not None and watermark >= target,
+        'elapsed': elapsed,
+        'rows_per_sec': stats['rows'] / elapsed,
+        'est_wire_bytes': stats['est_wire_bytes'],
+        'raw_bytes': stats['raw_bytes'],
+        'est_wire_bytes_per_sec': stats['est_wire_bytes'] / elapsed,
+        'link_bytes_up': link_end['bytes_up'] - link_start['bytes_up'],
+        'link_bytes_down': link_end['bytes_down'] - link_start['bytes_down'],
+        'link_bytes_per_sec': (link_end['bytes_up'] - link_start['bytes_up']) / elapsed,
+        'batches': stats['batches'],
+        'syncs': syncs,
+        'failed_syncs': failures,
+        'catch_up_times': [c['time'] for c in catch_ups],
+        'flight_db_time': flight_time,
+        'ground_db_time': ground_time,
+        'queries': queries,
+    }
+
+
+def report(table, r):
+    print '{}: {rows_sent}/{rows_written} rows in {elapsed:.1f}s{}'.format(table, '' if r['caught_up'] else ' (did not catch up)', **r)
+    print '    {rows_per_sec:.1f} rows/s, {est_wire_bytes_per_sec:.0f} bytes/s sent, estimated ({raw_bytes} raw, ~{est_wire_bytes} compressed), {link_bytes_per_sec:.0f} bytes/s on the link ({link_bytes_up} up, {link_bytes_down} down)'.format(**r)
+    print '    {batches} batches in {syncs} syncs, {failed_syncs} failed'.format(**r)
+    for (num, t) in enumerate(r['catch_up_times']):
+        print '    blackout {}: {}'.format(num + 1, 'caught up in {:.1f}s'.format(t) if t is not None else 'did not catch up')
+    print '    db time: flight {flight_db_time:.3f}s, ground {ground_db_time:.3f}s'.format(**r)
+    for (name, q) in sorted(r['queries'].items(), key=lambda i: i[1]['total_time'], reverse=True):
+        print '        {:<40} {:>6} calls {:>9.3f}s total {:>8.4f}s max'.format(name, q['calls'], q['total_time'], q['max_time'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the flight to ground table sync over an emulated link (writes to both databases)')
+    parser.add_argument('--vms-address', default='127.0.0.1', help='address (IP or URL) of QS/VMS database')
+    parser.add_argument('--vms-port', type=int, default=3306, help='UDP port used by the QS/VMS database')
+    parser.add_argument('--vms-cert', help='location of SSL certificate to use to connect to QS/VMS database')
+    parser.add_argument('--vms-dbname', default='stepSATdb_Flight', help='name of the QS/VMS database')
+    parser.add_argument('--vms-username', default='root', help='username for the QS/VMS database')
+    parser.add_argument('--vms-password', default='Quicksat!1', help='password for the QS/VMS database')
+    parser.add_argument('--ground-address', default='127.0.0.1', help='address (IP or URL) of the ground database')
+    parser.add_argument('--ground-port', type=int, default=3307, help='port used by the ground database')
+    parser.add_argument('--ground-cert', help='location of SSL certificate to use to connect to the ground database')
+    parser.add_argument('--ground-dbname', default='stepSATdb_Flight', help='name of the ground database')
+    parser.add_argument('--ground-username', default='root', help='username for the ground database')
+    parser.add_argument('--ground-password', default='Quicksat!1', help='password for the ground database')
+    link_emulator.add_link_arguments(parser)
+    parser.add_argument('--table', dest='tables', action='append', choices=('Flight_Data', 'System_Messages'), help='table to benchmark, may be repeated (default is Flight_Data)')
+    parser.add_argument('--rows', type=int, default=1000, help='number of rows in the backlog when the sync starts')
+    parser.add_argument('--row-rate', type=float, default=5.0, help='rows written per second while the benchmark runs')
+    parser.add_argument('--duration', type=float, default=120.0, help='number of seconds to write rows for')
+    parser.add_argument('--timeout', type=float, default=600.0, help='number of seconds to keep syncing after the rows stop to catch up')
+    parser.add_argument('--no-budget', action='store_true', help='do not limit the rows and bytes the tables may send in each window')
+    parser.add_argument('--parameter-id', type=int, default=1, help='parameter_id of the generated Flight_Data rows')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--output', help='append the results to this JSON lines file')
+    args = parser.parse_args()
+    args.tables = args.tables or ['Flight_Data']
+
+    db = vms_db.vms_db(address=args.vms_address, port=args.vms_port, cert=args.vms_cert, username=args.vms_username, password=args.vms_password, dbname=args.vms_dbname)
+
+    emulator = link_emulator.LinkEmulator(args.ground_address, args.ground_port, bandwidth=args.bandwidth or None, latency=args.latency, blackouts=args.blackout, mode=args.blackout_mode)
+    emulator.start()
+    db_ground = vms_db_ground.vms_db_ground(address='127.0.0.1', port=emulator.port, cert=args.ground_cert, username=args.ground_username, password=args.ground_password, dbname=args.ground_dbname)
+
+    results = {}
+    try:
+        for table in args.tables:
+            results[table] = run_table(db, db_ground, emulator, table, args)
+            report(table, results[table])
+    finally:
+        db.stop_flight_data_writer()
+        db_ground.close()
+        emulator.stop()
+
+    if args.output:
+        options = dict((k, v) for (k, v) in vars(args).items() if not k.endswith('password'))
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({'commit': git_commit(), 'time': time.time(), 'args': options, 'results': results}, sort_keys=True) + '\n')
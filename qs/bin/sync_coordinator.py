@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+A module that schedules the jobs that synchronize the flight database with the
+ground database.
+
+Previously each table had its own periodic timer, and every timer checked the
+radio status (a serial AT exchange), the test_connection flag and the ground
+database connection on its own.  The SyncCoordinator is run by a single
+periodic timer; each cycle it finds the jobs that are due (or will be due
+shortly, so that jobs with similar rates are grouped together), checks the
+link once and then runs all of those jobs against the same ground connection.
+Jobs are run in priority order (lower numbers first).  Piggyback jobs (such
+as the poll for commands from the ground) are also run on every cycle that
+finds the link up, so they ride along with the other jobs at no extra link
+check cost.
+"""
+
+import sys
+import syslog
+import threading
+import time
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name,too-many-arguments
+
+# Jobs that are due within this many seconds are run early so they share the
+# link check with the jobs that are due now.
+DEFAULT_COALESCE_WINDOW = 15.0
+
+# Limits on how long the coordinator waits between cycles
+MIN_CYCLE_DELAY = 1.0
+MAX_CYCLE_DELAY = 30.0
+
+
+class SyncJob(object):
+    """
+    A job run by the SyncCoordinator.  The interval may be a number of seconds
+    or a function that returns the number of seconds, so that push rates that
+    are configured in the database are re-read after every run.  Pausable jobs
+    are not run while the run event is cleared.  Piggyback jobs are run at
+    their interval, and also whenever another job is run.
+    """
+    def __init__(self, name, action, interval, pausable=True, priority=0, piggyback=False):
+        self.name = name
+        self.action = action
+        self.interval = interval
+        self.pausable = pausable
+        self.priority = priority
+        self.piggyback = piggyback
+        # Jobs are run on the first cycle, like a PeriodicTimer
+        self.next_due = 0.0
+        self.runs = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def rate(self):
+        if callable(self.interval):
+            return float(self.interval())
+        return float(self.interval)
+
+
+class SyncCoordinator(object):
+    """
+    Runs the due sync jobs.  link_check is a function that returns True if the
+    ground can be reached, it is called at most once per cycle.
+    """
+    def __init__(self, link_check, run_event=None, coalesce_window=DEFAULT_COALESCE_WINDOW):
+        self.link_check = link_check
+        self.run_event = run_event
+        self.coalesce_window = coalesce_window
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.cycles = 0
+        self.link_checks = 0
+        self.link_down = 0
+
+    def add_job(self, name, action, interval, pausable=True, priority=0, piggyback=False):
+        job = SyncJob(name, action, interval, pausable, priority, piggyback)
+        with self.lock:
+            self.jobs.append(job)
+            self.jobs.sort(key=lambda j: j.priority)
+        return job
+
+    def _paused(self):
+        return self.run_event is not None and not self.run_event.is_set()
+
+    def run_cycle(self):
+        """
+        Runs one cycle and returns the number of seconds until the next cycle,
+        so it can be used directly as a PeriodicTimer action.
+        """
+        now = time.time()
+        paused = self._paused()
+        with self.lock:
+            runnable = [j for j in self.jobs if not (j.pausable and paused)]
+            due = [j for j in runnable if j.next_due <= now + self.coalesce_window]
+            if due:
+                due = [j for j in runnable if j in due or j.piggyback]
+
+        if due:
+            self.cycles += 1
+            self.link_checks += 1
+            link_up = self.link_check()
+            if not link_up:
+                self.link_down += 1
+
+            for job in due:
+                # Jobs that are run early are scheduled from the time they
+                # were due, so grouping them doesn't change their rate.
+                # pylint: disable=bare-except
+                try:
+                    job.next_due = max(job.next_due, now) + job.rate()
+                except:
+                    syslog.syslog(syslog.LOG_ERR, 'Error reading the {} sync rate: {}'.format(job.name, sys.exc_info()[1]))
+                    job.next_due = now + MAX_CYCLE_DELAY
+
+                if not link_up:
+                    job.skipped += 1
+                    continue
+                if job.pausable and self._paused():
+                    # Paused while the other jobs were running, try again on
+                    # the next cycle.
+                    job.next_due = now
+                    continue
+                try:
+                    job.action()
+                    job.runs += 1
+                except KeyboardInterrupt as e:
+                    raise e
+                except:
+                    job.errors += 1
+                    syslog.syslog(syslog.LOG_ERR, 'Error in {} sync: {}'.format(job.name, sys.exc_info()[1]))
+
+        return self.next_delay()
+
+    def higher_priority_due(self, priority):
+        """
+        Returns True if a job that is more important than the priority is due
+        to run, used to let long running jobs give up the link.
+        """
+        now = time.time()
+        paused = self._paused()
+        with self.lock:
+            return any(j.priority < priority and j.next_due <= now and not (j.pausable and paused) for j in self.jobs)
+
+    def next_delay(self):
+        now = time.time()
+        paused = self._paused()
+        with self.lock:
+            pending = [j.next_due for j in self.jobs if not (j.pausable and paused)]
+        if not pending:
+            return MAX_CYCLE_DELAY
+        return min(max(min(pending) - now, MIN_CYCLE_DELAY), MAX_CYCLE_DELAY)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'cycles': self.cycles,
+                'link_checks': self.link_checks,
+                'link_down': self.link_down,
+                'jobs': dict((j.name, {'runs': j.runs, 'skipped': j.skipped, 'errors': j.errors}) for j in self.jobs),
+            }
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+"""
+A module that copies new rows of the flight database tables to the ground
+database.
+
+Each synchronized table has a watermark: the event_key of the newest row that
+the ground has acknowledged (the ground INSERT was committed).  Rows after the
+watermark are read from the flight database in bounded batches and inserted
+directly into the ground database, so no export files are needed.  The next
+batch is read from the flight database while the previous batch is being
+written to the ground, and the watermark is only advanced (and saved in
+Flight_Pointers) after the ground write succeeds.
+
+The ground records each committed batch in a chunk ledger (see
+vms_db_ground.py) and skips the rows whose key it already has, so a batch that
+is re-sent is discarded, never duplicated, and a flight row never overwrites a
+row the ground created.  Before a table
+is first synchronized, and after a ground write fails (the link may have
+dropped after the ground committed the batch), the watermark is compared with
+the newest chunk in the ground ledger and advanced to it, so the batches the
+ground already has are not sent over the link again.
+
+Over the LinkStar duplex link every byte counts, so each batch is measured
+with zlib before it is sent.  Batches that compress well are sent over a
+compressed MySQL protocol connection and the others over a plain connection,
+which avoids spending CPU and packet headers on data that does not compress
+(such as Flight_Data_Binary).  The bytes that actually cross the link are not
+measured, the MySQL protocol compression happens inside the connector, so the
+compressed size of a batch is estimated by compressing an approximation of it
+(see batch_payload()).  The raw and the estimated compressed bytes of each
+table are reported in the sync statistics, and the throughput estimates and
+batch sizes below are based on the same estimate.
+
+Tables are sent in priority order.  Each table has a budget of rows (and
+optionally bytes) per link window; unused budget rolls over to later windows
+(up to a limit) so a table can catch up after a blackout without starving the
+others.  A bulk table stops after its current batch when an urgent table is
+waiting to sync.  The batch size of each table starts at its
+<table>_num_records_download setting and is then sized from the measured
+throughput of the current connection type (see throughput.py) and the average
+size of the table's rows, so that each batch takes about TARGET_BATCH_TIME
+seconds to send.  Ethernet drains a backlog in large batches while the
+satellite link gets batches small enough to avoid timeouts.
+"""
+
+import multiprocessing.pool
+import syslog
+import threading
+import time
+import zlib
+
+import mysql.connector
+
+import throughput
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name
+
+# The number of rows sent in each batch if the table does not have a
+# <table>_num_records_download setting, and the maximum number of batches sent
+# in one sync.
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_MAX_BATCHES = 10
+
+# A batch is sent compressed if zlib reduces it to less than this fraction of
+# its size.  Batches smaller than COMPRESS_MIN_BYTES are always sent plain.
+COMPRESS_RATIO = 0.8
+COMPRESS_MIN_BYTES = 512
+
+
+# Tables with a priority at or below URGENT_PRIORITY (lower numbers are more
+# important) preempt the other tables.
+URGENT_PRIORITY = 1
+
+# The length of a link window (in seconds), the number of windows of unused
+# budget that a table may accumulate, and the number of batches a table may
+# send in each window.
+WINDOW = 60.0
+MAX_ROLLOVER_WINDOWS = 3
+WINDOW_BATCHES = 4
+
+# The batch size is adapted so that a batch takes about TARGET_BATCH_TIME
+# seconds to write to the ground, between MIN_BATCH_SIZE and MAX_BATCH_SIZE
+# rows.
+TARGET_BATCH_TIME = 10.0
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 5000
+
+# The connection type that is assumed if none is configured
+DEFAULT_CONNECTION_TYPE = 'LinkStar'
+
+
+class TablePolicy(object):
+    """
+    The priority and per-window budget of a table.  If window_rows is not set
+    the row budget is WINDOW_BATCHES batches.  window_share limits the bytes
+    the table may send to a fraction of the estimated link capacity of each
+    window; if it is None the bytes are not limited.
+    """
+    def __init__(self, priority, window_rows=None, window_share=None, limited=True):
+        self.priority = priority
+        self.window_rows = window_rows
+        self.window_share = window_share
+        self.limited = limited
+
+
+# Commands and the state needed to operate the vehicle go first, bulk data
+# last.  Tables that aren't listed get DEFAULT_POLICY.
+POLICIES = {
+    'Command_Log': TablePolicy(0, limited=False),
+    'System_Applications_State': TablePolicy(1, limited=False),
+    'LinkStar_Duplex_State': TablePolicy(1),
+    'Location_Data': TablePolicy(1),
+    'System_Messages': TablePolicy(2),
+    'Flight_Data': TablePolicy(3),
+    'Flight_Data_Object': TablePolicy(4),
+    'Flight_Data_Binary': TablePolicy(5, window_share=0.25),
+}
+DEFAULT_POLICY = TablePolicy(3)
+
+
+class TableBudget(object):
+    """
+    A token bucket of the rows and bytes that a table may send.  The budget is
+    refilled at the rate of one window's worth per WINDOW seconds, and can
+    hold up to MAX_ROLLOVER_WINDOWS windows' worth.
+    """
+    def __init__(self, window_rows=None, window_bytes=None):
+        self.window_rows = window_rows
+        self.window_bytes = window_bytes
+        self.rows = window_rows
+        self.bytes = window_bytes
+        self.refilled = time.time()
+
+    def refill(self, window_rows=None, window_bytes=None):
+        now = time.time()
+        windows = (now - self.refilled) / WINDOW
+        self.refilled = now
+        if window_rows is not None:
+            self.window_rows = window_rows
+        if window_bytes is not None:
+            self.window_bytes = window_bytes
+        if self.window_rows is not None:
+            if self.rows is None:
+                self.rows = self.window_rows
+            self.rows = min(self.rows + windows * self.window_rows, MAX_ROLLOVER_WINDOWS * self.window_rows)
+        if self.window_bytes is not None:
+            if self.bytes is None:
+                self.bytes = self.window_bytes
+            self.bytes = min(self.bytes + windows * self.window_bytes, MAX_ROLLOVER_WINDOWS * self.window_bytes)
+
+    def available(self):
+        return (self.rows is None or self.rows >= 1) and (self.bytes is None or self.bytes > 0)
+
+    def rows_left(self, limit):
+        if self.rows is None:
+            return limit
+        return max(min(limit, int(self.rows)), 0)
+
+    def spend(self, rows, num_bytes):
+        # The bytes of a batch can't be known before it is read, so the byte
+        # budget may go negative and be paid back by later windows.
+        if self.rows is not None:
+            self.rows -= rows
+        if self.bytes is not None:
+            self.bytes -= num_bytes
+
+
+def batch_payload(rows):
+    """
+    Returns an approximation of the data that is sent to the ground for a
+    batch of rows, used to measure how well the batch compresses.
+    """
+    return '\n'.join('\t'.join(str(value) for value in row) for row in rows)
+
+
+class SyncEngine(object):
+    """
+    Synchronizes tables from the flight database (a vms_db object) to a ground
+    database (a vms_db_ground object).
+    """
+    def __init__(self, db, batch_size=DEFAULT_BATCH_SIZE, max_batches=DEFAULT_MAX_BATCHES, compress_ratio=COMPRESS_RATIO, estimator=None):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        # Set compress_ratio to 0 to never compress, or 1 to always compress
+        self.compress_ratio = compress_ratio
+
+        self.lock = threading.Lock()
+        self.table_locks = {}
+        self.watermarks = {}
+        # The tables whose watermark has been checked against the ground
+        # ledger
+        self.reconciled = set()
+        # The position of the event_key column in the rows of each table, or
+        # None if the table has no event_key and can't be synchronized
+        self.key_columns = {}
+        self.counters = {}
+        self.budgets = {}
+        # The configured and the adapted batch size of each table, and the
+        # average (estimated) number of bytes each row takes on the wire
+        self.configured_batch_sizes = {}
+        self.batch_sizes = {}
+        self.row_bytes = {}
+        if estimator is None:
+            estimator = throughput.ThroughputEstimator()
+        self.throughput = estimator
+        # The number of urgent tables that are being synchronized
+        self.urgent_active = 0
+        # An optional function that is called with a table priority and
+        # returns True if a more important sync is waiting to run
+        self.yield_check = None
+
+        # Writes the batches to the ground while the next batch is read
+        self.writer = multiprocessing.pool.ThreadPool(1)
+
+    def close(self):
+        self.writer.close()
+        self.writer.join()
+        self.throughput.close()
+
+    def _table_lock(self, table):
+        with self.lock:
+            if table not in self.table_locks:
+                self.table_locks[table] = threading.Lock()
+                self.counters[table] = {'batches': 0, 'rows': 0, 'errors': 0, 'compressed_batches': 0, 'raw_bytes': 0, 'est_wire_bytes': 0, 'preempted': 0, 'budget_exhausted': 0, 'replayed': 0, 'reconciled_rows': 0}
+                policy = self.policy(table)
+                self.budgets[table] = TableBudget(policy.window_rows)
+            return self.table_locks[table]
+
+    def _key_column(self, table):
+        """
+        Returns the position of the event_key column of a table.  The columns
+        are checked the first time a table is synchronized; a table without
+        an event_key has no watermark, so it is logged once and then skipped.
+        """
+        with self.lock:
+            if table in self.key_columns:
+                return self.key_columns[table]
+        columns = self.db.sync_columns(table)
+        if 'event_key' in columns:
+            index = list(columns).index('event_key')
+        else:
+            index = None
+            syslog.syslog(syslog.LOG_ERR, 'Unable to synchronize {} with the ground, the table has no event_key column'.format(table))
+        with self.lock:
+            return self.key_columns.setdefault(table, index)
+
+    def watermark(self, table):
+        """
+        Returns the event_key of the newest row of a table that the ground has
+        acknowledged.
+        """
+        with self.lock:
+            if table in self.watermarks:
+                return self.watermarks[table]
+
+        # The file based sync saved the key of the next row to export rather
+        # than the last row that was sent, so re-send that row; the ground
+        # skips it if it is a duplicate.  The first acknowledgement saves the
+        # watermark in the new format, so this only happens once.
+        (watermark, legacy) = self.db.sync_watermark(table)
+        if legacy:
+            watermark = max(watermark - 1, 0)
+        with self.lock:
+            return self.watermarks.setdefault(table, watermark)
+
+    def invalidate(self, table=None):
+        """
+        Forces the watermark and the columns of a table (or all tables) to be
+        re-read from the flight database.
+        """
+        with self.lock:
+            if table:
+                self.watermarks.pop(table, None)
+                self.reconciled.discard(table)
+                self.key_columns.pop(table, None)
+            else:
+                self.watermarks = {}
+                self.reconciled = set()
+                self.key_columns = {}
+
+    def _ack(self, table, key):
+        with self.lock:
+            self.watermarks[table] = key
+        self.db.ack_sync_watermark(table, key)
+
+    def _reconcile(self, table, db_ground):
+        """
+        Advances the watermark of a table to the newest chunk that the ground
+        has committed.  The ground's watermark is only trusted if the flight
+        database has the row, otherwise (for example if the flight database
+        has been re-created) the rows are sent again, and the ones the ground
+        already has are skipped.
+        """
+        watermark = self.watermark(table)
+        ground_watermark = db_ground.sync_ledger_watermark(table)
+        if ground_watermark > watermark:
+            if ground_watermark <= self.db.sync_max_key(table):
+                self._ack(table, ground_watermark)
+                with self.lock:
+                    self.counters[table]['reconciled_rows'] += ground_watermark - watermark
+            else:
+                syslog.syslog(syslog.LOG_WARNING, 'The ground has {} rows up to {} but the flight database does not, re-sending from {}'.format(table, ground_watermark, watermark))
+        with self.lock:
+            self.reconciled.add(table)
+
+    @staticmethod
+    def policy(table):
+        return POLICIES.get(table, DEFAULT_POLICY)
+
+    def _batch_size(self, table):
+        configured = self.db.session_state().num_records_download(table) or self.batch_size
+        with self.lock:
+            # Start over from the configured size if the setting was changed
+            if self.configured_batch_sizes.get(table) != configured:
+                self.configured_batch_sizes[table] = configured
+                self.batch_sizes[table] = configured
+            return int(self.batch_sizes[table])
+
+    def _connection_type(self):
+        return self.db.session_state().get('connection_type') or DEFAULT_CONNECTION_TYPE
+
+    def _adapt(self, table, conn_type, rows, est_wire_bytes, elapsed, ok):
+        """
+        Updates the throughput estimate with a completed batch and sizes the
+        next batch of the table so it takes about TARGET_BATCH_TIME seconds.
+        If the write failed the batch size is halved.
+        """
+        if ok:
+            self.throughput.record(conn_type, est_wire_bytes, elapsed)
+        rate = self.throughput.rate(conn_type)
+        with self.lock:
+            configured = self.configured_batch_sizes[table]
+            if not ok:
+                size = self.batch_sizes[table] / 2.0
+            else:
+                row_bytes = float(est_wire_bytes) / max(rows, 1)
+                if table in self.row_bytes:
+                    row_bytes = self.row_bytes[table] + 0.3 * (row_bytes - self.row_bytes[table])
+                self.row_bytes[table] = row_bytes
+                size = TARGET_BATCH_TIME * rate / max(row_bytes, 1.0)
+            self.batch_sizes[table] = min(max(size, min(MIN_BATCH_SIZE, configured)), MAX_BATCH_SIZE)
+
+    def _write(self, db_ground, table, columns, rows, compress):
+        # Runs in the writer thread, returns how long the write took and the
+        # number of rows written (0 if the ground already had the batch)
+        start = time.time()
+        written = db_ground.write_sync_rows(table, columns, rows, compress)
+        return (time.time() - start, written)
+
+    def _should_yield(self, priority):
+        if priority <= URGENT_PRIORITY:
+            return False
+        if self.urgent_active:
+            return True
+        return bool(self.yield_check and self.yield_check(priority))
+
+    def _measure(self, rows):
+        """
+        Returns (compress, raw bytes, estimated wire bytes) for a batch.  The
+        estimate is the zlib size of the payload if the batch is compressed,
+        otherwise the raw size; the real traffic is not measured.
+        """
+        payload = batch_payload(rows)
+        raw_bytes = len(payload)
+        if raw_bytes < COMPRESS_MIN_BYTES or self.compress_ratio <= 0:
+            return (False, raw_bytes, raw_bytes)
+        compressed_bytes = len(zlib.compress(payload))
+        if compressed_bytes < raw_bytes * self.compress_ratio:
+            return (True, raw_bytes, compressed_bytes)
+        return (False, raw_bytes, raw_bytes)
+
+    def sync_table(self, table, db_ground):
+        """
+        Sends the rows of a table that the ground has not acknowledged yet, up
+        to max_batches batches or the table's budget.  Returns the number of
+        rows sent, or None if the table could not be synchronized (the rows
+        will be sent with the next sync).
+        """
+        table_lock = self._table_lock(table)
+        if not table_lock.acquire(False):
+            # Another thread is already synchronizing this table
+            return 0
+
+        policy = self.policy(table)
+        urgent = policy.priority <= URGENT_PRIORITY
+        if urgent:
+            with self.lock:
+                self.urgent_active += 1
+
+        sent = 0
+        try:
+            key_column = self._key_column(table)
+            if key_column is None:
+                with self.lock:
+                    self.counters[table]['errors'] += 1
+                return None
+
+            conn_type = self._connection_type()
+            limit = self._batch_size(table)
+            budget = self.budgets[table]
+            with self.lock:
+                if policy.limited:
+                    window_bytes = None
+                    if policy.window_share:
+                        window_bytes = policy.window_share * self.throughput.rate(conn_type) * WINDOW
+                    budget.refill(policy.window_rows or limit * WINDOW_BATCHES, window_bytes)
+                else:
+                    budget = TableBudget()
+            if not budget.available():
+                with self.lock:
+                    self.counters[table]['budget_exhausted'] += 1
+                return 0
+
+            if table not in self.reconciled:
+                self._reconcile(table, db_ground)
+
+            (columns, rows) = self.db.read_sync_rows(table, self.watermark(table), budget.rows_left(limit))
+            for num in range(self.max_batches):
+                if not rows:
+                    break
+                last_key = rows[-1][key_column]
+                (compress, raw_bytes, est_wire_bytes) = self._measure(rows)
+                start = time.time()
+                pending = self.writer.apply_async(self._write, (db_ground, table, columns, rows, compress))
+                with self.lock:
+                    budget.spend(len(rows), est_wire_bytes)
+
+                # Read the next batch while the ground write is in progress,
+                # unless the budget is used up or a more important table is
+                # waiting.  A read error is only reported after this batch
+                # has been acknowledged.
+                read_error = None
+                next_rows = []
+                if num + 1 < self.max_batches:
+                    limit = self._batch_size(table)
+                    if not budget.available():
+                        with self.lock:
+                            self.counters[table]['budget_exhausted'] += 1
+                    elif self._should_yield(policy.priority):
+                        with self.lock:
+                            self.counters[table]['preempted'] += 1
+                    else:
+                        try:
+                            (columns, next_rows) = self.db.read_sync_rows(table, last_key, budget.rows_left(limit))
+                        except mysql.connector.Error as err:
+                            read_error = err
+
+                try:
+                    (elapsed, written) = pending.get()
+                except mysql.connector.Error:
+                    self._adapt(table, conn_type, len(rows), est_wire_bytes, time.time() - start, False)
+                    # The ground may have committed the batch before the
+                    # link dropped, check before it is sent again.
+                    with self.lock:
+                        self.reconciled.discard(table)
+                    raise
+                self._adapt(table, conn_type, len(rows), est_wire_bytes, elapsed, True)
+                self._ack(table, last_key)
+                with self.lock:
+                    self.counters[table]['batches'] += 1
+                    self.counters[table]['rows'] += len(rows)
+                    self.counters[table]['raw_bytes'] += raw_bytes
+                    self.counters[table]['est_wire_bytes'] += est_wire_bytes
+                    if compress:
+                        self.counters[table]['compressed_batches'] += 1
+                    if not written:
+                        self.counters[table]['replayed'] += 1
+                sent += len(rows)
+
+                if read_error:
+                    raise read_error
+                rows = next_rows
+            return sent
+        except mysql.connector.Error as err:
+            with self.lock:
+                self.counters[table]['errors'] += 1
+            print("MySQL Error: {}".format(err))
+            syslog.syslog(syslog.LOG_ERR, 'Error synchronizing {} with the ground after {} rows: {}'.format(table, sent, err))
+            return None
+        finally:
+            if urgent:
+                with self.lock:
+                    self.urgent_active -= 1
+            table_lock.release()
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for table in self.counters:
+                budget = self.budgets[table]
+                stats[table] = dict(self.counters[table], watermark=self.watermarks.get(table), priority=self.policy(table).priority, batch_size=int(self.batch_sizes.get(table, 0)), budget_rows=budget.rows, budget_bytes=budget.bytes)
+            return stats
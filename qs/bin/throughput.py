@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+A module that estimates the throughput of the link to the ground.
+
+The ground may be reached over Ethernet or over the LinkStar duplex modem (a
+PPP link of a few kbit/s), so the throughput is tracked separately for each
+connection type.  Each completed transfer updates an exponentially weighted
+moving average of bytes per second.  The estimates are saved to a file so that
+the first syncs after a restart are sized correctly.
+"""
+
+import json
+import os
+import os.path
+import syslog
+import threading
+import time
+
+# Disable some pylint warnings that I don't care about
+# pylint: disable=line-too-long,fixme,invalid-name
+
+DEFAULT_FILENAME = '/opt/qs/tmp/sync_throughput.json'
+
+# The estimates (bytes/sec) used until a connection type has been measured.
+# The LinkStar PPP link runs at 19200 baud, but the effective rate over the
+# satellite is much lower.
+DEFAULT_RATES = {
+    'Ethernet': 100000.0,
+    'LinkStar': 1000.0,
+}
+DEFAULT_RATE = 1000.0
+
+# Transfers smaller than this are dominated by latency rather than bandwidth
+# and are not used to update the estimate.
+MIN_SAMPLE_BYTES = 256
+
+
+class ThroughputEstimator(object):
+    """
+    Tracks the throughput (bytes/sec) of each connection type.  alpha is the
+    weight of a new measurement in the moving average.
+    """
+    def __init__(self, filename=DEFAULT_FILENAME, alpha=0.3, save_interval=300.0):
+        self.filename = filename
+        self.alpha = alpha
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.estimates = {}
+        self.saved_at = time.time()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                estimates = json.load(f)
+            with self.lock:
+                for (conn_type, estimate) in estimates.items():
+                    self.estimates[conn_type] = {
+                        'rate': float(estimate['rate']),
+                        'samples': int(estimate.get('samples', 0)),
+                        'updated': float(estimate.get('updated', 0.0)),
+                    }
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError) as err:
+            syslog.syslog(syslog.LOG_ERR, 'Error loading throughput estimates from {}: {}'.format(self.filename, err))
+
+    def save(self):
+        if not self.filename:
+            return
+        with self.lock:
+            data = json.dumps(self.estimates, indent=1, sort_keys=True)
+            self.dirty = False
+            self.saved_at = time.time()
+        try:
+            dirname = os.path.dirname(self.filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'w') as f:
+                f.write(data)
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError) as err:
+            syslog.syslog(syslog.LOG_ERR, 'Error saving throughput estimates to {}: {}'.format(self.filename, err))
+
+    def record(self, conn_type, num_bytes, elapsed):
+        """
+        Updates the estimate of a connection type with a completed transfer.
+        """
+        if num_bytes < MIN_SAMPLE_BYTES or elapsed <= 0:
+            return
+        rate = num_bytes / elapsed
+        with self.lock:
+            estimate = self.estimates.get(conn_type)
+            if estimate is None:
+                estimate = {'rate': rate, 'samples': 0, 'updated': 0.0}
+                self.estimates[conn_type] = estimate
+            else:
+                estimate['rate'] += self.alpha * (rate - estimate['rate'])
+            estimate['samples'] += 1
+            estimate['updated'] = time.time()
+            self.dirty = True
+            save = (time.time() - self.saved_at) >= self.save_interval
+        if save:
+            self.save()
+
+    def rate(self, conn_type):
+        """
+        Returns the estimated throughput of a connection type in bytes/sec.
+        """
+        with self.lock:
+            estimate = self.estimates.get(conn_type)
+            if estimate:
+                return estimate['rate']
+        return DEFAULT_RATES.get(conn_type, DEFAULT_RATE)
+
+    def close(self):
+        if self.dirty:
+            self.save()
+
+    def stats(self):
+        with self.lock:
+            return dict((conn_type, dict(estimate)) for (conn_type, estimate) in self.estimates.items())
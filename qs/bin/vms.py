@@ -9,14 +9,21 @@ import time
 import datetime
 import json
 import syslog
-import importlib
 import operator
 import multiprocessing
 import subprocess
+import os.path
 
 import vms_db
+import data_export
+import query_stats
+import sync_engine
+import sync_coordinator
+import command_dispatcher
+import command_workers
 import periodic_timer
-import vms_db_ground
+import scheduler
+import ground_session
 import ls_comm_flight_stream
 import linkstar
 import linkstarstx3
@@ -38,6 +45,30 @@ from random import randint
 time_set = False
 packetDitherTimeUpper = 10
 
+# Where the per-query database statistics are written
+QUERY_STATS_FILE = '/opt/qs/tmp/query_stats.json'
+
+# The number of periodic jobs that may run at the same time.  Some jobs block
+# for a long time (the ground sync, setting the time from the GPS), so leave
+# enough workers for the command processing to keep running.
+SCHEDULER_WORKERS = 6
+
+# How long to wait for the jobs that are stopped when the timing is reset to
+# finish their current run
+RECONFIG_STOP_TIMEOUT = 30.0
+
+# The number of commands that may run at the same time
+COMMAND_WORKERS = 4
+
+# The worker processes that run the custom "MODULE.CMD" commands, the handler
+# modules they import when they start, the number of commands each worker runs
+# before it is replaced, and how long a custom command may run before its
+# worker is killed
+CUSTOM_COMMAND_WORKERS = 2
+CUSTOM_COMMAND_MODULES = ('mcp', 'vms_file', 'stx3', 'generic')
+CUSTOM_COMMAND_MAX = 100
+CUSTOM_COMMAND_TIMEOUT = 3600
+
 # DEFINE GLOBAL VARIABLE to track the alarm count.  This is used as part of the countdown for 
 #    transmitting the alarm every 5 minutes.   Note delays are not used along with setting up
 #    a separate thread because we want to turn off the alarm as soon as possible when the alarm state goes to zero
@@ -66,58 +97,9 @@ def isfloat(value):
   except ValueError:
     return False
 
-def unknown_command_wrapper(db_args, cmd, thread_run_event):
-    status = 5
-
-    local_db = vms_db.vms_db(**db_args)
-    
-    # If the command is "STRING.STRING", split the string and attempt
-    # to import a module to handle the command.
-    subcmd = cmd['command'].lower().split('.', 2)
-    if len(subcmd) == 2:
-        # pylint: disable=bare-except
-        try:
-            m = importlib.import_module(subcmd[0])
-            cmd_process_func = getattr(m, 'process')
-        except KeyboardInterrupt as e:
-            raise e
-        except:
-            status = 3
-            # The previous statements could fail if a custom command
-            # package is not defined, or if it does not have a process
-            # function defined.
-            local_db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
-            cmd_process_func = None
-
-        if cmd_process_func:
-            try:
-                result = cmd_process_func(local_db, subcmd[1], cmd['data'], thread_run_event)
-                status = int(not result)
-                local_db.complete_commands(cmd, result)
-            except KeyboardInterrupt as e:
-                raise e
-            except:
-                # Ensure that the threads are not stuck paused
-                thread_run_event.set()
-
-                status = 4
-                local_db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
-    else:
-        status = 2
-        # This is not a custom command, just log it as an unknown error
-        msg = 'Unknown command {}:{}'.format(cmd['command'], cmd)
-        local_db.complete_commands(cmd, False, msg)
-
-    return status
-
-
-
-
 class vms(object):
     # pylint: disable=unused-argument,too-many-instance-attributes,too-many-statements
-    def __init__(self, vms_address, vms_port, vms_cert, vms_username, vms_password, vms_dbname, flight_stream_flag, **kwargs):
-        
-        global packetDitherTimeUpper
+    def __init__(self, vms_address, vms_port, vms_cert, vms_username, vms_password, vms_dbname, flight_stream_flag, vms_pool_size=None, **kwargs):
         
         # Save the arguments
         self.args = {
@@ -127,7 +109,8 @@ class vms(object):
                 'username': vms_username,
                 'password': vms_password,
                 'cert': vms_cert,
-                'dbname': vms_dbname
+                'dbname': vms_dbname,
+                'pool_size': vms_pool_size
             },
             'vms_ground': {
                 'address': '159.118.1.204',
@@ -146,54 +129,15 @@ class vms(object):
 
         # Connect to the QS/VMS DB
         self.db = vms_db.vms_db(**self.args['vms'])
+        # Copies new rows of the flight tables to the ground database
+        self.sync_engine = sync_engine.SyncEngine(self.db)
+        self.ground_session = None
 
-        # Determine if LinkStar Duplex Radio is installed - first get the data if the radio is installed
-        ls_duplex_installed = self.db.ls_duplex_installed_state()
-        print "LinkStar duplex Installed Flag" + str(ls_duplex_installed)
-
-        # Determine if LinkStar Simplex STX Radio is installed - first get the data if the radio is installed
-        ls_simplexstx3_installed = self.db.ls_simplexstx3_installed_state()
-        
-        if ls_simplexstx3_installed == 1:
-            radio_space_use = self.db.check_radio_space_use()
-        
-        # Check if bypassing the GPS. IF ALLOWED AND BYPASSING THE GPS do not get the time 
-        #    or set the time - there is no GPS to access the time from
-        gpsByPassAllowed = self.db.gps_bypass_allowed()
-        print "BY PASS VALUE: " + str(gpsByPassAllowed)
-
-        # Determine if GPS is installed
-        vms_gps_state = self.db.gps_installed_state()
-        print "gps_installed_state " + str(vms_gps_state)
+        self.linkstar = None
+        self.linkstarSTX3 = None
+        self.vms_gps = None
+        self.db_ground = None
 
-        if ls_duplex_installed == 1:
-            print "LinkStar Duplex INSTALLED"
-            self.linkstar = linkstar.linkstar(**self.args['vms'])
-        else: 
-            print "LinkStar Duplex NOT Installed"
-            
-        # IF the SIMPLEX, LinkStar-STX3 is installed, define class
-        if ls_simplexstx3_installed == 1:
-            print "LinkStar-STX3 INSTALLED"
-            self.linkstarSTX3 = linkstarstx3.linkstarSTX3()
-        else: 
-            print "LinkStar-STX3 NOT Installed"
-
-        # IF the duplex radio is installed, get the ground server arguments
-        if ls_duplex_installed == 1:
-            gs_args = self.db.get_db_ground_args()
-            print gs_args
-            self.args['vms_ground'] = {
-                'address': gs_args['server'],
-                'port': vms_port,
-                'username': gs_args['username'],
-                'password': 'quicksat1',
-                'cert': vms_cert,
-                'dbname': vms_dbname
-            }
-            #self.db_ground = vms_db_ground.vms_db_ground(**self.args['vms_ground'])
-            self.db_ground = None
-            
         # Define ls_comm_flight_stream
         #if flight_stream_flag == 'ENABLED':
         #    self.db_fS = ls_comm_flight_stream.ls_comm_flight_stream(**self.args['lsav'])
@@ -201,183 +145,307 @@ class vms(object):
         # Some mechanisms to allow threads to be paused by a command handler
         self.thread_run_event = multiprocessing.Event()
 
-        # Keep track of the unknown command processes to ensure they aren't
-        # deleted by the garbage collector.
-        self.cmd_processes = []
+        # Runs the periodic jobs, the pausable jobs are not run while a
+        # command handler has cleared the thread_run_event
+        self.scheduler = scheduler.Scheduler(SCHEDULER_WORKERS, self.thread_run_event)
+
+        # Runs the custom "MODULE.CMD" commands in long-lived worker processes
+        self.command_workers = command_workers.CommandWorkers(self.args['vms'], self.thread_run_event, self.db.complete_commands, CUSTOM_COMMAND_WORKERS, CUSTOM_COMMAND_MODULES, CUSTOM_COMMAND_MAX, CUSTOM_COMMAND_TIMEOUT)
+
+        # Runs the commands claimed by the command monitor
+        self.dispatcher = command_dispatcher.CommandDispatcher(COMMAND_WORKERS, self.db.complete_commands, lambda cmd: self.handle_unknown_command(cmd['command'], cmd))
+        self.register_commands()
 
-        self.threads = []
+        # The periodic jobs by name, and the installation and rate settings
+        # they were set up with.  When the timing is reset only the jobs
+        # whose settings changed are rescheduled or restarted.
+        self.timers = {}
+        self.config = {}
+        self.started = False
+        self.packet_group_timer = None
+        self.process_timer = None
+        self.sync_coordinator = None
 
         # Open the syslog
         syslog.openlog()
         syslog.syslog(syslog.LOG_NOTICE, 'Started')
 
-        print "---> Duplex setup if installed "
-        # IF the duplex radio is installed, send the duplex information to the ground periodically
-        if ls_duplex_installed == 1:
-            print "DUPLEX INSTALLED -  SYNC STATE"
-            # Linkstar duplex state pushing uses command_log_rate
-            t = periodic_timer.PeriodicTimer(self.sync_linkstar_duplex_state, 49)
-            self.threads.append(t)
-
-        # IF the duplex radio is installed, update the location information between the radio and location tables
-        if ls_duplex_installed == 1:
-            # For now location information update rate is fixed at every 60 sec
-            print "DUPLEX INSTALLED -  UPDATE LOCATION *****"
-            print "update location loop"
-            t = periodic_timer.PeriodicTimer(self.update_linkstar_location_tables, 53)
-            self.threads.append(t)
-
-        # IF the duplex radio is installed, sync the location with the ground
-        if ls_duplex_installed == 1:
-            # System_Messages uses command_syslog_push_rate
-            print "DUPLEX INSTALLED -  SYNC LOCATION *****"
-            print "sync location"
-            t = periodic_timer.PeriodicTimer(self.sync_location_table, 22)
-            self.threads.append(t)
-        
-        print "----> Activate GPS loop if installed"
-        # IF GPS is installed start tracking GPS location data
-        if (vms_gps_state is not None) and ( vms_gps_state['gps_type'] != 'NONE'):
-            if (vms_gps_state['gps_type'] == 'ADAFRUIT'):
-                self.vms_gps = vms_gps.GPS()
-            elif (vms_gps_state['gps_type'] == 'NOVATEL'):
-                self.vms_gps = vms_gps_novatel.GPS()
-
-            t = periodic_timer.PeriodicTimer(self.update_gps_data, vms_gps_state['sample_rate'])
-            self.threads.append(t)
+        self.configure(self.read_config())
 
-        print "----> Command Monitor"
-        # For now, use the command poll rate to run the "command log monitor" function
-        t = periodic_timer.PeriodicTimer(self.process, self.db.retrieve_command_log_poll_rate())
-        self.threads.append(t)
+    def read_config(self):
+        """
+        Reads the installation and rate settings that the periodic jobs are
+        set up with.
+        """
+        config = {}
 
-        # Use a pre-defined radio status poll time for now
-        if ls_duplex_installed == 1:
-            print "----> Duplex Radio Status loop"
-            t = periodic_timer.PeriodicTimer(self.radio_status, 35)
-            self.threads.append(t)
+        # Determine if LinkStar Duplex Radio is installed - first get the data if the radio is installed
+        config['duplex'] = self.db.ls_duplex_installed_state() == 1
+        print "LinkStar duplex Installed Flag" + str(config['duplex'])
 
-        # Flight_Data and Flight_Data_Object use data_download_push_rate
-        if ls_duplex_installed == 1:
-            t = periodic_timer.PeriodicTimer(self.sync_flight_data, self.db.retrieve_data_download_push_rate())
-            self.threads.append(t)
+        # Determine if LinkStar Simplex STX Radio is installed - first get the data if the radio is installed
+        config['stx3'] = self.db.ls_simplexstx3_installed_state() == 1
+        if config['stx3']:
+            config['space_use'] = self.db.check_radio_space_use()
+            config['packet_group_timing'] = self.packet_group_timing()
 
-        if ls_duplex_installed == 1:
-            t = periodic_timer.PeriodicTimer(self.sync_flight_data_object, self.db.retrieve_data_download_push_rate())
-            self.threads.append(t)
+        # Determine if GPS is installed
+        vms_gps_state = self.db.gps_installed_state()
+        print "gps_installed_state " + str(vms_gps_state)
+        if (vms_gps_state is not None) and (vms_gps_state['gps_type'] != 'NONE'):
+            config['gps_type'] = vms_gps_state['gps_type']
+            config['gps_sample_rate'] = vms_gps_state['sample_rate']
+
+        config['command_poll_rate'] = self.db.retrieve_command_log_poll_rate()
+        return config
+
+    def configure(self, config):
+        """
+        Sets up the periodic jobs and devices for the settings in config.  The
+        settings are compared with the settings the jobs are running with, the
+        radios and the GPS are only set up again if they were installed or
+        removed (or the GPS type changed), and only the delay is changed if a
+        rate changed.  Returns the names of the settings that changed.
+        """
+        global packetDitherTimeUpper
 
-        # Flight_Data_Binary uses binary_data_push_rate
-        if ls_duplex_installed == 1:
-            t = periodic_timer.PeriodicTimer(self.sync_flight_data_binary, self.db.retrieve_binary_data_push_rate())
-            self.threads.append(t)
+        old = self.config
+        changed = sorted(k for k in set(config) | set(old) if config.get(k) != old.get(k))
+
+        if 'duplex' in changed:
+            if old.get('duplex'):
+                self.stop_duplex()
+            if config['duplex']:
+                self.start_duplex()
+
+        if 'gps_type' in changed:
+            if old.get('gps_type'):
+                self.stop_gps()
+            if config.get('gps_type'):
+                self.start_gps(config['gps_type'], config['gps_sample_rate'])
+        elif 'gps_sample_rate' in changed:
+            self.timers['update_gps_data'].delay = config['gps_sample_rate']
+
+        if 'command_poll_rate' in changed:
+            if self.process_timer:
+                self.process_timer.delay = config['command_poll_rate']
+            else:
+                print "----> Command Monitor"
+                # For now, use the command poll rate to run the "command log monitor" function.  If
+                # a poll overruns, the missed polls are combined into one poll right away.
+                self.process_timer = self.add_timer('process', self.process, config['command_poll_rate'], fixed_rate=True, overrun=scheduler.OVERRUN_COALESCE)
+
+        if 'stx3' in changed:
+            if old.get('stx3'):
+                self.stop_stx3()
+            if config['stx3']:
+                self.start_stx3(config['space_use'], config['packet_group_timing'])
+        elif config['stx3']:
+            if 'space_use' in changed:
+                self.set_stx3_channel(config['space_use'])
+            if 'packet_group_timing' in changed:
+                (packetGroupXmitRate, packetDitherTimeUpper) = config['packet_group_timing']
+                self.packet_group_timer.delay = packetGroupXmitRate
+
+        # Remove old rows from the Location_Data and STX3 message history
+        # tables.  This is low priority so it runs infrequently and deletes
+        # the rows in small chunks.
+        if 'prune_tables' not in self.timers:
+            print "----> Table retention"
+            self.add_timer('prune_tables', self.prune_tables, 300, pausable=True, fixed_rate=True)
+
+        self.config = config
+        return changed
+
+    def reconfigure(self):
+        """
+        Re-reads the settings after the timing has been reset and updates the
+        periodic jobs that are affected.
+        """
+        self.db.invalidate_session_state()
+        self.db.settings.invalidate()
+        # pylint: disable=bare-except
+        try:
+            changed = self.configure(self.read_config())
+            syslog.syslog(syslog.LOG_NOTICE, 'Timing reset, changed settings: {}'.format(', '.join(changed) or 'none'))
+        except KeyboardInterrupt as e:
+            raise e
+        except:
+            syslog.syslog(syslog.LOG_ERR, 'Error reconfiguring after a timing reset: {}'.format(traceback.format_exception(*sys.exc_info())))
+
+    def add_timer(self, name, action, delay, **kwargs):
+        # Timers added after the VMS has started are started right away
+        self.stop_timers(name)
+        t = periodic_timer.PeriodicTimer(action, delay, scheduler=self.scheduler, name=name, **kwargs)
+        self.timers[name] = t
+        if self.started:
+            t.start()
+        return t
+
+    def stop_timers(self, *names):
+        """
+        Stops the named timers, and waits up to RECONFIG_STOP_TIMEOUT seconds
+        for the ones that are running to finish.
+        """
+        timers = [(name, self.timers.pop(name)) for name in names if name in self.timers]
+        for (_, t) in timers:
+            t.stop(False)
+        deadline = time.time() + RECONFIG_STOP_TIMEOUT
+        for (name, t) in timers:
+            if not t.join(max(deadline - time.time(), 0)):
+                syslog.syslog(syslog.LOG_WARNING, 'Timer {} is still running after it was stopped'.format(name))
+
+    def start_duplex(self):
+        print "LinkStar Duplex INSTALLED"
+        self.linkstar = linkstar.linkstar(**self.args['vms'])
+        self.linkstar.state_changed = self.db.invalidate_session_state
+
+        # The ground connection is opened the first time the link is up
+        # and kept open for as long as the ground server stays the same
+        self.ground_session = ground_session.GroundSession(self.db, self.args['vms']['port'], self.args['vms']['cert'], self.args['vms']['dbname'])
+        self.args['vms_ground'] = self.ground_session.server_args()
+        print self.args['vms_ground']
+        self.db_ground = None
 
-        # Command_Log_ground_to_sv uses command_poll_rate
-        if ls_duplex_installed == 1:
-            t = periodic_timer.PeriodicTimer(self.sync_command_log_ground_to_sv, self.db.retrieve_command_log_poll_rate())
-            self.threads.append(t)
+        print "---> Duplex setup if installed "
+        # For now location information update rate is fixed at every 60 sec
+        print "DUPLEX INSTALLED -  UPDATE LOCATION *****"
+        print "update location loop"
+        self.add_timer('update_linkstar_location_tables', self.update_linkstar_location_tables, 53, pausable=True, fixed_rate=True)
 
+        # Use a pre-defined radio status poll time for now
+        print "----> Duplex Radio Status loop"
+        self.add_timer('radio_status', self.radio_status, 35, pausable=True, fixed_rate=True)
+
+        # Sync the flight database with the ground.  One coordinator checks
+        # the radio status and the ground connection once per cycle and runs
+        # all of the sync jobs that are due, each at its own rate.
+        print "DUPLEX INSTALLED -  SYNC COORDINATOR *****"
+        self.sync_coordinator = sync_coordinator.SyncCoordinator(self.ground_link_available, self.thread_run_event)
+        # Let bulk tables give up the link when a more important job is due
+        self.sync_engine.yield_check = self.sync_coordinator.higher_priority_due
+        # Linkstar duplex state pushing uses command_log_rate
+        self.add_table_sync('LinkStar_Duplex_State', 49)
+        self.add_table_sync('Location_Data', 22, pausable=False)
+        # Flight_Data and Flight_Data_Object use data_download_push_rate
+        self.add_table_sync('Flight_Data', self.db.retrieve_data_download_push_rate)
+        self.add_table_sync('Flight_Data_Object', self.db.retrieve_data_download_push_rate)
+        # Flight_Data_Binary uses binary_data_push_rate
+        self.add_table_sync('Flight_Data_Binary', self.db.retrieve_binary_data_push_rate)
+        # Command_Log_ground_to_sv uses command_poll_rate, and also rides
+        # along with every other sync while the link is up so commands
+        # sent during a link window arrive within seconds
+        self.sync_coordinator.add_job('Command_Log ground to sv', self._sync_command_log_ground_to_sv, self.db.retrieve_command_log_poll_rate, pausable=False, priority=0, piggyback=True)
         # Command_Log_sv_to_ground uses command_push_rate
-        if ls_duplex_installed == 1:
-            t = periodic_timer.PeriodicTimer(self.sync_command_log_sv_to_ground, self.db.retrieve_command_log_push_rate())
-            self.threads.append(t)
-
+        self.add_table_sync('Command_Log', self.db.retrieve_command_log_push_rate, pausable=False)
         # System_Messages uses command_syslog_push_rate
-        if ls_duplex_installed == 1:
-            t = periodic_timer.PeriodicTimer(self.sync_system_messages, self.db.retrieve_command_syslog_push_rate())
-            self.threads.append(t)
+        self.add_table_sync('System_Messages', self.db.retrieve_command_syslog_push_rate, pausable=False)
+        self.sync_coordinator.add_job('Recording_Sessions', self._sync_vms_recording_sessions, 37, priority=2)
+        # Update the ground station Systems_Application table - this tells
+        # the ground station the state of the applications on the SV.
+        self.add_table_sync('System_Applications_State', 38, pausable=False)
+
+        self.add_timer('sync_coordinator', self.sync_coordinator.run_cycle, sync_coordinator.MIN_CYCLE_DELAY)
+        self.add_timer('ground_keepalive', self.ground_session.keepalive, ground_session.PING_INTERVAL)
+
+    def stop_duplex(self):
+        print "LinkStar Duplex NOT Installed"
+        self.stop_timers('update_linkstar_location_tables', 'radio_status', 'sync_coordinator', 'ground_keepalive')
+        self.sync_engine.yield_check = None
+        self.sync_coordinator = None
+        self.db_ground = None
+        if self.ground_session:
+            self.ground_session.close()
+            self.ground_session = None
+        self.linkstar = None
 
-        # recording_sessions uses command_syslog_push_rate
-        if ls_duplex_installed == 1:
-            t = periodic_timer.PeriodicTimer(self.sync_vms_recording_sessions, 37)
-            self.threads.append(t)
+    def start_gps(self, gps_type, sample_rate):
+        print "----> Activate GPS loop if installed"
+        # IF GPS is installed start tracking GPS location data
+        if gps_type == 'ADAFRUIT':
+            self.vms_gps = vms_gps.GPS()
+        elif gps_type == 'NOVATEL':
+            self.vms_gps = vms_gps_novatel.GPS()
+        self.add_timer('update_gps_data', self.update_gps_data, sample_rate, fixed_rate=True)
 
-        # Systems_Applications uses retrieve_command_log_poll_rate
-        #    Update the ground station Systems_Application table - this tells the ground station the state of the applications on the SV.
-        #
+        # IF GPS is installed set the system time.  Because the time may not be correct at the start, and the system
+        #    can experience a restart we will check set and the time every two minutes
+        print "tttt ---> Set GPS time"
+        self.add_timer('set_ls_system_time', self.set_ls_system_time, 120)
 
-        if ls_duplex_installed == 1:
-            t = periodic_timer.PeriodicTimer(self.update_system_applications_state_to_gnd, 38)
-            self.threads.append(t)
+    def stop_gps(self):
+        self.stop_timers('update_gps_data', 'set_ls_system_time')
+        self.vms_gps = None
+
+    def start_stx3(self, space_use, timing):
+        global packetDitherTimeUpper
+
+        print "LinkStar-STX3 INSTALLED"
+        self.linkstarSTX3 = linkstarstx3.linkstarSTX3()
 
         print "---> Set up STX3 if installed"
-        # IF the SIMPLEX, LinkStar-STX3 is installed, beacon create a data packet group and transmit to the ground
-        if ls_simplexstx3_installed == 1:
-            # Get GSN number of the STX3 module and write it to the stepSATdb_Flight database
-            
-            #radioGSN ='0-1234567'
-            radioGSN = self.linkstarSTX3.stx3_command('AT+GSN?')
-            radioGSN_val = radioGSN.split(": ",1)[1]
-            self.db.update_gsn(radioGSN_val)
-            
-            # Get the packet_group_xmit_rate...this sets the frequency the packet transmission is done.
-            #    We will also use this to set the random, "dithering", time of the 
-            #    the packet sent to the ground.  This dithering factor is based on the timing between messages
-            #    to a limit of up to 5 minute dither
-            
-            packetGroupXmitRate = self.db.retrieve_packet_group_xmit_rate()
-            number_repeats_val = self.db.retrieve_linkstar_simplex_info('maximum_repeats')
-            repeat_delay_val = self.db.retrieve_linkstar_simplex_info('repeat_delay')
-            print "The baseline transmit rate is ", str(packetGroupXmitRate),", and the Number of Repeats is ", str(number_repeats_val)," and the repeat time is ", str(repeat_delay_val)
+        # Get GSN number of the STX3 module and write it to the stepSATdb_Flight database
 
-            packetGroupXmitRate = packetGroupXmitRate - (number_repeats_val * repeat_delay_val)
-            print "---> The net packet delay time is ", str(packetGroupXmitRate)
-            
-            t=periodic_timer.PeriodicTimer(self.transmit_packet_group, packetGroupXmitRate)
-            if packetGroupXmitRate < 3600:
-                packetDitherTimeUpper = int( 0.0666667 * float(packetGroupXmitRate))
-                print "The packetDitherTimeUpper is -----> ", packetDitherTimeUpper
-            else:
-                packetDitherTimeUpper = 600
-            self.threads.append(t)
+        #radioGSN ='0-1234567'
+        radioGSN = self.linkstarSTX3.stx3_command('AT+GSN?')
+        radioGSN_val = radioGSN.split(": ",1)[1]
+        self.db.update_gsn(radioGSN_val)
+
+        # Get the packet_group_xmit_rate...this sets the frequency the packet transmission is done.
+        #    We will also use this to set the random, "dithering", time of the
+        #    the packet sent to the ground.  This dithering factor is based on the timing between messages
+        #    to a limit of up to 5 minute dither
+        (packetGroupXmitRate, packetDitherTimeUpper) = timing
+        self.packet_group_timer = self.add_timer('transmit_packet_group', self.transmit_packet_group, packetGroupXmitRate, fixed_rate=True)
+
+        # If the repeat settings are changed, adjust the transmit rate
+        # without restarting
+        self.db.settings.add_listener(self.simplex_settings_changed)
+
+        self.set_stx3_channel(space_use)
+        self.linkstarSTX3.stx3_CBTMIN(280)                     # required by Globalstar
+        self.linkstarSTX3.stx3_CBTMAX(540)                     # required by Globalstar
+        self.linkstarSTX3.stx3_number_burst_transmissions(3)   # required by Globalstar
 
-        # Set Channel based on space use
-        if ls_simplexstx3_installed == 1:
-            if radio_space_use == 1:
-                print "Channel C"
-                stx3Channel = 2
-                # channel "2" is Channel C to be used in SPACE AT ALL TIMES!!!
-            else:
-                print "Channel A"
-                stx3Channel = 0
-                
-            self.linkstarSTX3.stx3_set_channel( stx3Channel )
-            self.linkstarSTX3.stx3_CBTMIN(280)                     # required by Globalstar
-            self.linkstarSTX3.stx3_CBTMAX(540)                     # required by Globalstar
-            self.linkstarSTX3.stx3_number_burst_transmissions(3)   # required by Globalstar
-        
         # Set loop to monitor alarm and timing/transmit changes
-        if ls_simplexstx3_installed == 1:
-            t=periodic_timer.PeriodicTimer(self.stx3_state_change_monitor, 20)      # Check the timing change and the alarm state every 20 seconds
-            self.threads.append(t)
-            
+        self.add_timer('stx3_state_change_monitor', self.stx3_state_change_monitor, 20, fixed_rate=True)      # Check the timing change and the alarm state every 20 seconds
+
         # IF the SIMPLEX, LinkStar-STX3 is installed, beacon create a data packet group and transmit to the ground
         #if ls_simplexstx3_installed == 1:
         #        t=periodic_timer.PeriodicTimer(self.transmit_alarm_packet, 120)
         #        self.threads.append(t)
 
-        # IF GPS is installed set the system time.  Because the time may not be correct at the start, and the system
-        #    can experience a restart we will check set and the time every two minutes
-        
-        
-        if (vms_gps_state is not None) and ( vms_gps_state['gps_type'] != 'NONE'):            
-            # set system time
-            print "tttt ---> Set GPS time"
-            t=periodic_timer.PeriodicTimer(self.set_ls_system_time, 120)
-            self.threads.append(t)
+    def stop_stx3(self):
+        print "LinkStar-STX3 NOT Installed"
+        self.db.settings.remove_listener(self.simplex_settings_changed)
+        self.stop_timers('transmit_packet_group', 'stx3_state_change_monitor')
+        self.packet_group_timer = None
+        self.linkstarSTX3 = None
+
+    def set_stx3_channel(self, space_use):
+        # Set Channel based on space use
+        if space_use == 1:
+            print "Channel C"
+            stx3Channel = 2
+            # channel "2" is Channel C to be used in SPACE AT ALL TIMES!!!
+        else:
+            print "Channel A"
+            stx3Channel = 0
 
+        self.linkstarSTX3.stx3_set_channel( stx3Channel )
 
     def __del__(self):
-        for t in self.threads:
-            t.stop()
-        for proc in self.cmd_processes[:]:
-            proc.kill()
+        self.shutdown()
+        self.sync_engine.close()
+        if self.ground_session:
+            self.ground_session.close()
         syslog.syslog(syslog.LOG_NOTICE, 'Shutting down')
         syslog.closelog()
 
-    def radio_status(self):
-        # Check if this thread should be running or paused
-        self.thread_run_event.wait()
+    def prune_tables(self):
+        self.db.retention.run()
 
+    def radio_status(self):
         # Have the VMS DB connection retrieve and update the radio status
         self.linkstar.get_radio_status()
         # Keep the poll rate constant for now, it shouldn't change
@@ -385,178 +453,172 @@ class vms(object):
 
     def run(self):
         self.thread_run_event.set()
-        for t in self.threads:
+        # Start the worker processes before the jobs start running
+        self.command_workers.start()
+        for t in self.timers.values():
             t.start()
-        runSys = True
+        self.started = True
+        self.scheduler.start()
+        self.dispatcher.start()
+        loops = 0
         try:
-            while runSys:
+            while True:
                 time.sleep(30.0)
-                # Check if timing changed.  If changed, restart vms
+                # Log the connection pool usage and query statistics every 5
+                # minutes
+                loops += 1
+                if loops % 10 == 0:
+                    self.log_pool_stats()
+                    self.log_query_stats()
+                    self.log_sync_stats()
+                    self.log_scheduler_stats()
+                    self.log_command_stats()
+                    self.log_command_workers_stats()
+
+                # Check if timing changed.  If changed, update the jobs whose
+                # settings changed, the rest keep running
                 timingChanged = self.db.check_timing_reset()
                 if timingChanged == 1:
                     print "@@@@@@@@ TIMING CHANGED @@@@@@@@"
                     # set timing_reset flag to zero
                     self.db.zero_timing_reset_flag()
-                    # restart command processing
-                    for t in self.threads:
-                        t.stop()
-                    self.threads = []
-
-                    for proc in self.cmd_processes:
-                        proc.kill()
-                    self.cmd_processes = []
-                    
-                    runSys = False
-                else: 
-                    runSys = True
-
-        except KeyboardInterrupt:
-            for t in self.threads:
-                t.stop()
-            self.threads = []
-
-            for proc in self.cmd_processes:
-                proc.kill()
-            self.cmd_processes = []
-
-            raise
-            
+                    self.reconfigure()
+
+        finally:
+            # Whatever ended the loop, don't leave the jobs, the command
+            # threads or the worker processes running
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        Stops the periodic jobs, the command dispatcher and the command worker
+        processes.  The jobs and commands that are running are given up to
+        RECONFIG_STOP_TIMEOUT seconds to finish.
+        """
+        for t in self.timers.values():
+            t.stop(False)
+        self.timers = {}
+        self.scheduler.stop(True, RECONFIG_STOP_TIMEOUT)
+        self.dispatcher.stop(True, RECONFIG_STOP_TIMEOUT)
+        self.command_workers.stop()
+
+    def log_pool_stats(self):
+        pools = [self.db]
+        if getattr(self, 'db_ground', None):
+            pools.append(self.db_ground)
+        for db in pools:
+            stats = db.pool_stats()
+            syslog.syslog(syslog.LOG_INFO, 'DB pool {host}: size={size}, created={created}, in use={in_use} (max {max_in_use}), checkouts={checkouts}, waits={waits}, avg wait={avg_wait:.4f}s (max {max_wait:.4f}s), reconnects={reconnects}'.format(**stats))
+
+    def log_scheduler_stats(self):
+        stats = self.scheduler.stats()
+        syslog.syslog(syslog.LOG_INFO, 'Scheduler: workers={workers}, busy={busy}, queued={queued}, paused={paused}'.format(**stats))
+        for (name, job) in sorted(stats['jobs'].items()):
+            syslog.syslog(syslog.LOG_INFO, 'Job {}: state={state}, {mode} delay={delay}, runs={runs}, errors={errors}, paused={paused}, avg={avg_time:.3f}s, max={max_time:.3f}s, avg late={avg_lateness:.3f}s, max late={max_lateness:.3f}s, overruns={overruns}, missed ticks={missed}, avg jitter={avg_jitter:.3f}s, max jitter={max_jitter:.3f}s'.format(name, **job))
+
+    def log_command_stats(self):
+        stats = self.dispatcher.stats()
+        syslog.syslog(syslog.LOG_INFO, 'Commands: workers={workers}, pending={pending}, running={running}, abandoned={abandoned}'.format(**stats))
+        for (name, ctype) in sorted(stats['types'].items()):
+            if ctype['submitted']:
+                syslog.syslog(syslog.LOG_INFO, 'Command {}: group={group}, submitted={submitted}, completed={completed}, errors={errors}, timeouts={timeouts}, cancels={cancels}, avg wait={avg_wait:.3f}s, max wait={max_wait:.3f}s, avg={avg_time:.3f}s, max={max_time:.3f}s'.format(name, **ctype))
+
+    def log_command_workers_stats(self):
+        stats = self.command_workers.stats()
+        syslog.syslog(syslog.LOG_INFO, 'Command workers: workers={workers}, queued={queued}, running={running}, submitted={submitted}, completed={completed}, failed={failed}, crashes={crashes}, timeouts={timeouts}, recycled={recycled}, avg={avg_time:.3f}s, max={max_time:.3f}s'.format(**stats))
+
+    def log_sync_stats(self):
+        if self.ground_session:
+            stats = self.ground_session.stats()
+            syslog.syslog(syslog.LOG_INFO, 'Ground session: connected={connected}, uptime={uptime:.0f}s (total {total_uptime:.0f}s), connects={connects}, reconnects={reconnects}, failed attempts={failed_attempts}, retry in={retry_in:.0f}s, pings={pings}, server changes={args_changes}, commands received={commands_received} (seq {command_seq})'.format(**stats))
+        if self.sync_coordinator:
+            stats = self.sync_coordinator.stats()
+            syslog.syslog(syslog.LOG_INFO, 'Sync coordinator: cycles={cycles}, link checks={link_checks}, link down={link_down}'.format(**stats))
+
+        for (conn_type, estimate) in sorted(self.sync_engine.throughput.stats().items()):
+            syslog.syslog(syslog.LOG_INFO, 'Sync throughput {}: {:.0f} bytes/sec ({} samples)'.format(conn_type, estimate['rate'], estimate['samples']))
+
+        # Log how much data has been sent to the ground for each table, and
+        # how much was saved by compressing it.
+        for (table, stats) in sorted(self.sync_engine.stats().items()):
+            if stats['raw_bytes']:
+                saved = 100.0 * (stats['raw_bytes'] - stats['est_wire_bytes']) / stats['raw_bytes']
+            else:
+                saved = 0.0
+            syslog.syslog(syslog.LOG_INFO, 'Sync {}: priority={priority}, rows={rows}, batches={batches} ({compressed_batches} compressed), batch size={batch_size}, errors={errors}, preempted={preempted}, budget exhausted={budget_exhausted}, replayed={replayed}, reconciled rows={reconciled_rows}, raw bytes={raw_bytes}, est. compressed bytes={est_wire_bytes} (~{:.1f}% saved), watermark={watermark}'.format(table, saved, **stats))
+
+    def log_query_stats(self):
+        # Write the queries that took the most time to the syslog and the
+        # System_Messages table, and the full statistics to a local file.
+        lines = query_stats.STATS.summary()
+        for line in lines:
+            syslog.syslog(syslog.LOG_INFO, line)
+        self.db._log_msg('\n'.join(lines[:6]))  # pylint: disable=protected-access
+        try:
+            query_stats.STATS.dump(QUERY_STATS_FILE)
+        except (IOError, OSError) as err:
+            syslog.syslog(syslog.LOG_ERR, 'Error writing query stats to {}: {}'.format(QUERY_STATS_FILE, err))
+
+    def register_commands(self):
+        """
+        Registers the built-in command handlers.  The radio commands share the
+        radio and the sync commands share the ground connection, so only one
+        command of each group runs at a time.  A CALL can wait up to 60
+        seconds for the radio, so the radio commands get a longer timeout.
+        """
+        d = self.dispatcher
+        d.register('RETRIEVE_COMMAND_LOGS', self.retrieve_command_logs, group='export', limit=2, priority=2, timeout=1800)
+        d.register('RETRIEVE_SYSTEM_MESSAGES', self.retrieve_system_messages, group='export', priority=2, timeout=1800)
+        d.register('RETRIEVE_FLIGHT_DATA', self.retrieve_flight_data, group='export', priority=2, timeout=1800)
+        d.register('CREATE_REC_SESSION', self.create_rec_session, timeout=60)
+        d.register('HANGUP', self.hangup, group='radio', priority=0, timeout=120)
+        d.register('CALL', self.call, group='radio', priority=1, timeout=120)
+        d.register('SYNC_FLIGHT_DATA_OBJECT', self.sync_flight_data_object, group='sync', priority=1, timeout=600)
+        d.register('SYNC_FLIGHT_DATA_BINARY', self.sync_flight_data_binary, group='sync', priority=1, timeout=600)
+        d.register('SYNC_FLIGHT_DATA', self.sync_flight_data, group='sync', priority=1, timeout=600)
+        d.register('SYNC_COMMAND_LOG_SV_TO_GROUND', self.sync_command_log_sv_to_ground, group='sync', priority=0, timeout=600)
+        d.register('SYNC_COMMAND_LOG_GROUND_TO_SV', self.sync_command_log_ground_to_sv, group='sync', priority=0, timeout=600)
+        d.register('SYNC_SYSTEM_MESSAGES', self.sync_system_messages, group='sync', priority=1, timeout=600)
+        d.register('SYNC_RECORDING_SESSIONS', self.sync_vms_recording_sessions, group='sync', priority=1, timeout=600)
+        d.register('STOP_STX3', self.set_STX3_to_OFF, group='stx3', priority=0, timeout=60)
+        d.register('START_STX3', self.set_STX3_to_ON, group='stx3', priority=0, timeout=60)
 
     def process(self):
-        # pylint: disable=too-many-branches
+        # Claim the pending commands and queue them to be run by the command
+        # dispatcher, in the order of their priority
         commands = self.db.all_pending_commands()
-        for cmd in sorted(commands, key=operator.itemgetter("priority")):
-            # Most likely there should only be one set of these commands queued
-            # up, but it is possible that some combinations may be pending at
-            # the same time.  To make the logic simpler, just check for all
-            # possibilities
-            if cmd['command'] == 'RETRIEVE_COMMAND_LOGS':
-                self.retrieve_command_logs(cmd)
-            elif cmd['command'] == 'RETRIEVE_SYSTEM_MESSAGES':
-                self.retrieve_system_messages(cmd)
-            elif cmd['command'] == 'RETRIEVE_FLIGHT_DATA':
-                self.retrieve_flight_data(cmd)
-            elif cmd['command'] == 'CREATE_REC_SESSION':
-                self.create_rec_session(cmd)
-            elif cmd['command'] == 'CALL':
-                self.call(cmd)
-            elif cmd['command'] == 'HANGUP':
-                self.hangup(cmd)
-            elif cmd['command'] == 'SYNC_FLIGHT_DATA_OBJECT':
-                self.sync_flight_data_object(cmd)
-            elif cmd['command'] == 'SYNC_FLIGHT_DATA_BINARY':
-                self.sync_flight_data_binary(cmd)
-            elif cmd['command'] == 'SYNC_FLIGHT_DATA':
-                self.sync_flight_data(cmd)
-            elif cmd['command'] == 'SYNC_COMMAND_LOG_SV_TO_GROUND':
-                self.sync_command_log_sv_to_ground(cmd)
-            elif cmd['command'] == 'SYNC_COMMAND_LOG_GROUND_TO_SV':
-                self.sync_command_log_ground_to_sv(cmd)
-            elif cmd['command'] == 'SYNC_SYSTEM_MESSAGES':
-                self.sync_system_messages(cmd)
-            elif cmd['command'] == 'SYNC_RECORDING_SESSIONS':
-                self.sync_vms_recording_sessions(cmd)
-            elif cmd['command'] == 'STOP_STX3':
-                print "in OFF COMMAND"
-                self.set_STX3_to_OFF(cmd)
-            elif cmd['command'] == 'START_STX3':
-                print "in ON COMMAND"
-                self.set_STX3_to_ON(cmd)
-            else:
-                self.handle_unknown_command(cmd['command'], cmd)
-
-        # If there were any unknown command processes spawned, check them now
-        if self.cmd_processes:
-            msg = 'process status for cmd "{0.name}"= pid:{0.pid}, alive:{1}, return:{0.exitcode}'
-            for proc in self.cmd_processes[:]:
-                syslog.syslog(syslog.LOG_INFO, msg.format(proc, proc.is_alive()))
-                if not proc.is_alive():
-                    self.cmd_processes.remove(proc)
+        for cmd in commands:
+            self.dispatcher.submit(cmd)
 
         # return the new poll rate if it has changed
         return self.db.retrieve_command_log_poll_rate()
 
     def retrieve_command_logs(self, cmd):
-        # There are 3 different ways the command logs can be retrieved:
-        #   1. within a time range
-        #   2. command logs for a specific session
-        #   3. all command logs
-        #
-        # Check the 'data' element to determine what type of command this is.
-        # Each retrieve command should be processed separately
-        # pylint: disable=bare-except
-        try:
-            session = None
-            timestamp = None
-            # Check if there is any data specified at all
-            if len(cmd['data']):
-                # First try an integer conversion
-                try:
-                    session = int(cmd['data'])
-                except ValueError:
-                    # Last possibility is a timestamp, use the standard MySQL
-                    # timestamp format
-                    timestamp = time.strptime(cmd['data'], '%Y-%m-%d %H:%M:%S')
-            (msgs, _) = self.db.retrieve_command_logs(session, timestamp)
-            write_json_data(msgs, '/opt/qs/outputs/cmd{}_command_log_{}'.format(cmd['time'], cmd['data']))
-            self.db.complete_commands(cmd, True)
-        except KeyboardInterrupt as e:
-            raise e
-        except:
-            self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
+        self.export_data(cmd, 'Command_Log', 'time_of_command', 'command_log')
 
     def retrieve_system_messages(self, cmd):
-        # There are 3 different ways the system messages can be retrieved:
-        #   1. within a time range
-        #   2. system messages for a specific session
-        #   3. all system messages
-        #
-        # Check the 'data' element to determine what type of command this is.
-        # Each retrieve command should be processed separately
-        # pylint: disable=bare-except
-        try:
-            session = None
-            timestamp = None
-            # Check if there is any data specified at all
-            if len(cmd['data']):
-                # First try an integer conversion
-                try:
-                    session = int(cmd['data'])
-                except ValueError:
-                    # Last possibility is a timestamp, use the standard MySQL
-                    # timestamp format
-                    timestamp = time.strptime(cmd['data'], '%Y-%m-%d %H:%M:%S')
-            (logs, _) = self.db.retrieve_system_messages(session, timestamp)
-            write_json_data(logs, '/opt/qs/outputs/cmd{}_system_messages_{}'.format(cmd['time'], cmd['data']))
-            self.db.complete_commands(cmd, True)
-        except KeyboardInterrupt as e:
-            raise e
-        except:
-            self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
+        self.export_data(cmd, 'System_Messages', 'event_time', 'system_messages')
 
     def retrieve_flight_data(self, cmd):
-        # There are 3 different ways the flight data can be retrieved:
-        #   1. within a time range
-        #   2. flight data for a specific session
-        #   3. all flight data
+        self.export_data(cmd, 'Flight_Data', 'time_stamp', 'flight')
+
+    def export_data(self, cmd, table, column, name):
+        # There are 3 different ways the data can be retrieved:
+        #   1. within a time range (one timestamp for everything after it, or
+        #      two for a start and end time)
+        #   2. data for a specific session
+        #   3. all data
+        # and "gzip" can be added to compress the output file, for example
+        # "2017-06-01 00:00:00,2017-06-02 00:00:00,gzip".
         #
-        # Check the 'data' element to determine what type of command this is.
+        # The rows are streamed to a JSON-lines file in /opt/qs/outputs.
         # Each retrieve command should be processed separately
         # pylint: disable=bare-except
         try:
-            session = None
-            timestamp = None
-            # Check if there is any data specified at all
-            if len(cmd['data']):
-                # First try an integer conversion
-                try:
-                    session = int(cmd['data'])
-                except ValueError:
-                    # Last possibility is a timestamp, use the standard MySQL
-                    # timestamp format
-                    timestamp = time.strptime(cmd['data'], '%Y-%m-%d %H:%M:%S')
-            (data, _) = self.db.retrieve_flight_data(session, timestamp)
-            write_json_data(data, '/opt/qs/outputs/cmd{}_flight_{}'.format(cmd['time'], cmd['data']))
+            options = data_export.parse_filter(cmd['data'])
+            filename = os.path.join(data_export.OUTPUT_DIR, 'cmd{}_{}_{}'.format(cmd['time'], name, cmd['data']))
+            (filename, count, _) = self.db.export_data(table, column, filename, **options)
+            syslog.syslog(syslog.LOG_INFO, 'Exported {} {} rows to {}'.format(count, table, filename))
             self.db.complete_commands(cmd, True)
         except KeyboardInterrupt as e:
             raise e
@@ -600,11 +662,6 @@ class vms(object):
             self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
 
     def update_linkstar_location_tables(self, cmd=None):
-        # Check if this thread should be running or paused (only if it wasn't
-        # called as a command handler)
-        if not cmd:
-            self.thread_run_event.wait()
-
         #  Moves LinkStar Duplex State Location info into location table
         #    This is done to keep all location information in one consistent spot.
         #    Also, the goal is to keep location data frequency consistent, since
@@ -626,17 +683,8 @@ class vms(object):
         # Mark the command as being processed
         self.db.start_command(cmd)
 
-        # Now spawn a separate process to handle the command
-        proc = multiprocessing.Process(
-            target=unknown_command_wrapper,
-            name=cmd['command'],
-            args=(self.args['vms'], cmd, self.thread_run_event))
-        proc.start()
-
-        msg = 'command process cmd "{0.name}" started (pid:{0.pid})'
-        syslog.syslog(syslog.LOG_INFO, msg.format(proc))
-
-        self.cmd_processes.append(proc)
+        # Now send it to a command worker process to handle
+        self.command_workers.submit(cmd)
 
     def call(self, cmd):
         # pylint: disable=bare-except
@@ -660,53 +708,58 @@ class vms(object):
 
     def check_db_ground_connection(self):
         print 'check_db_ground_connection'
-        gs_args = self.db.get_db_ground_args()
-        self.args['vms_ground'] = {
-            'address': gs_args['server'],
-            'port': self.args['vms_ground']['port'],
-            'username': gs_args['username'],
-            'password': gs_args['password'],
-            'cert': self.args['vms_ground']['cert'],
-            'dbname': self.args['vms_ground']['dbname']
-        }
-        print self.args['vms_ground']
-
-        # Check if signal is lost.  If it is, delete db_ground
-        #
-
-        # pylint: disable=bare-except
-        if self.db_ground:
-            print "in DB GROUND CHECK"
-            # This just indicates whether or not the ground connection has
-            # ever been established.  Connection checking and reconnection
-            # attempts are handled in the vms_db_ground class.
-            return True
-        else:
-            print "creating new instance"
-            try:
-                self.db_ground = vms_db_ground.vms_db_ground(**self.args['vms_ground'])
-                print "connected to ground db"
-                return True
-            except KeyboardInterrupt as e:
-                raise e
-            except:
-                syslog.syslog(syslog.LOG_ERR, 'Error opening ground connection: {}'.format(traceback.format_exception(*sys.exc_info())))
-        return False
+        # The ground session re-uses its connection (pinging it if it has
+        # been idle) and backs off after failed connection attempts.
+        self.db_ground = self.ground_session.connect()
+        self.args['vms_ground'] = self.ground_session.args
+        return self.db_ground is not None
 
     """
     Most functions that use the radio will need to check the radio status first
     """
 
     def remove_db_ground_connection(self):
+        # The link is down, stop using the ground connection.  The session
+        # keeps it open so it can be used again when the link comes back.
+        self.ground_session.link_down()
+        self.db_ground = None
+        return
+
+    def add_table_sync(self, table, interval, pausable=True):
+        # Add a job to the sync coordinator that sends the new rows of a table
+        # to the ground, at the table's sync priority
+        self.sync_coordinator.add_job(table, lambda: self._sync_table(table), interval, pausable, sync_engine.SyncEngine.policy(table).priority)
+
+    def ground_link_available(self):
+        # Update the radio status and check if the ground database can be
+        # reached, dropping the ground connection if it can't.
+        self.linkstar.get_radio_status()
+        if self.db.check_test_connection():
+            return self.check_db_ground_connection()
+        self.remove_db_ground_connection()
+        return False
+
+    def sync_table_to_ground(self, table, cmd=None):
+        # Send the rows of the table that the ground doesn't have yet, if
+        # there is a connection to the ground
+        if self.ground_link_available():
+            self._sync_table(table, cmd)
+
+    def _sync_table(self, table, cmd=None):
+        print "---> Syncing {} to ground".format(table)
+        # pylint: disable=bare-except
         try:
-            if self.db_ground:
-                del self.db_ground
+            sent = self.sync_engine.sync_table(table, self.db_ground)
+            if cmd:
+                if sent is None:
+                    self.db.complete_commands(cmd, False, 'Unable to sync {} with the ground'.format(table))
+                else:
+                    self.db.complete_commands(cmd, True)
         except KeyboardInterrupt as e:
             raise e
         except:
-            syslog.syslog(syslog.LOG_ERR, 'Error opening ground connection: {}'.format(traceback.format_exception(*sys.exc_info())))
-        self.db_ground = None
-        return
+            if cmd:
+                self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
 
     def sync_flight_data_object(self, cmd=None):
         # Check if this thread should be running or paused (only if it wasn't
@@ -715,30 +768,7 @@ class vms(object):
             self.thread_run_event.wait()
 
         print "****** IN sync_flight_data_object"
-        #  generate the export file
-        #      NOTE - this db module will only generate the file if FIRST TIME RUN
-        #             or the file was already downloaded
-        sync_to_ground = self.db.sync_selected_db_table('Flight_Data_Object')
-        #  Download the export file IF there is a connection to the ground
-        self.linkstar.get_radio_status()
-        if self.db.check_test_connection():
-            if self.check_db_ground_connection():
-                print "flight data object test"
-                # pylint: disable=bare-except
-                try:
-                    if sync_to_ground:
-                        ground_Sync = self.db_ground.sync_selected_db_table('Flight_Data_Object')
-                        if ground_Sync:
-                            self.db.reset_sync_flag('Flight_Data_Object')
-                    if cmd:
-                        self.db.complete_commands(cmd, True)
-                except KeyboardInterrupt as e:
-                    raise e
-                except:
-                    if cmd:
-                        self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
-        else:
-            self.remove_db_ground_connection()
+        self.sync_table_to_ground('Flight_Data_Object', cmd)
 
     def sync_flight_data_binary(self, cmd=None):
         # Check if this thread should be running or paused (only if it wasn't
@@ -747,27 +777,7 @@ class vms(object):
             self.thread_run_event.wait()
 
         print "****** IN sync_flight_data_binary"
-        #  generate the export file
-        #      NOTE - this db module will only generate the file if FIRST TIME RUN
-        #             or the file was already downloaded
-        sync_to_ground = self.db.sync_selected_db_table('Flight_Data_Binary')
-        self.linkstar.get_radio_status()
-        if self.db.check_test_connection():
-            if self.check_db_ground_connection():
-                print "flight data binary test"
-                # pylint: disable=bare-except
-                try:
-                    if sync_to_ground:
-                        ground_Sync = self.db_ground.sync_selected_db_table('Flight_Data_Binary')
-                        if ground_Sync:
-                            self.db.reset_sync_flag('Flight_Data_Binary')
-                    if cmd:
-                        self.db.complete_commands(cmd, True)
-                except:
-                    if cmd:
-                        self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
-        else:
-            self.remove_db_ground_connection()
+        self.sync_table_to_ground('Flight_Data_Binary', cmd)
 
     def sync_flight_data(self, cmd=None):
         # Check if this thread should be running or paused (only if it wasn't
@@ -776,30 +786,7 @@ class vms(object):
             self.thread_run_event.wait()
 
         print "****** IN sync_flight_data"
-        #  generate the export file
-        #      NOTE - this db module will only generate the file if FIRST TIME RUN
-        #             or the file was already downloaded
-        sync_to_ground = self.db.sync_selected_db_table('Flight_Data')
-        print "Value for sync to ground - flight data"
-        print sync_to_ground
-        self.linkstar.get_radio_status()
-        if self.db.check_test_connection():
-            if self.check_db_ground_connection():
-                print "flight data test"
-                # pylint: disable=bare-except
-                try:
-                    if sync_to_ground:
-                        print "---> Syncing Flight_Data to ground"
-                        ground_Sync = self.db_ground.sync_selected_db_table('Flight_Data')
-                        if ground_Sync:
-                            self.db.reset_sync_flag('Flight_Data')
-                    if cmd:
-                        self.db.complete_commands(cmd, True)
-                except:
-                    if cmd:
-                        self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
-        else:
-            self.remove_db_ground_connection()
+        self.sync_table_to_ground('Flight_Data', cmd)
 
     def sync_system_messages(self, cmd=None):
         # Check if this thread should be running or paused (only if it wasn't
@@ -808,30 +795,7 @@ class vms(object):
         #    self.thread_run_event.wait()
 
         print "****** IN sync_system_messages"
-        #  generate the export file
-        #      NOTE - this db module will only generate the file if FIRST TIME RUN
-        #             or the file was already downloaded
-        sync_to_ground = self.db.sync_selected_db_table('System_Messages')
-        print "Value for sync to ground - system messages"
-        print sync_to_ground
-        self.linkstar.get_radio_status()
-        if self.db.check_test_connection():
-            if self.check_db_ground_connection():
-                # print "system message test"
-                # pylint: disable=bare-except
-                try:
-                    if sync_to_ground:
-                        print "---> Syncing System_Messages to ground"
-                        ground_Sync = self.db_ground.sync_selected_db_table('System_Messages')
-                        if ground_Sync:
-                            self.db.reset_sync_flag('System_Messages')
-                    if cmd:
-                        self.db.complete_commands(cmd, True)
-                except:
-                    if cmd:
-                        self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
-        else:
-            self.remove_db_ground_connection()
+        self.sync_table_to_ground('System_Messages', cmd)
 
     def sync_vms_recording_sessions(self, cmd=None):
         # Check if this thread should be running or paused (only if it wasn't
@@ -839,54 +803,34 @@ class vms(object):
         if not cmd:
             self.thread_run_event.wait()
 
-        self.linkstar.get_radio_status()
-        if self.db.check_test_connection():
-            if self.check_db_ground_connection():
-                print "Syncing Recording Session Information"
-                sync_to_ground = self.db.sync_recording_sessions()
-                if sync_to_ground:
-                    ground_Sync = self.db_ground.sync_recording_sessions()
-                    if ground_Sync:
-                        self.db.reset_sync_flag('Recording_Sessions')
-                sync_to_ground = self.db.sync_recording_session_state()
-                if sync_to_ground:
-                    ground_Sync = self.db_ground.sync_recording_session_state()
-                    if ground_Sync:
-                        self.db.reset_sync_flag('Recording_Session_State')
-                sync_to_ground = self.db.sync_flight_pointers()
-                if sync_to_ground:
-                    ground_Sync = self.db_ground.sync_flight_pointers()
-                    if ground_Sync:
-                        self.db.reset_sync_flag('Flight_Pointers')
-                if cmd:
-                    self.db.complete_commands(cmd, True)
-        else:
-            self.remove_db_ground_connection()
+        if self.ground_link_available():
+            self._sync_vms_recording_sessions(cmd)
+
+    def _sync_vms_recording_sessions(self, cmd=None):
+        print "Syncing Recording Session Information"
+        sync_to_ground = self.db.sync_recording_sessions()
+        if sync_to_ground:
+            ground_Sync = self.db_ground.sync_recording_sessions()
+            if ground_Sync:
+                self.db.reset_sync_flag('Recording_Sessions')
+        sync_to_ground = self.db.sync_recording_session_state()
+        if sync_to_ground:
+            ground_Sync = self.db_ground.sync_recording_session_state()
+            if ground_Sync:
+                self.db.reset_sync_flag('Recording_Session_State')
+        sync_to_ground = self.db.sync_flight_pointers()
+        if sync_to_ground:
+            ground_Sync = self.db_ground.sync_flight_pointers()
+            if ground_Sync:
+                self.db.reset_sync_flag('Flight_Pointers')
+        if cmd:
+            self.db.complete_commands(cmd, True)
 
     def sync_command_log_sv_to_ground(self, cmd=None):
         # Check if this thread should be running or paused (only if it wasn't
         # called as a command handler)
 
-        sync_to_ground = self.db.sync_selected_db_table('Command_Log')
-        print "Value for sync to ground - Command_Log"
-        print sync_to_ground
-        self.linkstar.get_radio_status()
-        if self.db.check_test_connection():
-            if self.check_db_ground_connection():
-                print "sync command log with the ground"
-                try:
-                    if sync_to_ground:
-                        print "---> Syncing Command_Log to ground"
-                        ground_Sync = self.db_ground.sync_selected_db_table('Command_Log')
-                        if ground_Sync:
-                            self.db.reset_sync_flag('Command_Log')
-                    if cmd:
-                        self.db.complete_commands(cmd, True)
-                except:
-                    if cmd:
-                        self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
-        else:
-            self.remove_db_ground_connection()
+        self.sync_table_to_ground('Command_Log', cmd)
 
     def sync_command_log_ground_to_sv(self, cmd=None):
         # Check if this thread should be running or paused (only if it wasn't
@@ -895,27 +839,27 @@ class vms(object):
         # sync from ground to sv
         # run pending commands
         print "****** IN sync command ground to SV"
-        self.linkstar.get_radio_status()
-        if self.db.check_test_connection():
-            if self.check_db_ground_connection():
-                # try:
-                print "++++ Ground Command connection made ++++ "
-                datetime_last_command = self.db.get_last_command_date('Pending-Ground')
-                print "datetime_last_command value --->"
-                print datetime_last_command
-                ground_commands = self.db_ground.read_command_log(datetime_last_command)
-                print ground_commands
-                self.db.add_sv_command_log(ground_commands)  # write to sv db with read_from_sv set to true
-
-                if cmd:
-                    self.db.complete_commands(cmd, True)
-                print "command log ground to sv test"
-                # except:
-                #    if cmd:
-                #       self.db.complete_commands(cmd, False,
-                #           traceback.format_exception(*sys.exc_info()))
-        else:
-            self.remove_db_ground_connection()
+        if self.ground_link_available():
+            self._sync_command_log_ground_to_sv(cmd)
+
+    def _sync_command_log_ground_to_sv(self, cmd=None):
+        # try:
+        print "++++ Ground Command connection made ++++ "
+        # Read the commands queued on the ground since the last one received
+        # and write them to the sv db with read_from_sv set to true
+        ground_commands = self.ground_session.receive_commands(self.db.add_sv_command_log)
+        print ground_commands
+        if ground_commands:
+            # Run the new commands now rather than at the next command poll
+            self.process_timer.trigger()
+
+        if cmd:
+            self.db.complete_commands(cmd, True)
+        print "command log ground to sv test"
+        # except:
+        #    if cmd:
+        #       self.db.complete_commands(cmd, False,
+        #           traceback.format_exception(*sys.exc_info()))
 
     def sync_linkstar_duplex_state(self, cmd=None):
         print "******>>>> IN sync_linkstar_duplex_state"
@@ -925,27 +869,7 @@ class vms(object):
             self.thread_run_event.wait()
 
         print "****** IN sync_linkstar_duplex_state"
-        #  generate the export file
-        #      NOTE - this db module will only generate the file if FIRST TIME RUN
-        #             or the file was already downloaded
-        sync_to_ground = self.db.sync_selected_db_table('LinkStar_Duplex_State')
-        self.linkstar.get_radio_status()
-        if self.db.check_test_connection():
-            if self.check_db_ground_connection():
-                # print "sync_linkstar_duplex test"
-                # pylint: disable=bare-except
-                try:
-                    if sync_to_ground:
-                        ground_Sync = self.db_ground.sync_selected_db_table('LinkStar_Duplex_State')
-                        if ground_Sync:
-                            self.db.reset_sync_flag('LinkStar_Duplex_State')
-                    if cmd:
-                        self.db.complete_commands(cmd, True)
-                except:
-                    if cmd:
-                        self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
-        else:
-            self.remove_db_ground_connection()
+        self.sync_table_to_ground('LinkStar_Duplex_State', cmd)
 
     def sync_location_table(self, cmd=None):
         print " ~~~~~~>> in sync_location_table  <<----------"
@@ -953,30 +877,7 @@ class vms(object):
         # called as a command handler)
 
         print " ~~~~~~ in sync_location_table"
-        #  generate the export file
-        #      NOTE - this db module will only generate the file if FIRST TIME RUN
-        #             or the file was already downloaded
-        sync_to_ground = self.db.sync_selected_db_table('Location_Data')
-        print "Value for sync to ground - location table"
-        print sync_to_ground
-        self.linkstar.get_radio_status()
-        if self.db.check_test_connection():
-            if self.check_db_ground_connection():
-                # print "sync location Data information with the ground"
-                # pylint: disable=bare-except
-                try:
-                    if sync_to_ground:
-                        print "In ground sync LOCATION"
-                        ground_Sync = self.db_ground.sync_selected_db_table('Location_Data')
-                        if ground_Sync:
-                            self.db.reset_sync_flag('Location_Data')
-                    if cmd:
-                        self.db.complete_commands(cmd, True)
-                except:
-                    if cmd:
-                        self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
-        else:
-            self.remove_db_ground_connection()
+        self.sync_table_to_ground('Location_Data', cmd)
 
     def update_system_applications_state_to_gnd(self, cmd=None):
         # Check if this thread should be running or paused (only if it wasn't
@@ -984,26 +885,7 @@ class vms(object):
 
         print "****** IN update_system_applications_state_to_gnd"
 
-        sync_to_ground = self.db.sync_selected_db_table('System_Applications_State')
-        print sync_to_ground
-
-        self.linkstar.get_radio_status()
-        if self.db.check_test_connection():
-            if self.check_db_ground_connection():
-                # pylint: disable=bare-except
-                try:
-                    if sync_to_ground:
-                        print "In ground sync Application State"
-                        ground_Sync = self.db_ground.sync_selected_db_table('System_Applications_State')
-                        if ground_Sync:
-                            self.db.reset_sync_flag('System_Applications_State')
-                    if cmd:
-                        self.db.complete_commands(cmd, True)
-                except:
-                    if cmd:
-                        self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
-        else:
-            self.remove_db_ground_connection()
+        self.sync_table_to_ground('System_Applications_State', cmd)
 
     def upload_app_from_gnd(self, cmd):
         self.linkstar.get_radio_status()
@@ -1040,6 +922,33 @@ class vms(object):
             if cmd:
                 self.db.complete_commands(cmd, False, traceback.format_exception(*sys.exc_info()))
                 
+    def packet_group_timing(self):
+        # Returns the delay between packet group transmissions, and the upper
+        # limit of the random dither time before each transmission.
+        packetGroupXmitRate = self.db.retrieve_packet_group_xmit_rate()
+        number_repeats_val = self.db.retrieve_linkstar_simplex_info('maximum_repeats')
+        repeat_delay_val = self.db.retrieve_linkstar_simplex_info('repeat_delay')
+        print "The baseline transmit rate is ", str(packetGroupXmitRate),", and the Number of Repeats is ", str(number_repeats_val)," and the repeat time is ", str(repeat_delay_val)
+
+        packetGroupXmitRate = packetGroupXmitRate - (number_repeats_val * repeat_delay_val)
+        print "---> The net packet delay time is ", str(packetGroupXmitRate)
+
+        if packetGroupXmitRate < 3600:
+            ditherTimeUpper = int( 0.0666667 * float(packetGroupXmitRate))
+            print "The packetDitherTimeUpper is -----> ", ditherTimeUpper
+        else:
+            ditherTimeUpper = 600
+        return (packetGroupXmitRate, ditherTimeUpper)
+
+    def simplex_settings_changed(self, table, changed):
+        global packetDitherTimeUpper
+
+        if table == 'LinkStar_Simplex_Information' and ('maximum_repeats' in changed or 'repeat_delay' in changed):
+            (packetGroupXmitRate, packetDitherTimeUpper) = self.packet_group_timing()
+            if self.packet_group_timer:
+                self.packet_group_timer.delay = packetGroupXmitRate
+            syslog.syslog(syslog.LOG_INFO, 'STX3 repeat settings changed, packet group delay = {}, dither = {}'.format(packetGroupXmitRate, packetDitherTimeUpper))
+
     def transmit_packet_group(self):
         # This function builds the packet to be sent and
         #    transmits the packet to the ground through the LinkStar-STX3 radio
@@ -143,6 +143,10 @@ class vms_bmpsensor(object):
         # Connect to the QS/VMS DB
         self.db = vms_db.vms_db(**self.args['vms'])
         print "ARGS SET"
+
+        # Batch the sensor samples rather than inserting them one at a time,
+        # they are flushed to the database every 60 seconds (or 100 samples).
+        self.db.start_flight_data_writer(flush_interval=60.0)
         # Some mechanisms to allow threads to be paused by a command handler
         self.thread_run_event = multiprocessing.Event()
 
@@ -164,6 +168,7 @@ class vms_bmpsensor(object):
     def __del__(self):
         for t in self.threads:
             t.stop()
+        self.db.stop_flight_data_writer()
         for proc in self.cmd_processes[:]:
             proc.kill()
         syslog.syslog(syslog.LOG_NOTICE, 'Shutting down')
@@ -183,6 +188,9 @@ class vms_bmpsensor(object):
                 t.stop()
             self.threads = []
 
+            # Make sure any samples that are still queued are written
+            self.db.stop_flight_data_writer()
+
             for proc in self.cmd_processes:
                 proc.kill()
             self.cmd_processes = []
@@ -4,9 +4,9 @@ A module that provides a python interface to the QS/VMS database.
 """
 
 import syslog
-import itertools
 import sys
 import threading
+import time
 import string
 import os
 import os.path
@@ -23,6 +23,12 @@ import grp
 #   https://pypi.python.org/pypi/setuptools
 import mysql.connector
 
+import db_pool
+import flight_data_writer
+import retention
+import settings_cache
+import data_export
+
 # Disable some pylint warnings that I don't care about
 # pylint: disable=line-too-long,fixme,invalid-name,too-many-public-methods,too-many-arguments,too-many-locals,too-many-lines,too-many-statements
 #
@@ -32,16 +38,216 @@ import mysql.connector
 # TEMPORARY:
 # pylint: disable=missing-docstring
 
+# The value of a table's Flight_Pointers <table>_rt flag that marks its
+# <table>_event_key as the newest row the ground has acknowledged.  The file
+# based sync used 0 and 1, and saved the key of the next row to export.
+SYNC_WATERMARK_ACKED = 2
+
+
+class SessionContext(object):
+    """
+    Tracks the active recording session so that queries can bind the session
+    ID as a parameter rather than re-deriving it with a
+    "SELECT MAX(recording_session_id)" subquery in every statement.
+
+    The Recording_Session_State and Flight_Pointers rows for a session are
+    both keyed by the recording_session_id, so the session ID is the only key
+    that needs to be cached.  The context is refreshed explicitly whenever
+    vms_db.increment_session() creates a new session, and at most once every
+    check_interval seconds a cheap version check is run to detect sessions
+    created by another process.
+    """
+    def __init__(self, check_interval=10.0):
+        self.lock = threading.RLock()
+        self.check_interval = check_interval
+        self.session_id = None
+        self.checked_at = 0.0
+
+    def is_stale(self):
+        """
+        Returns True if the cached session ID must be re-validated.
+        """
+        with self.lock:
+            if self.session_id is None:
+                return True
+            return (time.time() - self.checked_at) >= self.check_interval
+
+    def update(self, session_id):
+        """
+        Records the session ID that was read from the database and resets the
+        version check timer.
+        """
+        with self.lock:
+            if session_id != self.session_id:
+                syslog.syslog(syslog.LOG_DEBUG, 'Active recording session changed from {} to {}'.format(self.session_id, session_id))
+            self.session_id = session_id
+            self.checked_at = time.time()
+
+    def invalidate(self):
+        """
+        Forces the next lookup to re-read the session from the database.
+        """
+        with self.lock:
+            self.checked_at = 0.0
+
+    def params(self, **kwargs):
+        """
+        Returns a dictionary of statement parameters that contains the cached
+        session ID as "session" along with any additional parameters.
+        """
+        kwargs['session'] = self.session_id
+        return kwargs
+
+
+class SessionStateSnapshot(object):
+    """
+    A cached copy of the active session's Recording_Session_State row.
+
+    The control flags and push/poll rates in this row are read by almost
+    every periodic job, so the whole row is loaded with a single query and
+    re-used until it is older than ttl seconds.  The row is also modified by
+    the ground station and the web interface, which is why it can't be cached
+    indefinitely; local writes to the row should call invalidate() so that
+    the next read sees the new values immediately.
+    """
+    def __init__(self, ttl=5.0):
+        self.lock = threading.RLock()
+        self.ttl = ttl
+        self.row = None
+        self.session_id = None
+        self.loaded_at = 0.0
+
+    def is_stale(self, session_id):
+        with self.lock:
+            if self.row is None or session_id != self.session_id:
+                return True
+            return (time.time() - self.loaded_at) >= self.ttl
+
+    def update(self, session_id, row):
+        with self.lock:
+            self.session_id = session_id
+            self.row = row
+            self.loaded_at = time.time()
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = 0.0
+
+    def get(self, column, default=None):
+        with self.lock:
+            if self.row is None:
+                return default
+            return self.row.get(column, default)
+
+    def flag(self, column):
+        """
+        Returns a control flag (such as test_connection or sync_to_ground) as
+        an integer, 0 if the flag is not set.
+        """
+        value = self.get(column)
+        if value is None:
+            return 0
+        return int(value)
+
+    def rate(self, column):
+        """
+        Returns a push or poll rate, in seconds, or None if the rate is not
+        set.
+        """
+        value = self.get(column)
+        if value is None:
+            return None
+        return float(value)
+
+    def num_records_download(self, table):
+        """
+        Returns the number of rows of a table that should be sent to the
+        ground in each sync.
+        """
+        value = self.get('{}_num_records_download'.format(string.lower(table)))
+        if value is None:
+            return None
+        return int(value)
+
+
+def satellite_view_rows(SatellitesInView, SatellitesInTracked):
+    """
+    Converts the GPS satellites in view list (groups of PRN number, elevation,
+    azimuth and SNR) and the list of tracked satellites into a dictionary of
+    PRN number: (elevation, azimuth, snr, being_tracked).
+    """
+    count = int(len(SatellitesInView)/4)
+    # Only as many tracked satellites as there are satellites in view are
+    # considered
+    tracked = set(SatellitesInTracked[:count])
+    rows = {}
+    for x in range(0, count):
+        prn = SatellitesInView[4*x]
+        # If a satellite is listed more than once, the first entry is used
+        if prn not in rows:
+            rows[prn] = (SatellitesInView[(4*x)+1], SatellitesInView[(4*x)+2], SatellitesInView[(4*x)+3], int(prn in tracked))
+    return rows
+
+
+class LastValueCache(object):
+    """
+    Caches the most recent value of each (table, parameter_id) for ttl
+    seconds.
+
+    The cache is per process.  Values written through this process's
+    vms_db.write_flight_data() are stored directly, but most Flight_Data is
+    written by other processes (such as vms_bmpsensor), so for those readers
+    this is a read-through cache: a value is read from the database when its
+    entry is missing or older than ttl seconds, and may be up to ttl seconds
+    old.  Parameters that have no value yet are not cached.
+    """
+    def __init__(self, ttl=10.0):
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.values = {}
+
+    def get(self, table, parameter_id, column):
+        """
+        Returns a tuple of (found, value).
+        """
+        with self.lock:
+            entry = self.values.get((table, parameter_id))
+            if entry and column in entry[1] and (time.time() - entry[0]) < self.ttl:
+                return (True, entry[1][column])
+        return (False, None)
+
+    def put(self, table, parameter_id, column, value):
+        now = time.time()
+        with self.lock:
+            entry = self.values.get((table, parameter_id))
+            if entry and (now - entry[0]) < self.ttl:
+                entry[1][column] = value
+                self.values[(table, parameter_id)] = (now, entry[1])
+            else:
+                self.values[(table, parameter_id)] = (now, {column: value})
+
+    def invalidate(self):
+        with self.lock:
+            self.values = {}
+
 
 class vms_db(object):
     """
     A class that wraps up the QS/VMS database interface.
     """
     # pylint: disable=unused-argument
-    def __init__(self, address, port, cert, username, password, dbname, **kwargs):
-        self.lock = threading.RLock()
-        self.db = None
-        self.cursor = None
+    def __init__(self, address, port, cert, username, password, dbname, session_check_interval=10.0, session_state_ttl=5.0, settings_refresh_interval=10.0, last_value_ttl=10.0, pool_size=None, **kwargs):
+        self.pool = None
+        self.pool_size = pool_size
+        self.flight_data_writer = None
+        self.retention = retention.RetentionManager(self)
+        self.session = SessionContext(session_check_interval)
+        self.state = SessionStateSnapshot(session_state_ttl)
+        self.settings = settings_cache.SettingsCache(self, settings_refresh_interval)
+        self.last_values = LastValueCache(last_value_ttl)
+        # The rows that are currently in GPS_Satellite_View, or None if the
+        # contents of the table are not known.
+        self.satellite_view = None
         self.config = {
             'user': username,
             'password': password,
@@ -58,64 +264,147 @@ class vms_db(object):
     def __del__(self):
         self.close()
 
+    def _cursor(self, **kwargs):
+        """
+        Checks out a pooled connection and returns a cursor for the duration
+        of a "with" block.
+        """
+        return self.pool.cursor(**kwargs)
+
+    def _transaction(self, **kwargs):
+        """
+        Checks out a pooled connection and returns a cursor for a "with"
+        block, everything done in the block is one transaction.
+        """
+        return self.pool.transaction(**kwargs)
+
     def _execute(self, stmt, args=None):
         """
         simple function to allow executing unusual statements
         """
 
-        with self.lock:
+        with self._cursor() as cursor:
             if isinstance(args, list):
-                self.cursor.executemany(stmt, args)
+                cursor.executemany(stmt, args)
             else:
-                self.cursor.execute(stmt, args)
-            if self.cursor.with_rows:
-                return self.cursor.fetchall()
+                cursor.execute(stmt, args)
+            if cursor.with_rows:
+                return cursor.fetchall()
             else:
-                self.db.commit()
                 return None
 
-    def _log_msg(self, msg):
+    def _log_msg(self, msg, cursor=None):
         stmt = '''
             INSERT INTO `stepSATdb_Flight`.`System_Messages` (
                     `System_Messages`.`event_time`,
                     `System_Messages`.`sysmsg`,
                     `System_Messages`.`Recording_Sessions_recording_session_id`
                 )
-                VALUES ((NOW()+0),%s,(
-                    SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                        FROM `stepSATdb_Flight`.`Recording_Sessions`
-                    )
-                )
+                VALUES ((NOW()+0),%(msg)s,%(session)s)
         '''
+        # If a cursor is supplied the message is written as part of the
+        # caller's transaction and any errors are left to the caller.
+        if cursor:
+            cursor.execute(stmt, self._session_params(msg=msg))
+            return
+
         # Handle exceptions for this cleanly, errors should get logged to the
         # syslog
 
         # pylint: disable=bare-except
-        with self.lock:
-            try:
-                self.cursor.execute(stmt, (msg,))
-                self.db.commit()
-            except KeyboardInterrupt as e:
-                raise e
-            except:
-                syslog.syslog(syslog.LOG_ERR, 'Error logging message "{}": {}'.format(msg, sys.exc_info()[1]))
+        try:
+            with self._cursor() as cursor:
+                cursor.execute(stmt, self._session_params(msg=msg))
+        except KeyboardInterrupt as e:
+            raise e
+        except:
+            syslog.syslog(syslog.LOG_ERR, 'Error logging message "{}": {}'.format(msg, sys.exc_info()[1]))
 
     def open(self):
-        with self.lock:
-            if not self.db:
-                self.db = mysql.connector.connect(**self.config)
-
-            if self.db and not self.cursor:
-                self.cursor = self.db.cursor(dictionary=True)
+        if not self.pool:
+            self.pool = db_pool.get_pool(self.config, self.pool_size)
+        # Check out a connection now so that configuration errors are reported
+        # when this object is created rather than on the first query.
+        with self.pool.connection():
+            pass
 
     def close(self):
-        with self.lock:
+        self.stop_flight_data_writer()
+
+        # The pool is shared with any other objects that connect to the same
+        # database, so just release the idle connections.
+        if self.pool:
+            self.pool.close()
+
+    def pool_stats(self):
+        """
+        Returns the connection pool gauges (connections created and in use,
+        and how long callers have waited for a connection).
+        """
+        return self.pool.stats()
+
+    def current_session(self, refresh=False):
+        """
+        Returns the ID of the active recording session.  The cached value is
+        used unless it is stale (or a refresh is requested), in which case the
+        single-row "MAX()" lookup is performed to validate it.  If the lookup
+        fails the cached value is returned.
+        """
+        if refresh or self.session.is_stale():
+            stmt = '''
+                SELECT MAX(`Recording_Sessions`.`recording_session_id`) AS 'recording_session_id'
+                    FROM `stepSATdb_Flight`.`Recording_Sessions`
+            '''
+            try:
+                with self._cursor() as cursor:
+                    cursor.execute(stmt)
+                    row = cursor.fetchone()
+                if row:
+                    self.session.update(row['recording_session_id'])
+            except mysql.connector.Error as err:
+                print("MySQL Error: {}".format(err))
+                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        return self.session.session_id
+
+    def session_state(self, refresh=False):
+        """
+        Returns the snapshot of the active session's Recording_Session_State
+        row, re-loading it if it is stale.  If the row can't be loaded the
+        previous snapshot is returned.
+        """
+        session_id = self.current_session()
+        if refresh or self.state.is_stale(session_id):
+            stmt = '''
+                SELECT *
+                    FROM `stepSATdb_Flight`.`Recording_Session_State`
+                    WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=%(session)s
+                LIMIT 1
+            '''
+            try:
+                with self._cursor() as cursor:
+                    cursor.execute(stmt, self.session.params())
+                    row = cursor.fetchone()
+                if row:
+                    self.state.update(session_id, row)
+            except mysql.connector.Error as err:
+                print("MySQL Error: {}".format(err))
+                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        return self.state
 
-            if self.cursor:
-                self.cursor.close()
+    def invalidate_session_state(self):
+        """
+        Forces the next session_state() call to re-load the row, used after
+        the row has been modified.
+        """
+        self.state.invalidate()
 
-            if self.db:
-                self.db.close()
+    def _session_params(self, **kwargs):
+        """
+        Returns statement parameters containing the active session ID (as
+        "session") and any additional named parameters.
+        """
+        self.current_session()
+        return self.session.params(**kwargs)
 
     def get_board_connection_data(self, ident=None, name=None):
         """
@@ -145,10 +434,10 @@ class vms_db(object):
             stmt = None
 
         if stmt:
-            with self.lock:
+            with self._cursor() as cursor:
                 try:
-                    self.cursor.execute(stmt)
-                    info = self.cursor.fetchall()
+                    cursor.execute(stmt)
+                    info = cursor.fetchall()
                 except mysql.connector.Error as err:
                     print("MySQL Error: {}".format(err))
                     syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -202,9 +491,9 @@ class vms_db(object):
         print stmt
 
         if stmt:
-            with self.lock:
-                self.cursor.execute(stmt)
-                info = self.cursor.fetchall()
+            with self._cursor() as cursor:
+                cursor.execute(stmt)
+                info = cursor.fetchall()
             if len(info) == 1:
                 info = info[0]
             return info
@@ -260,9 +549,9 @@ class vms_db(object):
             stmt = None
 
         if stmt:
-            with self.lock:
-                self.cursor.execute(stmt)
-                apps = self.cursor.fetchall()
+            with self._cursor() as cursor:
+                cursor.execute(stmt)
+                apps = cursor.fetchall()
             return apps
         else:
             syslog.syslog(syslog.LOG_DEBUG, 'get_board_apps() called with no application identification info')
@@ -270,22 +559,15 @@ class vms_db(object):
 
     def all_pending_commands(self):
         # Get the current recording_session_id
-        stmt = '''
-                SELECT *
-                    FROM `stepSATdb_Flight`.`Recording_Sessions`
-                    ORDER BY `Recording_Sessions`.`recording_session_id` DESC LIMIT 1
-             '''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row_recording_session = self.cursor.fetchone()
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        params = self._session_params()
 
         print "entering vms_db.all_pending_commands()"
+        # The pending commands are selected with a locking read and marked as
+        # read in the same transaction, so a command can only be claimed by
+        # one poller.
         stmt = '''
-            SELECT `Command_Log`.`command` AS command,
+            SELECT `Command_Log`.`event_key` AS event_key,
+                    `Command_Log`.`command` AS command,
                     `Command_Log`.`time_of_command` AS time,
                     `Command_Log`.`Recording_Sessions_recording_session_id` AS id,
                     `Command_Log`.`command_data` AS data,
@@ -295,35 +577,25 @@ class vms_db(object):
                     `Command_Log`.`command_id` AS command_id
                 FROM `stepSATdb_Flight`.`Command_Log`
                 WHERE `Command_Log`.`command_state`='Pending' AND `Command_Log`.`read_from_sv`=0
-                    AND `Command_Log`.`Recording_Sessions_recording_session_id`=(
-                        SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                            FROM `stepSATdb_Flight`.`Recording_Sessions`
-                    )
+                    AND `Command_Log`.`Recording_Sessions_recording_session_id`=%(session)s
+                FOR UPDATE
         '''
-        print stmt
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                commands = self.cursor.fetchall()
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-                
-        # Set all Pending Commands to read_from_sv = 1
-        stmt = '''
-            UPDATE `stepSATdb_Flight`.`Command_Log`
-                SET `Command_Log`.`read_from_sv` = 1
-                    WHERE `Command_Log`.`Recording_Sessions_recording_session_id` = %(recording_session_id)s
-                    AND `Command_Log`.`command_state`='Pending'
-                '''
-        print stmt
-        with self.lock:
-            try:
-                self.cursor.execute(stmt, row_recording_session)
-                self.db.commit()
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        commands = []
+        try:
+            with self._transaction() as cursor:
+                cursor.execute(stmt, params)
+                commands = cursor.fetchall()
+                if commands:
+                    keys = [c['event_key'] for c in commands]
+                    cursor.execute('''
+                        UPDATE `stepSATdb_Flight`.`Command_Log`
+                            SET `Command_Log`.`read_from_sv` = 1
+                                WHERE `Command_Log`.`event_key` IN ({})
+                    '''.format(','.join(['%s'] * len(keys))), keys)
+        except mysql.connector.Error as err:
+            commands = []
+            print("MySQL Error: {}".format(err))
+            syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
 
         if commands:
             syslog.syslog(syslog.LOG_DEBUG, 'Retrieved pending commands "{}"'.format(str(commands)))
@@ -338,10 +610,9 @@ class vms_db(object):
                         ON DUPLICATE KEY UPDATE `Command_Log`.`read_from_sv` = 1 , `Command_Log`.`command_state` = 'Processing'
         '''
 
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt, command)
-                self.db.commit()
+                cursor.execute(stmt, command)
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -365,36 +636,39 @@ class vms_db(object):
                 log = 'Command Failed'
 
         # transform the command list
-        cmd_keys = ['time', 'id', 'data', 'session', 'command', 'data', 'priority', 'source', 'command_id']
-        if isinstance(commands, dict) and set(cmd_keys).issubset(set(commands.keys())):
+        if isinstance(commands, dict):
             # if the command is a dictionary with keys of 'time', 'id', 'data',
             # and 'session', turn this into a list with one element.
-            update_cmds = [(commands['session'], commands['command'], state, commands['data'], commands['priority'], commands['source'], commands['command_id'])]
-        elif isinstance(commands, dict):
-            update_cmds = [(commands['session'], commands['command'], state, commands['data'], commands['priority'], commands['source'], commands['command_id'], c) for c in itertools.chain(commands.items())]
-        else:  # if isinstance(commands, list):
-            update_cmds = [(commands['session'], commands['command'], state, commands['data'], commands['priority'], commands['source'], commands['command_id']) for c in commands]
+            commands = [commands]
+
+        # Commands that timed out or were cancelled have already been
+        # completed by the command dispatcher, don't let a late result from
+        # the handler overwrite that
+        live = [c for c in commands if not (c.get('cancel') and c['cancel'].is_set())]
+        if commands and not live:
+            return
+        commands = live
+        update_cmds = [(c['session'], c['command'], state, c['data'], c['priority'], c['source'], c['command_id']) for c in commands]
         syslog.syslog(syslog.LOG_DEBUG, 'Updating stepSATdb_Flight.Command_Log with commands "{}"'.format(str(update_cmds)))
 
         # Now that the command is complete, update the "pushed_to_ground" flag
-        # to let the final commmad state be sent to the ground.
-
+        # to let the final commmad state be sent to the ground.  The command
+        # states and the log message are written in one transaction.
         stmt = '''
              INSERT INTO `stepSATdb_Flight`.`Command_Log` (`time_of_command`, `Recording_Sessions_recording_session_id`,`command`,
                 `command_state`, `command_data`, `priority`, `source`, `read_from_sv`, `pushed_to_ground`, `command_id`)
-                VALUES (NOW(),%s,%s,%s,%s,%s,%s,1, 1, %s)
-                        ON DUPLICATE KEY UPDATE `Command_Log`.`read_from_sv` = 1 , `Command_Log`.`command_state` = 'FAIL'
-        '''
-
-        with self.lock:
-            try:
-                self.cursor.executemany(stmt, update_cmds)
-                self.db.commit()
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-
-        self._log_msg(log)
+                VALUES {}
+                        ON DUPLICATE KEY UPDATE `Command_Log`.`read_from_sv` = 1 , `Command_Log`.`command_state` = VALUES(`command_state`)
+        '''.format(','.join(['(NOW(),%s,%s,%s,%s,%s,%s,1, 1, %s)'] * len(update_cmds)))
+
+        try:
+            with self._transaction() as cursor:
+                if update_cmds:
+                    cursor.execute(stmt, [value for row in update_cmds for value in row])
+                self._log_msg(log, cursor)
+        except mysql.connector.Error as err:
+            print("MySQL Error: {}".format(err))
+            syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
 
     def set_application_state(self, app, state, status, msg):
         # syslog.syslog(syslog.LOG_DEBUG, 'Updating app status "{}"/{}/{}/{}'.format(str(app), state, status, msg))
@@ -411,10 +685,9 @@ class vms_db(object):
         params['state'] = state
         params['status'] = status
 
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt, params)
-                self.db.commit()
+                cursor.execute(stmt, params)
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -438,11 +711,10 @@ class vms_db(object):
         params['state'] = state
         params['status'] = status
 
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt, params)
-                app_state = self.cursor.fetchall()
-                self.db.commit()
+                cursor.execute(stmt, params)
+                app_state = cursor.fetchall()
                 return app_state
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
@@ -461,6 +733,14 @@ class vms_db(object):
     def retrieve_flight_data(self, session=None, timestamp=None):
         return self.retrieve_data('Flight_Data', 'time_stamp', session, timestamp)
 
+    def export_data(self, table, column, filename, session=None, start=None, end=None, compress=False):
+        """
+        Streams the selected rows of a table to a JSON-lines file, see
+        data_export.export_table().  Unlike retrieve_data() the rows are never
+        all held in memory.
+        """
+        return data_export.export_table(self, table, column, filename, session=session, start=start, end=end, compress=compress)
+
     def retrieve_flight_data_last(self, table, column, parameter_id=None, session=None):
         return self.retrieve_data_last(table, column, parameter_id, session)
 
@@ -483,14 +763,16 @@ class vms_db(object):
                     ORDER BY `{table}`.`{column}` DESC
             '''.format(table=table, column=column)
 
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt, dict(session=session, timestamp=timestamp))
-                if self.cursor.with_rows:
+                cursor.execute(stmt, dict(session=session, timestamp=timestamp))
+                if cursor.with_rows:
                     # Get the maximum timestamp from the first row (because of the
                     # ORDER BY ... DESC clause) and return it with the results.
-                    ret = self.cursor.fetchall()
-                    return (self.cursor.fetchall(), ret[0][column])
+                    ret = cursor.fetchall()
+                    if ret:
+                        return (ret, ret[0][column])
+                    return (ret, None)
                 else:
                     # Return an empty list and 'None' for the timestamp
                     return ([], None)
@@ -499,46 +781,44 @@ class vms_db(object):
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
 
     def retrieve_data_last(self, table, column, parameter_id=None, session=None):
+        # The most recent value of each parameter is cached, only look it up
+        # in the database if it hasn't been written recently.
+        if parameter_id and not session:
+            (found, value) = self.last_values.get(table, parameter_id, column)
+            if found:
+                return value
+
+        where = []
         if session:
-            if parameter_id:
-                stmt = '''
-                    SELECT `{table}`.`{column}` FROM `stepSATdb_Flight`.`{table}`
-                        WHERE `{table}`.`Recording_Sessions_recording_session_id`=%(session)s AND parameter_id = `{parameter_id}`
-                        ORDER BY `{table}`.`event_key` DESC LIMIT 1
-                '''.format(table=table, column=column, parameter_id=parameter_id)
-            else:
-                stmt = '''
-                    SELECT `{table}`.`{column}` FROM `stepSATdb_Flight`.`{table}`
-                        WHERE `{table}`.`Recording_Sessions_recording_session_id`=%(session)s AND parameter_id = %(parameter_id)s
-                        ORDER BY `{table}`.`event_key` DESC LIMIT 1
-                '''.format(table=table, column=column)
-        else:
-            if parameter_id:
-                stmt = '''
-                    SELECT `{table}`.`{column}` FROM `stepSATdb_Flight`.`{table}`
-                        WHERE parameter_id = "{parameter_id}"
-                        ORDER BY `{table}`.`event_key`  DESC LIMIT 1
-                '''.format(table=table, column=column, parameter_id=parameter_id)
-            else:
-                stmt = '''
-                    SELECT `{table}`.`{column}` FROM `stepSATdb_Flight`.`{table}`
-                        ORDER BY `{table}`.`event_key`  DESC LIMIT 1
-                '''.format(table=table, column=column)
+            where.append('`{table}`.`Recording_Sessions_recording_session_id`=%(session)s'.format(table=table))
+        if parameter_id:
+            where.append('`{table}`.`parameter_id`=%(parameter_id)s'.format(table=table))
+        stmt = '''
+            SELECT `{table}`.`{column}` FROM `stepSATdb_Flight`.`{table}`
+                {where}
+                ORDER BY `{table}`.`event_key` DESC LIMIT 1
+        '''.format(table=table, column=column, where='WHERE ' + ' AND '.join(where) if where else '')
         print 'Retrieving Data...'
         print stmt
 
-        with self.lock:
+        row = None
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
+                cursor.execute(stmt, dict(session=session, parameter_id=parameter_id))
+                row = cursor.fetchone()
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+                return "*"
 
-        if row:
-            return row[column]
-        else:
+        if not row:
+            # Not cached so that the first value is seen as soon as it is
+            # written
             return "*"
+        value = row[column]
+        if parameter_id and not session:
+            self.last_values.put(table, parameter_id, column, value)
+        return value
 
     def get_active_parameter_id(self):
         # find the active parameter_id 
@@ -546,10 +826,10 @@ class vms_db(object):
                     SELECT `Parameter_ID_Table`.`parameter_id` FROM `Parameter_ID_Table` 
                     WHERE `stx3_selected_parameter` = 1
                 '''
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
+                cursor.execute(stmt)
+                row = cursor.fetchone()
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -584,21 +864,7 @@ class vms_db(object):
 
     def retrieve_push_poll_rate(self, column):
         # Get the latest state push/poll rate values
-        stmt = '''
-            SELECT `Recording_Session_State`.`{}`,`Recording_Session_State`.`state_index`
-                FROM `stepSATdb_Flight`.`Recording_Session_State`
-                ORDER BY `Recording_Session_State`.`state_index` DESC
-                LIMIT 1
-        '''.format(column)
-
-        with self.lock:
-            self.cursor.execute(stmt)
-            row = self.cursor.fetchone()
-
-        if row:
-            return row[column]
-        else:
-            return None
+        return self.session_state().rate(column)
 
     def ls_duplex_installed_state(self):
         return self.retrieve_linkstar_duplex_info('radio_installed')
@@ -610,10 +876,10 @@ class vms_db(object):
                 FROM `stepSATdb_Flight`.`LinkStar_Duplex_Information`
         '''.format(column)
 
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
+                cursor.execute(stmt)
+                row = cursor.fetchone()
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -629,56 +895,25 @@ class vms_db(object):
 
     def retrieve_linkstar_simplex_info(self, column):
         # Get the requested linkstar simplex radio information
-        stmt = '''
-            SELECT `LinkStar_Simplex_Information`.`{}`
-                FROM `stepSATdb_Flight`.`LinkStar_Simplex_Information`
-        '''.format(column)
-
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-
-        if row:
-            return row[column]
-        else:
-            return None
+        return self.settings.simplex(column)
 
     def update_ls_location_info(self):
-        # Get the current recording_session_id
-        stmt = '''
-                SELECT *
-                    FROM `stepSATdb_Flight`.`Recording_Sessions`
-                    ORDER BY `Recording_Sessions`.`recording_session_id` DESC LIMIT 1
-             '''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row_recording_session = self.cursor.fetchone()
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-
         # Get the most recent LinkStar_Duplex_State
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute('''
+                cursor.execute('''
                     SELECT *
                         FROM `stepSATdb_Flight`.`LinkStar_Duplex_State`
-                             WHERE `LinkStar_Duplex_State`.`Recording_Sessions_recording_session_id`= %(recording_session_id)s
+                             WHERE `LinkStar_Duplex_State`.`Recording_Sessions_recording_session_id`= %(session)s
                              ORDER BY `LinkStar_Duplex_State`.`event_key` DESC LIMIT 1
-                ''', row_recording_session)
-                row_LinkStar_Duplex_State = self.cursor.fetchone()
+                ''', self._session_params())
+                row_LinkStar_Duplex_State = cursor.fetchone()
                 # Write the LinkStar location information into the Location_Data table
-                self.cursor.execute('''
+                cursor.execute('''
                    INSERT INTO `stepSATdb_Flight`.`Location_Data` (`recording_session_id`,`latitude`, `longitude`,
                         `time_recorded`, `timestamp_source`, `data_source`, `position_error`) VALUES (
                          %(Recording_Sessions_recording_session_id)s, %(latitude)s, %(longitude)s, %(time_recorded)s, %(time_of_day)s, 'LINKSTAR1', %(position_error)s )
                 ''', row_LinkStar_Duplex_State)
-                self.db.commit()
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -686,23 +921,18 @@ class vms_db(object):
     def increment_session(self):
         # pylint: disable=too-many-statements
         # First increment and create new recording session
-        with self.lock:
+        with self._cursor() as cursor:
 
-            self.cursor.execute('''
+            cursor.execute('''
                 INSERT INTO `stepSATdb_Flight`.`Recording_Sessions` (`datetime_created`) VALUES ( NOW() )
                             ''')
-            self.db.commit()
-
-            # Get the new recording_session_id and then post in the
-            # Recording_Sessions_State table
 
-            stmt = '''
-                SELECT *
-                    FROM `stepSATdb_Flight`.`Recording_Sessions`
-                    ORDER BY `Recording_Sessions`.`recording_session_id` DESC LIMIT 1
-             '''
-            self.cursor.execute(stmt)
-            row_recording_session = self.cursor.fetchone()
+            # The new recording_session_id is the auto-increment key of the
+            # row that was just inserted, use it for the new
+            # Recording_Sessions_State row and refresh the session context.
+            row_recording_session = {'recording_session_id': cursor.lastrowid}
+            self.session.update(row_recording_session['recording_session_id'])
+            self.state.invalidate()
 
             stmt = '''
                 SELECT *
@@ -710,12 +940,12 @@ class vms_db(object):
                     ORDER BY `Recording_Session_State`.`Recording_Sessions_recording_session_id` DESC
                     LIMIT 1
             '''
-            self.cursor.execute(stmt)
-            row_recording_session_state = self.cursor.fetchone()
+            cursor.execute(stmt)
+            row_recording_session_state = cursor.fetchone()
 
             row_recording_session_state['Recording_Sessions_recording_session_id'] = row_recording_session['recording_session_id']
 
-            self.cursor.execute('''
+            cursor.execute('''
                INSERT INTO `stepSATdb_Flight`.`Recording_Session_State` (`state_index`, `current_mode`,
                     `current_flight_phase`, `data_download_push_rate`, `command_poll_rate`, `command_syslog_push_rate`,
                     `ethernet_link_state`, `serial_link_state`, `active_board`, `last_FRNCS_sync`,
@@ -727,7 +957,6 @@ class vms_db(object):
                     %(test_connection)s, %(FRNCS_contact)s, %(active_ground_server)s, %(Recording_Sessions_recording_session_id)s, %(selected_server)s, %(connection_type)s, %(gateway_ip_address)s, %(use_wired_link)s, %(selected_ground_server)s, %(binary_data_push_rate)s, %(flight_data_num_records_download)s, %(flight_data_object_num_records_download)s, %(flight_data_binary_num_records_download)s, %(command_log_num_records_download)s, %(system_messages_num_records_download)s, %(sync_to_ground)s, %(command_push_rate)s,
                     %(linkstar_duplex_state_num_records_download)s, %(location_data_num_records_download)s )
             ''', row_recording_session_state)
-            self.db.commit()
 
             # Create a new record in Flight_Pointers to coincide with the new
             # recording_session_id.
@@ -737,17 +966,16 @@ class vms_db(object):
                  FROM `stepSATdb_Flight`.`Flight_Pointers`
                  ORDER BY `Flight_Pointers`.`Recording_Sessions_recording_session_id` DESC LIMIT 1
              '''
-            self.cursor.execute(stmt)
-            row_flight_pointers = self.cursor.fetchone()
+            cursor.execute(stmt)
+            row_flight_pointers = cursor.fetchone()
 
             row_flight_pointers['Recording_Sessions_recording_session_id'] = row_recording_session['recording_session_id']
-            self.cursor.execute('''
+            cursor.execute('''
                INSERT INTO `stepSATdb_Flight`.`Flight_Pointers` (`Recording_Sessions_recording_session_id`, `flight_data_event_key`,
                     `flight_data_binary_event_key`, `flight_data_object_event_key`, `system_messages_event_key`, `linkstar_duplex_state_event_key` ) VALUES (
                      %(Recording_Sessions_recording_session_id)s, %(flight_data_event_key)s,
                     %(flight_data_binary_event_key)s, %(flight_data_object_event_key)s, %(system_messages_event_key)s, %(linkstar_duplex_state_event_key)s )
             ''', row_flight_pointers)
-            self.db.commit()
 
             # Update LinkStar Duplex information - the new recording_session_id information
             stmt = '''
@@ -755,16 +983,15 @@ class vms_db(object):
                     FROM `stepSATdb_Flight`.`LinkStar_Duplex_Information`
                     ORDER BY `LinkStar_Duplex_Information`.`esn` DESC LIMIT 1
              '''
-            self.cursor.execute(stmt)
-            row_linkStar_duplex_information = self.cursor.fetchone()
+            cursor.execute(stmt)
+            row_linkStar_duplex_information = cursor.fetchone()
 
             row_linkStar_duplex_information['current_recording_session'] = row_recording_session['recording_session_id']
-            self.cursor.execute('''
+            cursor.execute('''
                 UPDATE `stepSATdb_Flight`.`LinkStar_Duplex_Information`
                     SET `LinkStar_Duplex_Information`.`current_recording_session` = %(current_recording_session)s
                     WHERE `LinkStar_Duplex_Information`.`esn` = %(esn)s
             ''', row_linkStar_duplex_information)
-            self.db.commit()
 
             #  With a new Recording_Session_State we need to download it to the ground station.
             if not os.path.exists('/opt/qs/tmp'):
@@ -783,27 +1010,26 @@ class vms_db(object):
                 SELECT * FROM `stepSATdb_Flight`.`Recording_Session_State` INTO OUTFILE '/opt/qs/tmp/Recording_Session_State.csv'
                        FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY '\\\\' LINES TERMINATED BY '\n'
            '''
-            with self.lock:
-                self.cursor.execute(stmt)
+            with self._cursor() as cursor:
+                cursor.execute(stmt)
 
             # set flag to indicate file is ready for download
             stmt_write_pointer = '''
                 UPDATE `stepSATdb_Flight`.`Flight_Pointers`
                     SET `Flight_Pointers`.`recording_session_state_rt` = 1
-                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                            SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                                FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
+                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=%(session)s
             '''
-            with self.lock:
-                self.cursor.execute(stmt_write_pointer)
+            with self._cursor() as cursor:
+                cursor.execute(stmt_write_pointer, self._session_params())
 
             # ---- The time the last sync of the data occurred with the ground ----
             stmt_write_timesync = '''
                 UPDATE `stepSATdb_Flight`.`Recording_Session_State`
-                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW() ORDER BY Recording_Sessions_recording_session_id DESC LIMIT 1
+                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW()
+                    WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=%(session)s
             '''
-            with self.lock:
-                self.cursor.execute(stmt_write_timesync)
+            with self._cursor() as cursor:
+                cursor.execute(stmt_write_timesync, self._session_params())
 
             #  Since a new Flight_Pointers record was created this needs to be added to the ground station.
             if not os.path.exists('/opt/qs/tmp'):
@@ -822,27 +1048,26 @@ class vms_db(object):
                 SELECT * FROM `stepSATdb_Flight`.`Flight_Pointers` INTO OUTFILE '/opt/qs/tmp/Flight_Pointers.csv'
                        FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY '\\\\' LINES TERMINATED BY '\n'
             '''
-            with self.lock:
-                self.cursor.execute(stmt)
+            with self._cursor() as cursor:
+                cursor.execute(stmt)
 
             # set flag to indicate file is ready for download
             stmt_write_pointer = '''
                 UPDATE `stepSATdb_Flight`.`Flight_Pointers`
                     SET `Flight_Pointers`.`flight_pointers_rt` = 1
-                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                            SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                                FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
+                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=%(session)s
             '''
-            with self.lock:
-                self.cursor.execute(stmt_write_pointer)
+            with self._cursor() as cursor:
+                cursor.execute(stmt_write_pointer, self._session_params())
 
             # ---- The time the last sync of the data occurred with the ground ----
             stmt_write_timesync = '''
                 UPDATE `stepSATdb_Flight`.`Recording_Session_State`
-                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW() ORDER BY Recording_Sessions_recording_session_id DESC LIMIT 1
+                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW()
+                    WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=%(session)s
             '''
-            with self.lock:
-                self.cursor.execute(stmt_write_timesync)
+            with self._cursor() as cursor:
+                cursor.execute(stmt_write_timesync, self._session_params())
 
     def get_db_ground_args(self):
         # Retrieve ground server identifying information
@@ -850,9 +1075,9 @@ class vms_db(object):
            SELECT *
                FROM `stepSATdb_Flight`.`QS_Servers` LIMIT 1
         '''
-        with self.lock:
-            self.cursor.execute(stmt)
-            all_servers = self.cursor.fetchone()
+        with self._cursor() as cursor:
+            cursor.execute(stmt)
+            all_servers = cursor.fetchone()
         print stmt
         if all_servers['selected_server'] == 'TEST':
             selected_server = {
@@ -895,135 +1120,97 @@ class vms_db(object):
         print selected_server
         return selected_server
 
-    def sync_selected_db_table(self, selected_table_name):
-        # ----Get event_key number from Flight_Pointers table ----
-        # print "test"
-        stmt_event_key = '''
-            SELECT `{}_event_key`, `{}_rt` FROM `stepSATdb_Flight`.`Flight_Pointers`
-                WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                    SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                        FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
-        '''.format(string.lower(selected_table_name), string.lower(selected_table_name))
-        print stmt_event_key
-        print "******"
-        with self.lock:
-            self.cursor.execute(stmt_event_key)
-            row_flight_pointers_data = self.cursor.fetchall()
-            row_flight_pointers = row_flight_pointers_data[0]
-            print '{}_event_key'.format(string.lower(selected_table_name))
-            event_key = row_flight_pointers['{}_event_key'.format(string.lower(selected_table_name))]
-            file_flag = row_flight_pointers['{}_rt'.format(string.lower(selected_table_name))]
-        print event_key
-        print file_flag
-        if file_flag == 0 and event_key > 0:
-
-            print "Writing table ****"
-
-            if not os.path.exists('/opt/qs/tmp'):
-                os.mkdir('/opt/qs/tmp')
-
-            uid = pwd.getpwnam("mysql").pw_uid
-            gid = grp.getgrnam("mysql").gr_gid
-            if not os.stat('/opt/qs/tmp').st_uid == uid:
-                os.chown('/opt/qs/tmp', uid, gid)
-
-            if os.path.exists('/opt/qs/tmp/{}.csv'.format(selected_table_name)):
-                os.remove('/opt/qs/tmp/{}.csv'.format(selected_table_name))
-
-            # ----Get number of records to download from Recording_Session_State table----
-            stmt_num_records = '''
-                SELECT `{}_num_records_download` FROM `stepSATdb_Flight`.`Recording_Session_State`
-                    WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=(
-                        SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                            FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
-            '''.format(string.lower(selected_table_name))
-            print stmt_num_records
-            with self.lock:
-                self.cursor.execute(stmt_num_records)
-                num_records = self.cursor.fetchone()
-
-            # ----Formulate the statement to write the selected table to the file----
-            print "outfile write ***"
-            stmt_data_write = '''
-                SELECT * FROM `stepSATdb_Flight`.`{}` WHERE event_key>={} LIMIT {} INTO OUTFILE '/opt/qs/tmp/{}.csv'
-                    FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY '\\\\' LINES TERMINATED BY '\n'
-            '''.format(selected_table_name, event_key, num_records['{}_num_records_download'.format(string.lower(selected_table_name))], selected_table_name)
-            # print stmt_data_write
-            with self.lock:
-                # pylint: disable=bare-except
-                try:
-                    self.cursor.execute(stmt_data_write)
-                except KeyboardInterrupt as e:
-                    raise e
-                except:
-                    # TODO: consider writing to syslog or message log
-                    pass
-
-            # ----Update the event_key pointer for next upload ----
-            stmt_highest_pointer = '''SELECT MAX(`event_key`) AS 'pointer' FROM `stepSATdb_Flight`.`{}`'''.format(selected_table_name)
-            with self.lock:
-                self.cursor.execute(stmt_highest_pointer)
-                highest_pointer = self.cursor.fetchone()
-
-            last_used_key = (event_key + num_records['{}_num_records_download'.format(string.lower(selected_table_name))])
-            print "--> {} and the last used key {} and higest pointer {}".format(stmt_highest_pointer, last_used_key, highest_pointer)
-            if highest_pointer['pointer'] <= last_used_key:
-                new_event_key = highest_pointer['pointer']
-            else:
-                new_event_key = last_used_key
-
-            # set flag to indicate file is ready for download and update pointer
-            stmt_write_pointer = '''
-                UPDATE `stepSATdb_Flight`.`Flight_Pointers`
-                    SET `Flight_Pointers`.`{}_event_key` = {}, `Flight_Pointers`.`{}_rt` = 1
-                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                            SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                                FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
-            '''.format(string.lower(selected_table_name), new_event_key, string.lower(selected_table_name))
-            print stmt_write_pointer
-            with self.lock:
-                self.cursor.execute(stmt_write_pointer)
-
-        # ---- The time the last sync of the data occurred with the ground ----
-            stmt_write_timesync = '''
-                UPDATE `stepSATdb_Flight`.`Recording_Session_State`
-                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW() ORDER BY Recording_Sessions_recording_session_id DESC LIMIT 1
-            '''
-            with self.lock:
-                self.cursor.execute(stmt_write_timesync)
-            # This case means we just created a file from the table and it is ready to be downloaded
-            return True
-        elif event_key == 0:
-            # This case means table has NO data, no file was generated and there is nothing to download
-            return False
-        else:
-            # This case means table the previous generated file has NOT been downloaded yet; try and communicate with the ground again.
-            return True
+    def sync_watermark(self, table):
+        # Returns (watermark, legacy) for a table.  The watermark is the
+        # event_key of the newest row of the table that has been acknowledged
+        # by the ground.  The keys are unique across sessions so the newest
+        # watermark of any session is used.  legacy is True if the key was
+        # saved by the file based sync, which saved the key of the next row
+        # to export instead.  A new session copies the keys but not the
+        # flags, so a flagged row wins a tie.
+        stmt = '''
+            SELECT `{0}_event_key` AS 'watermark', `{0}_rt` AS 'flag' FROM `stepSATdb_Flight`.`Flight_Pointers`
+                ORDER BY `{0}_event_key` DESC, `{0}_rt` DESC LIMIT 1
+        '''.format(string.lower(table))
+        with self._cursor() as cursor:
+            cursor.execute(stmt)
+            row = cursor.fetchone()
+        if row and row['watermark']:
+            return (int(row['watermark']), row['flag'] != SYNC_WATERMARK_ACKED)
+        return (0, False)
+
+    def sync_max_key(self, table):
+        # Returns the event_key of the newest row of the table
+        stmt = '''
+            SELECT MAX(`event_key`) AS 'max_key' FROM `stepSATdb_Flight`.`{}`
+        '''.format(table)
+        with self._cursor() as cursor:
+            cursor.execute(stmt)
+            row = cursor.fetchone()
+        if row and row['max_key']:
+            return int(row['max_key'])
+        return 0
+
+    def sync_columns(self, table):
+        # Returns the column names of a table
+        stmt = '''
+            SELECT * FROM `stepSATdb_Flight`.`{}` LIMIT 0
+        '''.format(table)
+        with self._cursor(dictionary=False) as cursor:
+            cursor.execute(stmt)
+            cursor.fetchall()
+            return cursor.column_names
+
+    def read_sync_rows(self, table, watermark, limit):
+        # Returns the column names and the rows (as tuples) of a table that
+        # come after the watermark, oldest first.
+        stmt = '''
+            SELECT * FROM `stepSATdb_Flight`.`{}` WHERE `event_key` > %s ORDER BY `event_key` LIMIT {}
+        '''.format(table, int(limit))
+        with self._cursor(dictionary=False) as cursor:
+            cursor.execute(stmt, (watermark,))
+            rows = cursor.fetchall()
+            return (cursor.column_names, rows)
+
+    def ack_sync_watermark(self, table, watermark):
+        # Saves the newest event_key of the table that the ground has
+        # committed, and the time the last sync with the ground occurred.
+        # The flag marks the key as an acknowledged row (see sync_watermark).
+        stmt_write_pointer = '''
+            UPDATE `stepSATdb_Flight`.`Flight_Pointers`
+                SET `Flight_Pointers`.`{0}_event_key` = %(watermark)s, `Flight_Pointers`.`{0}_rt` = %(flag)s
+                    WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=%(session)s
+        '''.format(string.lower(table))
+        stmt_write_timesync = '''
+            UPDATE `stepSATdb_Flight`.`Recording_Session_State`
+                SET `Recording_Session_State`.`last_FRNCS_sync` = NOW()
+                WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=%(session)s
+        '''
+        params = self._session_params(watermark=watermark, flag=SYNC_WATERMARK_ACKED)
+        with self._transaction() as cursor:
+            cursor.execute(stmt_write_pointer, params)
+            cursor.execute(stmt_write_timesync, params)
 
     def reset_sync_flag(self, selected_table_name):
         # set flag to indicate file is ready to be deleted and a new one written; the old file was written to the ground
         stmt_update_flag = '''
             UPDATE `stepSATdb_Flight`.`Flight_Pointers`
                 SET `Flight_Pointers`.`{}_rt` = 0
-                    WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                        SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                            FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
+                    WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=%(session)s
         '''.format(string.lower(selected_table_name))
         # print stmt_update_flag
-        with self.lock:
-            self.cursor.execute(stmt_update_flag)
+        with self._cursor() as cursor:
+            cursor.execute(stmt_update_flag, self._session_params())
 
     def sync_recording_sessions(self):
         # ----Get file usage flag from Flight_Pointers table ----
         stmt_flag_key = '''
             SELECT `recording_sessions_rt` FROM `stepSATdb_Flight`.`Flight_Pointers`
-                WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                    SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                        FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
+                WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=%(session)s
         '''
-        with self.lock:
-            self.cursor.execute(stmt_flag_key)
-            row_flight_pointers = self.cursor.fetchone()
+        with self._cursor() as cursor:
+            cursor.execute(stmt_flag_key, self._session_params())
+            row_flight_pointers = cursor.fetchone()
             file_flag = row_flight_pointers['recording_sessions_rt']
 
         if file_flag == 0:
@@ -1044,40 +1231,37 @@ class vms_db(object):
                 SELECT * FROM `stepSATdb_Flight`.`Recording_Sessions` INTO OUTFILE '/opt/qs/tmp/recording_sessions.csv'
                    FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY '\\\\' LINES TERMINATED BY '\n'
                 '''
-            with self.lock:
-                self.cursor.execute(stmt)
+            with self._cursor() as cursor:
+                cursor.execute(stmt)
 
             # set flag to indicate file is ready for download
             stmt_write_pointer = '''
                 UPDATE `stepSATdb_Flight`.`Flight_Pointers`
                     SET `Flight_Pointers`.`recording_sessions_rt` = 1
-                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                            SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                                FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
+                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=%(session)s
             '''
-            with self.lock:
-                self.cursor.execute(stmt_write_pointer)
+            with self._cursor() as cursor:
+                cursor.execute(stmt_write_pointer, self._session_params())
 
             # ---- The time the last sync of the data occurred with the ground ----
             stmt_write_timesync = '''
                 UPDATE `stepSATdb_Flight`.`Recording_Session_State`
-                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW() ORDER BY Recording_Sessions_recording_session_id DESC LIMIT 1
+                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW()
+                    WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=%(session)s
             '''
-            with self.lock:
-                self.cursor.execute(stmt_write_timesync)
+            with self._cursor() as cursor:
+                cursor.execute(stmt_write_timesync, self._session_params())
         return True
 
     def sync_recording_session_state(self):
         # ----Get file usage flag from Flight_Pointers table ----
         stmt_flag_key = '''
             SELECT `recording_session_state_rt` FROM `stepSATdb_Flight`.`Flight_Pointers`
-                WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                    SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                        FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
+                WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=%(session)s
         '''
-        with self.lock:
-            self.cursor.execute(stmt_flag_key)
-            row_flight_pointers = self.cursor.fetchone()
+        with self._cursor() as cursor:
+            cursor.execute(stmt_flag_key, self._session_params())
+            row_flight_pointers = cursor.fetchone()
             file_flag = row_flight_pointers['recording_session_state_rt']
 
         if file_flag == 0:
@@ -1098,40 +1282,37 @@ class vms_db(object):
                 SELECT * FROM `stepSATdb_Flight`.`Recording_Session_State` INTO OUTFILE '/opt/qs/tmp/Recording_Session_State.csv'
                    FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY '\\\\' LINES TERMINATED BY '\n'
                 '''
-            with self.lock:
-                self.cursor.execute(stmt)
+            with self._cursor() as cursor:
+                cursor.execute(stmt)
 
             # set flag to indicate file is ready for download
             stmt_write_pointer = '''
                 UPDATE `stepSATdb_Flight`.`Flight_Pointers`
                     SET `Flight_Pointers`.`recording_session_state_rt` = 1
-                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                            SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                                FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
+                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=%(session)s
             '''
-            with self.lock:
-                self.cursor.execute(stmt_write_pointer)
+            with self._cursor() as cursor:
+                cursor.execute(stmt_write_pointer, self._session_params())
 
             # ---- The time the last sync of the data occurred with the ground ----
             stmt_write_timesync = '''
                 UPDATE `stepSATdb_Flight`.`Recording_Session_State`
-                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW() ORDER BY Recording_Sessions_recording_session_id DESC LIMIT 1
+                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW()
+                    WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=%(session)s
             '''
-            with self.lock:
-                self.cursor.execute(stmt_write_timesync)
+            with self._cursor() as cursor:
+                cursor.execute(stmt_write_timesync, self._session_params())
         return True
 
     def sync_flight_pointers(self):
         # ----Get file usage flag from Flight_Pointers table ----
         stmt_flag_key = '''
             SELECT `flight_pointers_rt` FROM `stepSATdb_Flight`.`Flight_Pointers`
-                WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                    SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                        FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
+                WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=%(session)s
         '''
-        with self.lock:
-            self.cursor.execute(stmt_flag_key)
-            row_flight_pointers = self.cursor.fetchone()
+        with self._cursor() as cursor:
+            cursor.execute(stmt_flag_key, self._session_params())
+            row_flight_pointers = cursor.fetchone()
             file_flag = row_flight_pointers['flight_pointers_rt']
 
         if file_flag == 0:
@@ -1152,27 +1333,26 @@ class vms_db(object):
                 SELECT * FROM `stepSATdb_Flight`.`Flight_Pointers` INTO OUTFILE '/opt/qs/tmp/Flight_Pointers.csv'
                    FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY '\\\\' LINES TERMINATED BY '\n'
                 '''
-            with self.lock:
-                self.cursor.execute(stmt)
+            with self._cursor() as cursor:
+                cursor.execute(stmt)
 
             # set flag to indicate file is ready for download
             stmt_write_pointer = '''
                 UPDATE `stepSATdb_Flight`.`Flight_Pointers`
                     SET `Flight_Pointers`.`flight_pointers_rt` = 1
-                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=(
-                            SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                                FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
+                        WHERE `Flight_Pointers`.`Recording_Sessions_recording_session_id`=%(session)s
             '''
-            with self.lock:
-                self.cursor.execute(stmt_write_pointer)
+            with self._cursor() as cursor:
+                cursor.execute(stmt_write_pointer, self._session_params())
 
             # ---- The time the last sync of the data occurred with the ground ----
             stmt_write_timesync = '''
                 UPDATE `stepSATdb_Flight`.`Recording_Session_State`
-                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW() ORDER BY Recording_Sessions_recording_session_id DESC LIMIT 1
+                    SET `Recording_Session_State`.`last_FRNCS_sync` = NOW()
+                    WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=%(session)s
             '''
-            with self.lock:
-                self.cursor.execute(stmt_write_timesync)
+            with self._cursor() as cursor:
+                cursor.execute(stmt_write_timesync, self._session_params())
         return True
 
 #    def read_command_log(self):
@@ -1197,71 +1377,65 @@ class vms_db(object):
         print commands
         if isinstance(commands, (bool)):
             commands = []
-        if commands:
-            for row in commands:
-                stmt = '''
-                    INSERT INTO `stepSATdb_Flight`.`Command_Log` (`time_of_command`, `Recording_Sessions_recording_session_id`,`command`,
-                        `command_state`, `command_data`, `priority`, `source`, `read_from_sv`, `pushed_to_ground`, `command_id`)
-                        VALUES (%(time_of_command)s,%(Recording_Sessions_recording_session_id)s,%(command)s,%(command_state)s,%(command_data)s,%(priority)s,%(source)s,1, 1, %(command_id)s)
-                        ON DUPLICATE KEY UPDATE `Command_Log`.`read_from_sv` = 1 , `Command_Log`.`command_state` = %(command_state)s
-                '''
-                with self.lock:
-                    try:
-                        self.cursor.execute(stmt, row)
-                        self.db.commit()
-                    except mysql.connector.Error as err:
-                        print("MySQL Error: {}".format(err))
-                        syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-                # Add new command state -> Pending
-                stmt = '''
-                    INSERT INTO `stepSATdb_Flight`.`Command_Log` (`time_of_command`, `Recording_Sessions_recording_session_id`,`command`,
-                        `command_state`, `command_data`, `priority`, `source`, `read_from_sv`, `pushed_to_ground`, `command_id`)
-                        VALUES (NOW(),%(Recording_Sessions_recording_session_id)s,%(command)s,'Pending',%(command_data)s,%(priority)s,%(source)s,0, 0, %(command_id)s)
-                        ON DUPLICATE KEY UPDATE `Command_Log`.`read_from_sv` = 1 , `Command_Log`.`command_state` = 'Pending'
-                '''
-                with self.lock:
-                    try:
-                        self.cursor.execute(stmt, row)
-                        self.db.commit()
-                    except mysql.connector.Error as err:
-                        print("MySQL Error: {}".format(err))
-                        syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        if not commands:
+            return True
+
+        # Each ground command is recorded with its ground state, and a new
+        # Pending state is added so the command is run.  All of the commands
+        # are ingested with two multi-row statements in one transaction.
+        columns = '''`time_of_command`, `Recording_Sessions_recording_session_id`,`command`,
+                `command_state`, `command_data`, `priority`, `source`, `read_from_sv`, `pushed_to_ground`, `command_id`'''
+        ground_stmt = '''
+            INSERT INTO `stepSATdb_Flight`.`Command_Log` ({})
+                VALUES {}
+                ON DUPLICATE KEY UPDATE `Command_Log`.`read_from_sv` = 1 , `Command_Log`.`command_state` = VALUES(`command_state`)
+        '''.format(columns, ','.join(['(%s,%s,%s,%s,%s,%s,%s,1, 1, %s)'] * len(commands)))
+        ground_params = []
+        for row in commands:
+            ground_params.extend([row['time_of_command'], row['Recording_Sessions_recording_session_id'], row['command'], row['command_state'], row['command_data'], row['priority'], row['source'], row['command_id']])
+
+        # Add new command state -> Pending
+        pending_stmt = '''
+            INSERT INTO `stepSATdb_Flight`.`Command_Log` ({})
+                VALUES {}
+                ON DUPLICATE KEY UPDATE `Command_Log`.`read_from_sv` = 1 , `Command_Log`.`command_state` = 'Pending'
+        '''.format(columns, ','.join(["(NOW(),%s,%s,'Pending',%s,%s,%s,0, 0, %s)"] * len(commands)))
+        pending_params = []
+        for row in commands:
+            pending_params.extend([row['Recording_Sessions_recording_session_id'], row['command'], row['command_data'], row['priority'], row['source'], row['command_id']])
+
+        try:
+            with self._transaction() as cursor:
+                cursor.execute(ground_stmt, ground_params)
+                cursor.execute(pending_stmt, pending_params)
+            return True
+        except mysql.connector.Error as err:
+            print("MySQL Error: {}".format(err))
+            syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+            return False
 
     def update_sv_command_log(self, commands):
         # updates relevant row(s) in sv command log
-        if commands:
-            for row in commands:
-                stmt = '''
-                    UPDATE `stepSATdb_Flight`.`Command_Log`
-                        SET `Command_Log`.`pushed_to_ground` = 1
-                            WHERE `Command_Log`.`Recording_Sessions_recording_session_id` = %(Recording_Sessions_recording_session_id)s
-                            AND `Command_Log`.`time_of_command` = %(time_of_command)s
-                '''
-                with self.lock:
-                    try:
-                        self.cursor.execute(stmt, row)
-                        self.db.commit()
-                    except mysql.connector.Error as err:
-                        print("MySQL Error: {}".format(err))
-                        syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        if not commands:
+            return
 
-    def check_test_connection(self):
         stmt = '''
-            SELECT `Recording_Session_State`.`test_connection`
-                FROM `stepSATdb_Flight`.`Recording_Session_State`
-                WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=(
-                    SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                        FROM `stepSATdb_Flight`.`Recording_Sessions`
-                )
-            LIMIT 1
-        '''
-        # print stmt
-        with self.lock:
-            self.cursor.execute(stmt)
-            results = self.cursor.fetchone()
+            UPDATE `stepSATdb_Flight`.`Command_Log`
+                SET `Command_Log`.`pushed_to_ground` = 1
+                    WHERE (`Command_Log`.`Recording_Sessions_recording_session_id`, `Command_Log`.`time_of_command`) IN ({})
+        '''.format(','.join(['(%s,%s)'] * len(commands)))
+        params = []
+        for row in commands:
+            params.extend([row['Recording_Sessions_recording_session_id'], row['time_of_command']])
+        try:
+            with self._cursor() as cursor:
+                cursor.execute(stmt, params)
+        except mysql.connector.Error as err:
+            print("MySQL Error: {}".format(err))
+            syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
 
-        connection = results['test_connection']
-        return connection
+    def check_test_connection(self):
+        return self.session_state().flag('test_connection')
 
     def read_system_applications(self):
         # Returns the System_Application rows of the sv db
@@ -1269,10 +1443,10 @@ class vms_db(object):
             SELECT *
                 FROM `stepSATdb_Flight`.`System_Applications`
         '''
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                system_applications_data = self.cursor.fetchall()
+                cursor.execute(stmt)
+                system_applications_data = cursor.fetchall()
                 # print commands
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
@@ -1304,10 +1478,10 @@ class vms_db(object):
         '''.format(command_state_value)
         print stmt
         row = ''
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
+                cursor.execute(stmt)
+                row = cursor.fetchone()
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -1317,33 +1491,55 @@ class vms_db(object):
         else:
             return None
             
+    def start_flight_data_writer(self, **kwargs):
+        """
+        Starts a background writer that batches the samples passed to
+        write_flight_data() into multi-row INSERTs.  The keyword arguments are
+        passed to flight_data_writer.FlightDataWriter.
+        """
+        if not self.flight_data_writer:
+            self.flight_data_writer = flight_data_writer.FlightDataWriter(self, **kwargs)
+            self.flight_data_writer.start()
+        return self.flight_data_writer
+
+    def stop_flight_data_writer(self):
+        """
+        Writes any queued Flight_Data samples and stops the background writer.
+        """
+        writer = getattr(self, 'flight_data_writer', None)
+        if writer:
+            self.flight_data_writer = None
+            writer.stop(flush=True)
+
+    def flush_flight_data(self):
+        if self.flight_data_writer:
+            return self.flight_data_writer.flush()
+        return 0
+
     def write_flight_data(self, parameter_id, parameter_data):
-        # Get current recording session
+        # If the background writer is running, just queue the sample.  Its
+        # time_stamp is taken from the VMS clock when the sample is queued
+        # rather than from NOW() when the row is written.  The sample is only
+        # cached if the writer accepted it.
+        if self.flight_data_writer:
+            accepted = self.flight_data_writer.write(parameter_id, parameter_data)
+            if accepted:
+                self.last_values.put('Flight_Data', parameter_id, 'parameter_value', parameter_data)
+            return accepted
+
+        # Write data to the current recording session
         stmt = '''
-                SELECT `Recording_Sessions`.`recording_session_id`
-                    FROM `stepSATdb_Flight`.`Recording_Sessions`
-                    ORDER BY `Recording_Sessions`.`recording_session_id` DESC LIMIT 1
+            INSERT INTO `Flight_Data`( `time_stamp`, `parameter_id`, `Recording_Sessions_recording_session_id`, `parameter_value`) VALUES (NOW(),%(parameter_id)s,%(session)s,%(parameter_value)s)
         '''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row_recording_session = self.cursor.fetchone()
-                rec_id = row_recording_session['recording_session_id']
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-        
-        # Write data
-        stmt = '''
-            INSERT INTO `Flight_Data`( `time_stamp`, `parameter_id`, `Recording_Sessions_recording_session_id`, `parameter_value`) VALUES (NOW(),'{}','{}','{}')
-        '''.format(parameter_id, rec_id, parameter_data)
         print stmt
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
+                cursor.execute(stmt, self._session_params(parameter_id=parameter_id, parameter_value=parameter_data))
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+                return
+        self.last_values.put('Flight_Data', parameter_id, 'parameter_value', parameter_data)
 
     def get_stx3_ascii_message(self, packet_id):
        # Get the message 
@@ -1352,10 +1548,10 @@ class vms_db(object):
         '''.format(packet_id)
         print stmt
         row = ''
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
+                cursor.execute(stmt)
+                row = cursor.fetchone()
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -1370,9 +1566,9 @@ class vms_db(object):
             UPDATE `LinkStarSTX3_Messages` SET `message`= '{}', `time_sent`= NOW() WHERE `LinkStarSTX3_Messages`.`packet_id` = '{}'
         '''.format(message_packet_ascii, packet_id)
         print stmt
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
+                cursor.execute(stmt)
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -1381,103 +1577,32 @@ class vms_db(object):
     def archive_packet( self,message_packet_ascii, packet_id ):
     
         stmt = '''
-            INSERT INTO `LinkStarSTX3_Message_History`( `packet_id`, `message`, `time_sent`) VALUES ('{}','{}',NOW())
-        '''.format(packet_id, message_packet_ascii )
-        print stmt
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-                
-        # Remove older archive messages based on max_packets_stored in LinkStar_Simplex_Information
-        # Get max_packets_stored
-        stmt = '''
-            SELECT `LinkStar_Simplex_Information`.`max_packets_stored` FROM `stepSATdb_Flight`.`LinkStar_Simplex_Information`
+            INSERT INTO `LinkStarSTX3_Message_History`( `packet_id`, `message`, `time_sent`) VALUES (%s,%s,NOW())
         '''
-
-        with self.lock:
+        print stmt
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
-                max_packets_stored = row['max_packets_stored']
-                print max_packets_stored
+                cursor.execute(stmt, (packet_id, message_packet_ascii))
+                # Older archive messages beyond max_packets_stored (from
+                # LinkStar_Simplex_Information) are removed by the retention
+                # manager.
+                self.retention.note_insert('LinkStarSTX3_Message_History', cursor.lastrowid)
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-        
-        # Get highest event_key
-        stmt = '''
-            SELECT * FROM `LinkStarSTX3_Message_History` ORDER BY `LinkStarSTX3_Message_History`.`event_key` DESC LIMIT 1
-        '''
 
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
-                max_event_key = row['event_key']
-                print max_event_key
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-        
-        # Calculate which event key to removed from. If less then zero skip removal.
-        event_key_delete_point = max_event_key - max_packets_stored
-        print event_key_delete_point
-        
-        if event_key_delete_point > 0:
-            stmt = '''
-                DELETE FROM `LinkStarSTX3_Message_History` WHERE `event_key` <  '{}'
-            '''.format(event_key_delete_point)
-            print stmt
-            with self.lock:
-                try:
-                    self.cursor.execute(stmt)
-                except mysql.connector.Error as err:
-                    print("MySQL Error: {}".format(err))
-                    syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-        
         return True
 
     def get_packet_type(self, packet_id):
-       # Get the GPS info if it exists 
-        stmt = '''
-            SELECT * FROM `Packets_Types` WHERE `packet_id` = '{}'
-        '''.format(packet_id)
-        print stmt
-        row = ''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
-                return row['packet_type']
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-
-        if row['packet_type']:
+        row = self.settings.packet_type(packet_id)
+        if row and row['packet_type']:
             return row['packet_type']
         else:
             return None
 
     def get_packet_parameter_id(self, packet_id):
-       # Get the GPS info if it exists 
-        stmt = '''
-            SELECT * FROM `Packets_Types` WHERE `packet_id` = '{}'
-        '''.format(packet_id)
-        print stmt
-        row = ''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-
-        print row['parameter_id']
-        if row['parameter_id']:
+        row = self.settings.packet_type(packet_id)
+        if row and row['parameter_id']:
             return row['parameter_id']
         else:
             return None
@@ -1490,10 +1615,10 @@ class vms_db(object):
         '''
         print stmt
         row = ''
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
+                cursor.execute(stmt)
+                row = cursor.fetchone()
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -1512,10 +1637,10 @@ class vms_db(object):
              '''
         print stmt
         row = ''
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
+                cursor.execute(stmt)
+                row = cursor.fetchone()
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -1527,70 +1652,24 @@ class vms_db(object):
     
 
     def gps_write_location_table(self,latitude,longitude, speed, dateTimeUTC, altitude, dataSource, heading):
-        # Get the current recording_session_id
-        stmt = '''
-                SELECT *
-                    FROM `stepSATdb_Flight`.`Recording_Sessions`
-                    ORDER BY `Recording_Sessions`.`recording_session_id` DESC LIMIT 1
-             '''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row_recording_session = self.cursor.fetchone()
-                rec_id = row_recording_session['recording_session_id']
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-
         stmt = '''
                    INSERT INTO `stepSATdb_Flight`.`Location_Data` (`recording_session_id`,`latitude`, `longitude`, `hspeed`,
                         `time_recorded`, `timestamp_source`, `altitude`,`data_source`, `heading`) VALUES (
-                         '{}', '{}', '{}', '{}',NOW(), '{}', '{}','{}', '{}' )
-                '''.format(rec_id,latitude, longitude, speed, dateTimeUTC, altitude, dataSource, heading)
+                         %(session)s, %(latitude)s, %(longitude)s, %(speed)s, NOW(), %(timestamp)s, %(altitude)s, %(source)s, %(heading)s )
+                '''
+        params = self._session_params(latitude=latitude, longitude=longitude, speed=speed, timestamp=dateTimeUTC,
+                                      altitude=altitude, source=dataSource, heading=heading)
         print stmt
-        with self.lock:
+        with self._cursor() as cursor:
             try:
                 # Write the GPS location information into the Location_Data table
-                self.cursor.execute(stmt)
-                self.db.commit()
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-                
-        # Only 60,000 location points shall be saved.  Remove older records beyond the 60,000 record count.
-
-        # Get highest event_key
-        stmt = '''
-            SELECT * FROM `Location_Data` ORDER BY `Location_Data`.`event_key` DESC LIMIT 1
-        '''
-
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
-                max_event_key = row['event_key']
-                print max_event_key
+                cursor.execute(stmt, params)
+                # Only 60,000 location points shall be saved, older records
+                # are removed by the retention manager.
+                self.retention.note_insert('Location_Data', cursor.lastrowid)
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-        
-        # Calculate which event key to removed from. If less then zero skip removal.
-        event_key_delete_point = max_event_key - 60000
-        print "*** ---> GPS clean-up delete point value..."
-        print event_key_delete_point
-        
-        if event_key_delete_point > 0:
-            stmt = '''
-                DELETE FROM `Location_Data` WHERE `event_key` <  '{}'
-            '''.format(event_key_delete_point)
-            print stmt
-            with self.lock:
-                try:
-                    self.cursor.execute(stmt)
-                except mysql.connector.Error as err:
-                    print("MySQL Error: {}".format(err))
-                    syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-
 
     def gps_write_GPS_fix_data(self, fixVal, gpsFixTypeVal, satellites_being_tracked, satellites_in_view, pdop, vdop, hdop):
         # Get GPS part_key - the configuration supports only one active GPS unit
@@ -1599,10 +1678,10 @@ class vms_db(object):
             SELECT GPS_Information.part_key FROM `GPS_Information`
         '''
         row = ''
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
+                cursor.execute(stmt)
+                row = cursor.fetchone()
                 gps_part_key = row['part_key']
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
@@ -1613,9 +1692,9 @@ class vms_db(object):
             UPDATE `GPS_Information` SET `fix_quality`= '{}', `3d_fix`= '{}', `satellites_in_view`= '{}', `satellites_being_tracked`= '{}', `pdop`= '{}', `vdop`= '{}', `hdop`= '{}' WHERE `GPS_Information`.`part_key` = '{}'
         '''.format(fixVal, gpsFixTypeVal, satellites_in_view, satellites_being_tracked, pdop, vdop, hdop, gps_part_key)
         print stmt
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
+                cursor.execute(stmt)
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
@@ -1623,176 +1702,99 @@ class vms_db(object):
         
     def gps_satellite_data(self, satellites_in_view, satellites_being_tracked, SatellitesInTracked, SatellitesInView):
         # store in stepSATdb_Flight the satellites in view and which satellites are being tracked
-        
-        # build array
-        
-        SatellitesTable=[]
-        for x in range(0, int(len(SatellitesInView)/4)):
-            SatellitesTable.append([SatellitesInView[(4*x)],SatellitesInView[(4*x)+1],SatellitesInView[(4*x)+2],SatellitesInView[(4*x)+3],0])            
-        print SatellitesTable
-        # check if satellite is used in tracking
-        print [row[0] for row in SatellitesTable]
-        searchTable = [row[0] for row in SatellitesTable]
-        if int(len(SatellitesInView)/4) > len(SatellitesInTracked):
-            range_val = len(SatellitesInTracked)
+        satellites = satellite_view_rows(SatellitesInView, SatellitesInTracked)
+        print satellites
+
+        # Only write the satellites that have changed since the last update,
+        # and remove the satellites that are no longer in view.  The first
+        # time through (or after an error) the table contents are unknown so
+        # it is cleared and re-written.
+        previous = self.satellite_view
+        if previous is None:
+            changed = satellites
+            removed = None
         else:
-            range_val = int(len(SatellitesInView)/4)
-        print ' --> range_val: '
-        print range_val
-        for x in range(0, range_val):
-            print SatellitesInTracked[x]
-            if SatellitesInTracked[x] in [row[0] for row in SatellitesTable]:
-                try:
-                    idx = searchTable.index(SatellitesInTracked[x])
-                    SatellitesTable[idx][4] = 1
-                    print 'satellite match'
-                except ValueError:
-                    # no match
-                    print 'error'
-        # write to the database
-        print SatellitesTable
-        
-        # First delete all old satellite tracking records in the table
-        stmt = '''
-            DELETE FROM `GPS_Satellite_View`
-        '''
-        print stmt
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-        
-        # insert new satellite tracking records into the table
-        print "----> satellites in view for DB"
-        print int(len(SatellitesInView)/4)
-        for x in range(0, int(len(SatellitesInView)/4)):
-            stmt = '''
-                INSERT IGNORE INTO `GPS_Satellite_View`(`PRN_number`, `elevation`, `azimuth`, `snr`, `being_tracked`) VALUES ('{}','{}','{}','{}','{}')
-            '''.format(SatellitesTable[x][0], SatellitesTable[x][1], SatellitesTable[x][2], SatellitesTable[x][3], SatellitesTable[x][4])
-            print stmt
-            with self.lock:
-                try:
-                    self.cursor.execute(stmt)
-                except mysql.connector.Error as err:
-                    print("MySQL Error: {}".format(err))
-                    syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+            changed = dict((prn, row) for prn, row in satellites.items() if previous.get(prn) != row)
+            removed = [prn for prn in previous if prn not in satellites]
+
+        if not changed and not removed and previous is not None:
+            return
+
+        try:
+            with self._transaction() as cursor:
+                if removed is None:
+                    cursor.execute('''
+                        DELETE FROM `GPS_Satellite_View`
+                    ''')
+                elif removed:
+                    cursor.execute('''
+                        DELETE FROM `GPS_Satellite_View` WHERE `PRN_number` IN ({})
+                    '''.format(','.join(['%s'] * len(removed))), removed)
+
+                if changed:
+                    stmt = '''
+                        INSERT INTO `GPS_Satellite_View`(`PRN_number`, `elevation`, `azimuth`, `snr`, `being_tracked`) VALUES {}
+                            ON DUPLICATE KEY UPDATE `elevation`=VALUES(`elevation`), `azimuth`=VALUES(`azimuth`), `snr`=VALUES(`snr`), `being_tracked`=VALUES(`being_tracked`)
+                    '''.format(','.join(['(%s,%s,%s,%s,%s)'] * len(changed)))
+                    params = [value for prn in sorted(changed.keys()) for value in (prn,) + changed[prn]]
+                    cursor.execute(stmt, params)
+            self.satellite_view = satellites
+        except mysql.connector.Error as err:
+            self.satellite_view = None
+            print("MySQL Error: {}".format(err))
+            syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+
     def ground_sync_allowed(self):
-         # Verify the user has enabled the radio
-        stmt = '''
-            SELECT `Recording_Session_State`.`sync_to_ground`
-                FROM `stepSATdb_Flight`.`Recording_Session_State`
-                WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=(
-                    SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                        FROM `stepSATdb_Flight`.`Recording_Sessions`
-                ) LIMIT 1
-        '''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                results = self.cursor.fetchone()
-                return results['sync_to_ground']
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-                return 0
-                
+        # Verify the user has enabled the radio
+        return self.session_state().flag('sync_to_ground')
+
     def gps_bypass_allowed(self):
-         # Verify the user has enabled the radio
-        stmt = '''
-            SELECT `Recording_Session_State`.`bypass_gps`
-                FROM `stepSATdb_Flight`.`Recording_Session_State`
-                WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=(
-                    SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-                        FROM `stepSATdb_Flight`.`Recording_Sessions`
-                ) LIMIT 1
-        '''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                results = self.cursor.fetchone()
-                return results['bypass_gps']
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
-                return 0
+        return self.session_state().flag('bypass_gps')
 
     def check_radio_space_use(self):
-        stmt = '''
-            SELECT `LinkStar_Simplex_Information`.`space_use` FROM `LinkStar_Simplex_Information`
-        '''
-        row = ''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
-                spaceUse = row['space_use']
-                print "SPACE USE FLAG"
-                print spaceUse
-                return spaceUse
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        spaceUse = self.settings.simplex('space_use')
+        print "SPACE USE FLAG"
+        print spaceUse
+        return spaceUse
 
     def update_gsn(self, radio_gsn):
         stmt = '''
             UPDATE `LinkStar_Simplex_Information` SET `phone_number`= '{}'
         '''.format(radio_gsn)
         print stmt
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
+                cursor.execute(stmt)
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        self.settings.invalidate()
         return True
         
     def check_timing_reset(self):
-        stmt = '''
-            SELECT `LinkStar_Simplex_Information`.`timing_reset` FROM `LinkStar_Simplex_Information`
-        '''
-        row = ''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
-                timingReset = row['timing_reset']
-                print "timing Reset FLAG"
-                print timingReset
-                return timingReset
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        timingReset = self.settings.simplex('timing_reset')
+        print "timing Reset FLAG"
+        print timingReset
+        return timingReset
     
     def check_alarm_status(self):
-        stmt = '''
-            SELECT `LinkStar_Simplex_Information`.`alarm_enabled` FROM `LinkStar_Simplex_Information`
-        '''
-        row = ''
-        with self.lock:
-            try:
-                self.cursor.execute(stmt)
-                row = self.cursor.fetchone()
-                alarmEnabled = row['alarm_enabled']
-                print "alarm_enabled FLAG"
-                print alarmEnabled
-                return alarmEnabled
-            except mysql.connector.Error as err:
-                print("MySQL Error: {}".format(err))
-                syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        alarmEnabled = self.settings.simplex('alarm_enabled')
+        print "alarm_enabled FLAG"
+        print alarmEnabled
+        return alarmEnabled
                 
     def zero_timing_reset_flag(self):
         stmt = '''
             UPDATE `LinkStar_Simplex_Information` SET `timing_reset`= 0
         '''
         print stmt
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
+                cursor.execute(stmt)
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
                 syslog.syslog(syslog.LOG_DEBUG, "MySQL Error: {}".format(err))
+        self.settings.invalidate()
         return True
 
     def build_time_tuple(self):
@@ -1800,10 +1802,10 @@ class vms_db(object):
         stmt = '''
             SELECT `Location_Data`.`timestamp_source`  FROM `Location_Data` ORDER BY `event_key` DESC LIMIT 1
         '''
-        with self.lock:
+        with self._cursor() as cursor:
             try:
-                self.cursor.execute(stmt)
-                results = self.cursor.fetchone()
+                cursor.execute(stmt)
+                results = cursor.fetchone()
                     
             except mysql.connector.Error as err:
                 print("MySQL Error: {}".format(err))
@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 """
 A module that provides a python interface to the QS/VMS ground database.
+
+Rows synchronized from the flight database are written idempotently: each
+batch (a "chunk") is identified by its table and the range of event_keys it
+holds, and is recorded in the Sync_Chunk_Ledger table in the same transaction
+as its rows.  If the link drops after the ground has committed a chunk but
+before the flight has saved its watermark, the re-sent chunk is found in the
+ledger and discarded without touching the table, and the flight can ask the
+ground for the newest chunk it has committed so that nothing needs to be
+re-sent at all.  Rows are written with INSERT IGNORE, so a row that is re-sent
+in a different chunk is skipped and a retry can never create duplicates or be
+rejected.  Existing rows are never updated: the ground creates rows of its own
+(such as the Pending-Ground commands in Command_Log) whose event_keys may
+match flight rows, and a flight row must not overwrite them.
 """
 
 import syslog
 import sys
-import threading
+import time
 
 # To connect to the QS/VMS database, install with
 #   $ pip install MySQL-python
@@ -17,22 +30,38 @@ import threading
 #   https://pypi.python.org/pypi/setuptools
 import mysql.connector
 
+import db_pool
+
 # Disable some pylint warnings that I don't care about
 # pylint: disable=line-too-long,fixme,invalid-name,too-many-public-methods,too-many-arguments
 #
 # TEMPORARY:
 # pylint: disable=missing-docstring
 
+# The ledger of the chunks that have been committed to the ground, and how
+# long (in seconds) chunks are kept in the ledger.  Only recent chunks can be
+# re-sent, so old entries are pruned at most once every LEDGER_PRUNE_INTERVAL
+# seconds per table.
+LEDGER_TABLE = 'Sync_Chunk_Ledger'
+LEDGER_RETENTION = 7 * 24 * 60 * 60
+LEDGER_PRUNE_INTERVAL = 60 * 60
+
 
 class vms_db_ground(object):
     """
     A class that wraps up the QS/VMS ground database interface.
     """
     # pylint: disable=unused-argument
-    def __init__(self, address, port, cert, username, password, dbname, **kwargs):
-        self.lock = threading.RLock()
-        self.db = None
-        self.cursor = None
+    def __init__(self, address, port, cert, username, password, dbname, pool_size=2, **kwargs):
+        self.pool = None
+        # Connections that use the compressed MySQL protocol, created the
+        # first time a compressed batch is sent.
+        self.compressed_pool = None
+        # Set once the chunk ledger is known to exist, and the time the
+        # ledger entries of each table were last pruned
+        self.ledger_ready = False
+        self.ledger_pruned = {}
+        self.pool_size = pool_size
         self.config = {
             'user': username,
             'password': 'quicksat!1',
@@ -56,16 +85,15 @@ class vms_db_ground(object):
         print "*** EXECUTE GROUND"
         # Test if the connection to the ground DB is still alive
         if self.test_connection():
-            with self.lock:
+            with self.pool.cursor() as cursor:
                 if isinstance(args, list):
-                    self.cursor.executemany(stmt, args)
+                    cursor.executemany(stmt, args)
                 else:
-                    self.cursor.execute(stmt, args)
+                    cursor.execute(stmt, args)
 
-                if self.cursor.with_rows:
-                    return self.cursor.fetchall()
+                if cursor.with_rows:
+                    return cursor.fetchall()
                 else:
-                    self.db.commit()
                     return True
         else:
             return False
@@ -87,7 +115,7 @@ class vms_db_ground(object):
         '''
         # Handle exceptions for this cleanly, errors should get logged to the
         # syslog
-        with self.lock:
+        with self.pool.connection():
             # pylint: disable=bare-except
             try:
                 self._execute(stmt, (msg,))
@@ -96,76 +124,137 @@ class vms_db_ground(object):
 
     def test_connection(self):
         print "++++ In test_connection"
-        with self.lock:
-            if self.db.is_connected():
-                print " #### DB CONNECTED to the Ground #### "
-                if not self.cursor:
-                    self.cursor = self.db.cursor(dictionary=True, buffered=True)
-                return True
-            else:
-                try:
-                    # Try to reconnect once, if that fails we probably need to
-                    # wait until the connection has been re-established.
-                    # if self.cursor:
-                    del self.cursor
-                    self.cursor = None
-                    self.db.reconnect(attempts=1, delay=0)
-                    self.cursor = self.db.cursor(dictionary=True, buffered=True)
-                    print " &&&&&& Trying to Reconnect to the Ground"
-
-                    # When re-establishing mysql connections you usually need
-                    # to re-instantiate any cursors or prepared statements
-                    self.cursor = self.db.cursor(dictionary=True)
+        try:
+            # The pool pings connections that have been idle for a while when
+            # they are checked out, so a connection that has been dropped by
+            # the server will have already been re-established here.
+            with self.pool.connection() as conn:
+                if conn.is_connected():
+                    print " #### DB CONNECTED to the Ground #### "
                     return True
-                except mysql.connector.Error as err:
-                    print "-----> error connecting to the ground <-----------"
-                    syslog.syslog(syslog.LOG_ERR, 'Error reconnecting to ground: {}'.format(err))
+
+                # Try to reconnect once, if that fails we probably need to
+                # wait until the connection has been re-established.
+                print " &&&&&& Trying to Reconnect to the Ground"
+                conn.reconnect(attempts=1, delay=0)
+                return True
+        except mysql.connector.Error as err:
+            print "-----> error connecting to the ground <-----------"
+            syslog.syslog(syslog.LOG_ERR, 'Error reconnecting to ground: {}'.format(err))
         return False
 
-    def open(self):
-        with self.lock:
-            if not self.db:
-                self.db = mysql.connector.connect(**self.config)
+    def ping(self):
+        # Checks that the ground can be reached with a round trip on one of
+        # the pooled connections.  The pool hands out its least recently used
+        # connection, so repeated pings keep all of them alive.  Errors are
+        # passed on to the caller.
+        with self.pool.connection() as conn:
+            conn.ping()
 
-            if self.db and not self.cursor:
-                self.cursor = self.db.cursor(dictionary=True)
+    def open(self):
+        if not self.pool:
+            self.pool = db_pool.get_pool(self.config, self.pool_size)
+        with self.pool.connection():
+            pass
 
     def close(self):
-        with self.lock:
+        if self.pool:
+            self.pool.close()
+        if self.compressed_pool:
+            self.compressed_pool.close()
 
-            if self.cursor:
-                self.cursor.close()
-                # print 'cursor.close'
+    def pool_stats(self):
+        return self.pool.stats()
 
-            if self.db:
-                self.db.close()
-                # print 'db.close'
+    def _compressed_pool(self):
+        if not self.compressed_pool:
+            self.compressed_pool = db_pool.get_pool(dict(self.config, compress=True), 1)
+        return self.compressed_pool
 
-    def sync_selected_db_table(self, selected_table_name):
-        print "----> Printing Selected Table"
-        selected_table_name_quotes = '`{}`'.format(selected_table_name)
+    def _ensure_ledger(self):
+        if self.ledger_ready:
+            return
         stmt = '''
-            LOAD DATA LOCAL INFILE '/opt/qs/tmp/{}.csv'
-                INTO TABLE `stepSATdb_Flight`.{} FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
-                ESCAPED BY '\\\\' LINES TERMINATED BY '\n'
-        '''.format(selected_table_name, selected_table_name_quotes)
-        # stmt_update_last_sync_time = '''
-        #     UPDATE `stepSATdb_Flight`.`Recording_Session_State`
-        #         SET `Recording_Session_State`.`last_FRNCS_sync` = NOW()
-        #             WHERE `Recording_Session_State`.`Recording_Sessions_recording_session_id`=(
-        #                 SELECT MAX(`Recording_Sessions`.`recording_session_id`)
-        #                     FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
-        # '''
-        with self.lock:
-            try:
-                sync_Success = self._execute(stmt)
-                # self._execute(stmt_update_last_sync_time)
-                return sync_Success
-            except mysql.connector.Error as err:
-                print "-----> error connecting to the ground, sync_selected_db_table <-----------"
-                print selected_table_name
-                syslog.syslog(syslog.LOG_ERR, 'Error reconnecting to ground: {}'.format(err))
-                return False
+            CREATE TABLE IF NOT EXISTS `stepSATdb_Flight`.`{}` (
+                `table_name` VARCHAR(64) NOT NULL,
+                `chunk_id` VARCHAR(64) NOT NULL,
+                `first_key` BIGINT NOT NULL,
+                `last_key` BIGINT NOT NULL,
+                `num_rows` INT NOT NULL,
+                `received_time` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (`table_name`, `chunk_id`),
+                KEY `table_last_key` (`table_name`, `last_key`),
+                KEY `received_time` (`received_time`)
+            ) ENGINE=InnoDB
+        '''.format(LEDGER_TABLE)
+        with self.pool.cursor() as cursor:
+            cursor.execute(stmt)
+        self.ledger_ready = True
+
+    @staticmethod
+    def chunk_id(first_key, last_key):
+        return '{}-{}'.format(first_key, last_key)
+
+    def sync_ledger_watermark(self, table):
+        # Returns the newest event_key of the table that the ground has
+        # committed, or 0 if no chunks of the table are in the ledger.
+        self._ensure_ledger()
+        stmt = '''
+            SELECT MAX(`last_key`) AS 'watermark' FROM `stepSATdb_Flight`.`{}` WHERE `table_name` = %s
+        '''.format(LEDGER_TABLE)
+        with self.pool.cursor() as cursor:
+            cursor.execute(stmt, (table,))
+            row = cursor.fetchone()
+        if row and row['watermark']:
+            return int(row['watermark'])
+        return 0
+
+    def _prune_ledger(self, cursor, table):
+        now = time.time()
+        if now - self.ledger_pruned.get(table, 0) < LEDGER_PRUNE_INTERVAL:
+            return
+        self.ledger_pruned[table] = now
+        stmt = '''
+            DELETE FROM `stepSATdb_Flight`.`{}` WHERE `table_name` = %s AND `received_time` < (NOW() - INTERVAL {} SECOND)
+        '''.format(LEDGER_TABLE, LEDGER_RETENTION)
+        cursor.execute(stmt, (table,))
+
+    def write_sync_rows(self, table, columns, rows, compress=False):
+        # Writes a chunk of rows read from the flight database and records
+        # the chunk in the ledger, in one transaction.  Returns the number of
+        # rows written, or 0 if the chunk had already been committed.  Rows
+        # whose key the ground already has are skipped, not updated.
+        # Errors are passed on to the caller so the chunk is not acknowledged.
+        # If compress is set the chunk is sent with the compressed protocol,
+        # the ground server decompresses it before the rows are inserted.
+        if not rows:
+            return 0
+        self._ensure_ledger()
+        key_index = list(columns).index('event_key')
+        first_key = rows[0][key_index]
+        last_key = rows[-1][key_index]
+        stmt_ledger = '''
+            INSERT IGNORE INTO `stepSATdb_Flight`.`{}` (`table_name`, `chunk_id`, `first_key`, `last_key`, `num_rows`) VALUES (%s, %s, %s, %s, %s)
+        '''.format(LEDGER_TABLE)
+        stmt = '''
+            INSERT IGNORE INTO `stepSATdb_Flight`.`{}` ({}) VALUES {}
+        '''.format(table,
+                   ', '.join('`{}`'.format(c) for c in columns),
+                   ','.join(['({})'.format(','.join(['%s'] * len(columns)))] * len(rows)))
+        if compress:
+            pool = self._compressed_pool()
+        else:
+            pool = self.pool
+        with pool.transaction() as cursor:
+            # The ledger row is locked until the transaction ends, so a chunk
+            # that is re-sent while the first copy is still being written
+            # waits for it and is then found in the ledger.
+            cursor.execute(stmt_ledger, (table, self.chunk_id(first_key, last_key), first_key, last_key, len(rows)))
+            if cursor.rowcount == 0:
+                return 0
+            cursor.execute(stmt, [value for row in rows for value in row])
+            self._prune_ledger(cursor, table)
+            return len(rows)
 
     def sync_recording_sessions(self):
         stmt = '''
@@ -180,7 +269,7 @@ class vms_db_ground(object):
         #                 SELECT MAX(`Recording_Sessions`.`recording_session_id`)
         #                     FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
         # '''
-        with self.lock:
+        with self.pool.connection():
             try:
                 sync_Success = self._execute(stmt)
                 # self._execute(stmt_update_last_sync_time)
@@ -203,7 +292,7 @@ class vms_db_ground(object):
         #                 SELECT MAX(`Recording_Sessions`.`recording_session_id`)
         #                     FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
         # '''
-        with self.lock:
+        with self.pool.connection():
             try:
                 sync_Success = self._execute(stmt)
                 # self._execute(stmt_update_last_sync_time)
@@ -226,7 +315,7 @@ class vms_db_ground(object):
         #                 SELECT MAX(`Recording_Sessions`.`recording_session_id`)
         #                     FROM `stepSATdb_Flight`.`Recording_Sessions` LIMIT 1)
         # '''
-        with self.lock:
+        with self.pool.connection():
             try:
                 sync_Success = self._execute(stmt)
                 # self._execute(stmt_update_last_sync_time)
@@ -242,7 +331,7 @@ class vms_db_ground(object):
                 INTO TABLE `stepSATdb_Flight`.`System_Applications` FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
                 ESCAPED BY '\\\\' LINES TERMINATED BY '\n'
         '''
-        with self.lock:
+        with self.pool.connection():
             try:
                 self._execute(stmt)
             except mysql.connector.Error as err:
@@ -257,12 +346,13 @@ class vms_db_ground(object):
                 SELECT *
                     FROM `stepSATdb_Flight`.`Command_Log`
                     WHERE `Command_Log`.`command_state`='Pending-Ground'
-                        AND `Command_Log`.`time_of_command` > '{}'
+                        AND `Command_Log`.`time_of_command` > %s
                         AND `Command_Log`.`Recording_Sessions_recording_session_id`=(
                             SELECT MAX(`Recording_Sessions`.`recording_session_id`)
                                 FROM `stepSATdb_Flight`.`Recording_Sessions`
                     )
-            '''.format(datetime_last_command)
+            '''
+            params = (datetime_last_command,)
         else:
             stmt = '''
                 SELECT *
@@ -273,17 +363,46 @@ class vms_db_ground(object):
                                 FROM `stepSATdb_Flight`.`Recording_Sessions`
                     )
             '''
+            params = None
 
         print stmt
-        with self.lock:
+        with self.pool.connection():
             try:
-                commands = self._execute(stmt)
+                commands = self._execute(stmt, params)
                 return commands
             except mysql.connector.Error as err:
                 print "-----> error connecting to the ground, read_command_log <-----------"
                 syslog.syslog(syslog.LOG_ERR, 'Error reconnecting to ground: {}'.format(err))
                 return False
 
+    def command_sequence(self):
+        # Returns the event_key of the newest command that is waiting for the
+        # spacecraft.  The keys are assigned by the ground in the order the
+        # commands are created, so they are used as the command sequence.
+        stmt = '''
+            SELECT MAX(`event_key`) AS 'seq' FROM `stepSATdb_Flight`.`Command_Log` WHERE `command_state` = 'Pending-Ground'
+        '''
+        with self.pool.cursor() as cursor:
+            cursor.execute(stmt)
+            row = cursor.fetchone()
+        if row and row['seq']:
+            return int(row['seq'])
+        return 0
+
+    def read_commands_after(self, seq, limit=100):
+        # Returns the commands waiting for the spacecraft that come after the
+        # sequence number, oldest first.  This is a range scan of the primary
+        # key so it stays cheap however large the Command_Log gets.  Errors
+        # are passed on to the caller.
+        stmt = '''
+            SELECT * FROM `stepSATdb_Flight`.`Command_Log`
+                WHERE `event_key` > %s AND `command_state` = 'Pending-Ground'
+                ORDER BY `event_key` LIMIT {}
+        '''.format(int(limit))
+        with self.pool.cursor() as cursor:
+            cursor.execute(stmt, (seq,))
+            return cursor.fetchall()
+
     def update_ground_command_log(self, ground_commands):
         # Writes updated row(s)to the ground db command log
         print "update ground command log"
@@ -295,7 +414,7 @@ class vms_db_ground(object):
                             WHERE `Command_Log`.`Recording_Sessions_recording_session_id` = %(Recording_Sessions_recording_session_id)s
                             AND `Command_log`.`time_of_command` = %(time_of_command)s
                 '''
-                with self.lock:
+                with self.pool.connection():
                     try:
                         self._execute(stmt, row)
                     except mysql.connector.Error as err:
@@ -315,7 +434,7 @@ class vms_db_ground(object):
                         ON DUPLICATE KEY UPDATE `Command_Log`.`pushed_to_ground` = 1 , `Command_Log`.`command_state` = %(command_state)s
                 '''
                 print stmt
-                with self.lock:
+                with self.pool.connection():
                     try:
                         self._execute(stmt, row)
                     except mysql.connector.Error as err:
@@ -335,7 +454,7 @@ class vms_db_ground(object):
                 FROM `stepSATdb_Flight`.`Parameter_ID_Table`
                 WHERE `Parameter_ID_Table`.`System_Applications_application_id`=%s
         '''
-        with self.lock:
+        with self.pool.connection():
             info = self._execute(app_stmt, (app_id,))[0]
             params = self._execute(params_stmt, (app_id,))
 